@@ -0,0 +1,228 @@
+"""Análises de empréstimos lidas só dos agregados diários mantidos por
+triggers (emprestimo_diario, emprestimo_diario_livro e
+emprestimo_diario_usuario). Um ano de dados custa algumas centenas de
+linhas agregadas, não uma varredura de emprestimo.
+"""
+from datetime import date, timedelta
+import heapq
+import threading
+
+# Expressão SQL que agrupa `dia` (AAAA-MM-DD) em cada período
+PERIODOS = {
+    'dia': 'dia',
+    'semana': "strftime('%Y-W%W', dia)",
+    'mes': 'substr(dia, 1, 7)',
+    'ano': 'substr(dia, 1, 4)',
+}
+
+DIAS_SEMANA = ('domingo', 'segunda', 'terça', 'quarta', 'quinta', 'sexta', 'sábado')
+
+
+def _filtro(start, end, tipo=None):
+    # Baldes zerados (empréstimos que mudaram de status, data ou tipo de
+    # usuário) não contam como período nem como dia com movimento
+    filtro = ' AND total > 0'
+    params = []
+    if start:
+        filtro += ' AND dia >= ?'
+        params.append(start)
+    if end:
+        filtro += ' AND dia <= ?'
+        params.append(end)
+    if tipo:
+        filtro += ' AND tipo = ?'
+        params.append(tipo)
+    return filtro, params
+
+
+def emprestimos_por_periodo(conn, start=None, end=None, agrupar='mes', tipo=None, bookId=None):
+    """Empréstimos feitos em cada período, com a divisão por status. Com
+    `bookId`, só os empréstimos daquele livro (sem divisão por status)."""
+    periodo = PERIODOS[agrupar]
+    if bookId is not None:
+        if tipo:
+            raise ValueError("tipo e bookId não podem ser combinados")
+        filtro, params = _filtro(start, end)
+        c = conn.execute(f'''
+            SELECT {periodo}, SUM(total) FROM emprestimo_diario_livro
+            WHERE bookId = ?{filtro}
+            GROUP BY 1 ORDER BY 1
+        ''', [bookId] + params)
+        return [{"periodo": p, "total": total} for p, total in c.fetchall()]
+
+    filtro, params = _filtro(start, end, tipo)
+    c = conn.execute(f'''
+        SELECT {periodo}, status, SUM(total) FROM emprestimo_diario
+        WHERE 1=1{filtro}
+        GROUP BY 1, 2 ORDER BY 1
+    ''', params)
+    serie = {}
+    for p, status, total in c.fetchall():
+        item = serie.setdefault(p, {"periodo": p, "total": 0, "por_status": {}})
+        item["total"] += total
+        item["por_status"][status] = total
+    return list(serie.values())
+
+
+def taxa_atraso(conn, start=None, end=None, agrupar='mes', tipo=None):
+    """Fração dos empréstimos de cada período (fora os cancelados) que estão
+    atrasados ou foram devolvidos depois do prazo"""
+    filtro, params = _filtro(start, end, tipo)
+    c = conn.execute(f'''
+        SELECT {PERIODOS[agrupar]}, SUM(total), SUM(atrasados) FROM emprestimo_diario
+        WHERE status != 'CANCEL'{filtro}
+        GROUP BY 1 ORDER BY 1
+    ''', params)
+    return [
+        {
+            "periodo": p,
+            "total": total,
+            "atrasados": atrasados,
+            "taxa": round(atrasados / total, 4) if total else 0.0,
+        } for p, total, atrasados in c.fetchall()
+    ]
+
+
+def dias_pico(conn, start=None, end=None, tipo=None, limite=10):
+    """Os `limite` dias com mais empréstimos e a média por dia da semana"""
+    filtro, params = _filtro(start, end, tipo)
+    c = conn.execute(f'''
+        SELECT dia, SUM(total) FROM emprestimo_diario
+        WHERE 1=1{filtro}
+        GROUP BY dia ORDER BY 2 DESC, dia LIMIT ?
+    ''', params + [limite])
+    dias = [{"dia": dia, "total": total} for dia, total in c.fetchall()]
+
+    c = conn.execute(f'''
+        SELECT CAST(strftime('%w', dia) AS INTEGER), SUM(total), COUNT(DISTINCT dia)
+        FROM emprestimo_diario
+        WHERE 1=1{filtro}
+        GROUP BY 1 ORDER BY 1
+    ''', params)
+    semana = [
+        {"dia_semana": DIAS_SEMANA[d], "total": total, "media": round(total / dias_com_movimento, 2)}
+        for d, total, dias_com_movimento in c.fetchall()
+    ]
+    return {"dias": dias, "dia_semana": semana}
+
+
+# Janelas de ranking aceitas, em dias (0 = todo o período)
+JANELAS_RANKING = (7, 30, 90, 365, 0)
+TAMANHO_RANKING = 100
+
+ENTIDADES_RANKING = {
+    'livros': ('bookId', 'emprestimo_diario_livro'),
+    'usuarios': ('userId', 'emprestimo_diario_usuario'),
+}
+
+
+class Ranking:
+    """Os `k` livros ou usuários com mais empréstimos nos últimos `dias`.
+
+    A primeira leitura soma os agregados diários da janela. Depois disso só
+    são lidos os empréstimos com loanId acima do último já contado, e, na
+    virada do dia, os agregados dos dias que saíram da janela. Exclusões ou
+    mudanças de data, livro ou usuário incrementam o contador
+    ranking_invalidacoes e forçam uma nova soma.
+
+    Enquanto as contagens só crescem, o topo é mantido sem reordenar tudo:
+    um item de fora só entra quando passa o último colocado.
+    """
+
+    def __init__(self, entidade, dias, k=TAMANHO_RANKING):
+        self.coluna, self.tabela = ENTIDADES_RANKING[entidade]
+        self.dias = dias
+        self.k = k
+        self._lock = threading.Lock()
+        self.limpar()
+
+    def limpar(self):
+        self.contagens = {}
+        self.topo = {}
+        self.inicio = None
+        self.marca = None
+        self.invalidacoes = None
+
+    def _inicio_janela(self, hoje):
+        return (hoje - timedelta(days=self.dias - 1)).isoformat() if self.dias else ''
+
+    def atualizar(self, conn, hoje=None):
+        """Traz as contagens para o estado atual do banco e devolve o topo
+        como lista de (id, total), do maior para o menor"""
+        inicio = self._inicio_janela(hoje or date.today())
+        with self._lock:
+            # Todas as leituras no mesmo snapshot, para não perder nem contar
+            # duas vezes um empréstimo gravado no meio da atualização. Uma
+            # conexão de leitura já chega com o snapshot da requisição aberto.
+            abriu = not conn.in_transaction
+            if abriu:
+                conn.execute('BEGIN')
+            try:
+                invalidacoes = conn.execute(
+                    "SELECT valor FROM contador WHERE nome = 'ranking_invalidacoes'").fetchone()[0]
+                maior = conn.execute('SELECT IFNULL(MAX(loanId), 0) FROM emprestimo').fetchone()[0]
+                if (self.marca is None or invalidacoes != self.invalidacoes
+                        or inicio < self.inicio or maior < self.marca):
+                    self._reconstruir(conn, inicio, maior)
+                    self.invalidacoes = invalidacoes
+                else:
+                    if inicio > self.inicio:
+                        self._descartar_dias(conn, inicio)
+                    self._somar_novos(conn, maior)
+            finally:
+                if abriu:
+                    conn.rollback()
+            return sorted(self.topo.items(), key=lambda item: (-item[1], item[0]))
+
+    def _chave(self, id_):
+        return (self.contagens[id_], -id_)
+
+    def _recalcular_topo(self):
+        melhores = heapq.nlargest(self.k, self.contagens, key=self._chave)
+        self.topo = {id_: self.contagens[id_] for id_ in melhores}
+
+    def _reconstruir(self, conn, inicio, maior):
+        c = conn.execute(f'''
+            SELECT {self.coluna}, SUM(total) FROM {self.tabela}
+            WHERE dia >= ? GROUP BY 1 HAVING SUM(total) > 0
+        ''', (inicio,))
+        self.contagens = dict(c.fetchall())
+        self.inicio = inicio
+        self.marca = maior
+        self._recalcular_topo()
+
+    def _descartar_dias(self, conn, inicio):
+        c = conn.execute(f'''
+            SELECT {self.coluna}, SUM(total) FROM {self.tabela}
+            WHERE dia >= ? AND dia < ? GROUP BY 1
+        ''', (self.inicio, inicio))
+        for id_, total in c.fetchall():
+            restante = self.contagens.get(id_, 0) - total
+            if restante > 0:
+                self.contagens[id_] = restante
+            else:
+                self.contagens.pop(id_, None)
+        self.inicio = inicio
+        self._recalcular_topo()
+
+    def _somar_novos(self, conn, maior):
+        if maior <= self.marca:
+            return
+        c = conn.execute(f'''
+            SELECT {self.coluna}, COUNT(*) FROM emprestimo
+            WHERE loanId > ? AND loanId <= ? AND loanDate >= ?
+            GROUP BY 1
+        ''', (self.marca, maior, self.inicio))
+        for id_, n in c.fetchall():
+            self.contagens[id_] = self.contagens.get(id_, 0) + n
+            if id_ in self.topo or len(self.topo) < self.k:
+                self.topo[id_] = self.contagens[id_]
+                continue
+            ultimo = min(self.topo, key=self._chave_topo)
+            if self._chave(id_) > self._chave_topo(ultimo):
+                del self.topo[ultimo]
+                self.topo[id_] = self.contagens[id_]
+        self.marca = maior
+
+    def _chave_topo(self, id_):
+        return (self.topo[id_], -id_)
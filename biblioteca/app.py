@@ -1,27 +1,200 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify
-from database import init_db
+from flask import Flask, Response, render_template, request, redirect, url_for, jsonify, g
+from flask import before_render_template, template_rendered, has_request_context
+from flask.json.provider import DefaultJSONProvider
+from database import conectar_leitura, PoolConexoes
+from circulacao import emprestar, emprestar_varios, devolver, ErroCirculacao
+from tarefas import iniciar_varredor, ultimas_execucoes
+from cache import CacheLRU
+from metricas import ConexaoInstrumentada, ConsultasLentas, Metricas
+from importacao import ler_registros, formato_do_arquivo, importar_livros, importar_usuarios, TIPOS_USUARIO
+from analise import PERIODOS, emprestimos_por_periodo, taxa_atraso, dias_pico
+from analise import Ranking, JANELAS_RANKING, ENTIDADES_RANKING, TAMANHO_RANKING
 import sqlite3
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import base64
+import csv
+import io
+import json
 import math
+import os
+import re
+import unicodedata
+import hashlib
+import time
+from functools import wraps
+
+class JSONCronometrado(DefaultJSONProvider):
+    """Serializador JSON padrão que soma o tempo gasto na etapa "json" da
+    requisição atual"""
+
+    def dumps(self, obj, **kwargs):
+        inicio = time.perf_counter()
+        texto = super().dumps(obj, **kwargs)
+        etapas = g.get('etapas') if has_request_context() else None
+        if etapas is not None:
+            etapas['json'] += time.perf_counter() - inicio
+        return texto
+
 
 app = Flask(__name__)
-init_db()
+app.json = JSONCronometrado(app)
+
+pool = PoolConexoes()
+cache_usuarios = CacheLRU(capacidade=512)
+cache_relatorio = CacheLRU(capacidade=256)
+metricas = Metricas()
+consultas_lentas = ConsultasLentas()
+rankings = {
+    (entidade, dias): Ranking(entidade, dias)
+    for entidade in ENTIDADES_RANKING for dias in JANELAS_RANKING
+}
+
+
+def _instrumentar(conn):
+    """Envolve a conexão para contar e cronometrar os comandos SQL; os que
+    passam de CONSULTA_LENTA_MS vão para o log de consultas lentas"""
+    rota = request.url_rule.rule if has_request_context() and request.url_rule else None
+    limite_s = app.config.get('CONSULTA_LENTA_MS', 100) / 1000
+
+    def ao_encerrar(sql, params, duracao, linhas):
+        if duracao >= limite_s:
+            consultas_lentas.registrar(conn, sql, params, duracao, linhas, rota)
+
+    return ConexaoInstrumentada(conn, ao_encerrar)
 
 
 def get_db():
-    """Retorna conexão com Foreign Keys habilitadas"""
-    conn = sqlite3.connect('biblioteca.db')
-    conn.execute("PRAGMA foreign_keys = ON")
-    return conn
+    """Retorna a conexão de escrita da requisição, tirada do pool e
+    devolvida a ele no fim da requisição"""
+    if 'db' not in g:
+        g.db = _instrumentar(pool.obter())
+    return g.db
+
+
+def get_db_leitura():
+    """Retorna a conexão somente leitura da requisição, já dentro de uma
+    transação: todas as consultas da requisição leem o mesmo snapshot, e no
+    modo WAL isso não atrasa os empréstimos gravados enquanto isso"""
+    if 'db_leitura' not in g:
+        conn = _instrumentar(pool.obter_leitura())
+        conn.execute('BEGIN')
+        g.db_leitura = conn
+    return g.db_leitura
+
+
+@app.teardown_appcontext
+def liberar_db(exc):
+    for nome in ('db', 'db_leitura'):
+        conn = g.pop(nome, None)
+        if conn is not None:
+            pool.liberar(conn.encerrar(), leitura=nome == 'db_leitura')
+
+
+@app.before_request
+def iniciar_medicao():
+    g.inicio = time.perf_counter()
+    g.etapas = {'render': 0.0, 'json': 0.0}
+
+
+def _inicio_render(sender, template, context, **extra):
+    g.inicio_render = time.perf_counter()
+
+
+def _fim_render(sender, template, context, **extra):
+    if 'etapas' in g:
+        g.etapas['render'] += time.perf_counter() - g.inicio_render
+
+
+before_render_template.connect(_inicio_render, app)
+template_rendered.connect(_fim_render, app)
+
+
+@app.after_request
+def registrar_medicao(response):
+    """Registra a latência da rota e informa no cabeçalho Server-Timing
+    quanto da requisição foi gasto em SQL, templates e JSON. Nas respostas
+    em streaming o corpo é gerado depois e fica de fora da medida."""
+    if 'inicio' not in g:
+        return response
+    total = time.perf_counter() - g.inicio
+    conexoes = [conn for conn in (g.get('db'), g.get('db_leitura')) if conn is not None]
+    etapas = dict(g.etapas, sql=sum(conn.segundos for conn in conexoes))
+    consultas = sum(conn.consultas for conn in conexoes)
+
+    response.headers['Server-Timing'] = ', '.join(
+        [f'sql;dur={etapas["sql"] * 1000:.2f};desc="{consultas} consultas"'] +
+        [f'{etapa};dur={etapas[etapa] * 1000:.2f}' for etapa in ('render', 'json')] +
+        [f'total;dur={total * 1000:.2f}']
+    )
+    rota = request.url_rule.rule if request.url_rule else 'desconhecida'
+    metricas.registrar(rota, request.method, response.status_code, total,
+                       dict(etapas, consultas=consultas))
+    return response
+
+
+POR_PAGINA = 50
+
+def pagina_listagem(c, query, chave):
+    """Executa uma listagem paginada por chave, em ordem decrescente de `chave`
+    (a primeira coluna do SELECT). O parâmetro `antes` da URL é a chave do
+    último item da página anterior. Retorna (linhas, cursor da próxima)."""
+    params = []
+    antes = request.args.get('antes', type=int)
+    if antes is not None:
+        query += f' WHERE {chave} < ?'
+        params.append(antes)
+    query += f' ORDER BY {chave} DESC LIMIT ?'
+    params.append(POR_PAGINA + 1)
+    c.execute(query, params)
+    rows = c.fetchall()
+    if len(rows) > POR_PAGINA:
+        return rows[:POR_PAGINA], rows[POR_PAGINA - 1][0]
+    return rows, None
+
+def condicional(*tabelas):
+    """GET condicional: monta ETag e Last-Modified a partir das versões das
+    `tabelas` em tabela_versao (uma consulta por chave primária) e responde
+    304 sem executar a view quando If-None-Match traz a versão atual."""
+    def decorador(view):
+        @wraps(view)
+        def envoltorio(*args, **kwargs):
+            if request.method != 'GET':
+                return view(*args, **kwargs)
+
+            c = get_db_leitura().cursor()
+            c.execute(f'''
+                SELECT tabela, versao, alterado_em FROM tabela_versao
+                WHERE tabela IN ({','.join('?' * len(tabelas))}) ORDER BY tabela
+            ''', tabelas)
+            versoes = c.fetchall()
+            assinatura = f"{versoes}|{request.full_path}".encode()
+            etag = hashlib.sha1(assinatura).hexdigest()[:20]
+            modificado = max(datetime.strptime(v[2], '%Y-%m-%d %H:%M:%S') for v in versoes)
+            modificado = modificado.replace(tzinfo=timezone.utc)
 
+            # If-Modified-Since é ignorado: com resolução de segundos ele não
+            # distingue duas gravações no mesmo segundo; só o ETag valida
+            if request.if_none_match.contains_weak(etag):
+                response = app.response_class(status=304)
+            else:
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.last_modified = modificado
+            response.cache_control.no_cache = True
+            return response
+        return envoltorio
+    return decorador
 
 @app.route('/')
 def index():
     return redirect(url_for('usuarios'))
 
 @app.route('/usuarios', methods=['GET', 'POST'])
+@condicional('usuario')
 def usuarios():
-    conn = get_db()
+    conn = get_db() if request.method == 'POST' else get_db_leitura()
     c = conn.cursor()
 
     if request.method == 'POST':
@@ -37,17 +210,71 @@ def usuarios():
             ''', (nome, matricula, tipo, email))
             conn.commit()
         except sqlite3.IntegrityError as e:
-            conn.close()
             return f"Erro: {str(e)}", 400
+        return redirect(url_for('usuarios'))
+
+    usuarios, proximo = pagina_listagem(c, '''
+        SELECT id, nome, matricula, tipo, email, status FROM usuario
+    ''', 'id')
+    return render_template('usuarios.html', usuarios=usuarios, proximo=proximo)
+
+def versao_tabela(c, tabela):
+    c.execute('SELECT versao FROM tabela_versao WHERE tabela = ?', (tabela,))
+    return c.fetchone()[0]
+
+def buscar_usuarios(c, q, limite):
+    """Busca de usuários para o autocompletar do balcão: prefixo de matrícula
+    pelo índice UNIQUE quando q é numérico, senão prefixo das palavras do nome
+    (sem acentos) pelo índice FTS"""
+    if q.isdigit():
+        # Matrículas só têm dígitos, e ':' é o caractere seguinte ao '9'
+        c.execute('''
+            SELECT id, nome, matricula, tipo FROM usuario
+            WHERE matricula >= ? AND matricula < ?
+            ORDER BY matricula LIMIT ?
+        ''', (q, q + ':', limite))
+        return c.fetchall()
+    consulta = consulta_fts(q)
+    if not consulta:
+        return []
+    # Sem ORDER BY rank: prefixos curtos casam com milhares de nomes e ordenar
+    # por relevância exigiria pontuar todos; o LIMIT encerra a leitura cedo
+    c.execute('''
+        SELECT u.id, u.nome, u.matricula, u.tipo
+        FROM usuario_fts JOIN usuario u ON u.id = usuario_fts.rowid
+        WHERE usuario_fts MATCH ?
+        LIMIT ?
+    ''', (consulta, limite))
+    return c.fetchall()
 
-    c.execute('SELECT * FROM usuario ORDER BY id DESC')
-    usuarios = c.fetchall()
-    conn.close()
-    return render_template('usuarios.html', usuarios=usuarios)
+@app.route('/api/usuarios/busca')
+def api_busca_usuarios():
+    """Autocompletar de usuários por matrícula ou nome, com cache dos prefixos
+    mais consultados invalidado pela versão da tabela usuario"""
+    q = request.args.get('q', '').strip()
+    limite = min(max(request.args.get('limite', 10, type=int), 1), 50)
+    if not q:
+        return jsonify({"data": []})
+
+    # Só os acentos saem da chave (como no índice FTS): descartar tudo o que
+    # não é ASCII levaria buscas em outros alfabetos à mesma chave ''
+    sem_acentos = ''.join(ch for ch in unicodedata.normalize('NFKD', q) if not unicodedata.combining(ch))
+    chave = (sem_acentos.casefold(), limite)
+    c = get_db_leitura().cursor()
+    versao = versao_tabela(c, 'usuario')
+    data = cache_usuarios.obter(chave, versao)
+    if data is None:
+        data = [
+            {"id": r[0], "nome": r[1], "matricula": r[2], "tipo": r[3]}
+            for r in buscar_usuarios(c, q, limite)
+        ]
+        cache_usuarios.guardar(chave, versao, data)
+    return jsonify({"data": data})
 
 @app.route('/livros', methods=['GET', 'POST'])
+@condicional('livro')
 def livros():
-    conn = get_db()
+    conn = get_db() if request.method == 'POST' else get_db_leitura()
     c = conn.cursor()
 
     if request.method == 'POST':
@@ -63,98 +290,353 @@ def livros():
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         ''', (titulo, autores, isbn, edicao, ano, copias, copias, 'DISPONIVEL'))
         conn.commit()
+        return redirect(url_for('livros'))
+
+    q = request.args.get('q', '').strip()
+    if q:
+        livros, proximo = buscar_livros(c, q, POR_PAGINA), None
+    else:
+        livros, proximo = pagina_listagem(c, '''
+            SELECT bookId, titulo, autores, ISBN, copiasTotal, copiasDisponiveis, status FROM livro
+        ''', 'bookId')
+    return render_template('livros.html', livros=livros, proximo=proximo, q=q)
+
+def consulta_fts(q):
+    """Converte o texto digitado numa consulta FTS5: cada palavra vira um
+    prefixo entre aspas (busca enquanto digita), todas obrigatórias"""
+    return ' '.join(f'"{termo}"*' for termo in re.findall(r'\w+', q))
+
+# Buscas com até esse número de letras não são ordenadas por relevância
+MAX_LETRAS_SEM_RELEVANCIA = 2
+
+def buscar_livros(c, q, limite, offset=0):
+    """Busca no catálogo: ISBN exato quando o texto parece um ISBN, senão
+    busca textual em título e autores ordenada por relevância (bm25), ou
+    pela ordem do catálogo quando o texto tem só uma ou duas letras"""
+    colunas = 'l.bookId, l.titulo, l.autores, l.ISBN, l.copiasTotal, l.copiasDisponiveis, l.status'
+    isbn = re.sub(r'[-\s]', '', q)
+    if re.fullmatch(r'[0-9]{9}[0-9Xx]|[0-9]{13}', isbn):
+        c.execute(f'SELECT {colunas} FROM livro l WHERE l.ISBN = ? LIMIT ? OFFSET ?',
+                  (isbn, limite, offset))
+        rows = c.fetchall()
+        if rows or offset:
+            return rows
+    consulta = consulta_fts(q)
+    if not consulta:
+        return []
+    # Uma ou duas letras casam com boa parte do catálogo e quase não
+    # distinguem os livros: sem ORDER BY rank o LIMIT encerra a leitura do
+    # índice cedo, em vez de pontuar e ordenar todos os livros que casam
+    ordem = 'ORDER BY rank'
+    if len(''.join(re.findall(r'\w+', q))) <= MAX_LETRAS_SEM_RELEVANCIA:
+        ordem = ''
+    c.execute(f'''
+        SELECT {colunas}
+        FROM livro_fts JOIN livro l ON l.bookId = livro_fts.rowid
+        WHERE livro_fts MATCH ?
+        {ordem}
+        LIMIT ? OFFSET ?
+    ''', (consulta, limite, offset))
+    return c.fetchall()
 
-    c.execute('SELECT * FROM livro ORDER BY bookId DESC')
-    livros = c.fetchall()
-    conn.close()
-    return render_template('livros.html', livros=livros)
+@app.route('/api/livros/busca')
+def api_busca_livros():
+    """Busca paginada no catálogo por título, autores ou ISBN"""
+    q = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    per_page = 20
+    if not q or page < 1:
+        return jsonify({"erro": "Informe o termo de busca em q"}), 400
+
+    rows = buscar_livros(get_db_leitura().cursor(), q, per_page + 1, (page - 1) * per_page)
+    return jsonify({
+        "data": [
+            {
+                "bookId": r[0],
+                "titulo": r[1],
+                "autores": r[2],
+                "isbn": r[3],
+                "copiasDisponiveis": r[5],
+            } for r in rows[:per_page]
+        ],
+        "pagination": {
+            "page": page,
+            "per_page": per_page,
+            "has_more": len(rows) > per_page
+        }
+    })
+
+def registros_enviados():
+    """Lê o arquivo da importação, enviado como campo `arquivo` de um
+    formulário multipart ou como corpo da requisição, sem carregá-lo todo"""
+    formato = request.args.get('formato')
+    if 'arquivo' in request.files:
+        arquivo = request.files['arquivo']
+        formato = formato or formato_do_arquivo(arquivo.filename or '')
+        fluxo = arquivo.stream
+    else:
+        formato = formato or ('jsonl' if request.mimetype in ('application/x-ndjson', 'application/jsonl') else 'csv')
+        fluxo = request.stream
+    if formato not in ('csv', 'jsonl'):
+        raise ValueError("Formato deve ser csv ou jsonl")
+    return ler_registros(io.TextIOWrapper(fluxo, encoding='utf-8-sig', newline=''), formato)
+
+@app.route('/api/livros/importar', methods=['POST'])
+def api_importar_livros():
+    try:
+        registros = registros_enviados()
+    except ValueError as e:
+        return jsonify({"erro": str(e)}), 400
+    return jsonify(importar_livros(get_db(), registros))
+
+@app.route('/api/usuarios/importar', methods=['POST'])
+def api_importar_usuarios():
+    try:
+        registros = registros_enviados()
+    except ValueError as e:
+        return jsonify({"erro": str(e)}), 400
+    return jsonify(importar_usuarios(get_db(), registros))
 
 @app.route('/emprestimos', methods=['GET', 'POST'])
+@condicional('usuario', 'livro', 'emprestimo')
 def emprestimos():
-    conn = get_db()
+    conn = get_db() if request.method == 'POST' else get_db_leitura()
     c = conn.cursor()
 
     if request.method == 'POST':
-        userId = request.form['userId']
-        bookId = request.form['bookId']
-        dias = 14 if request.form['tipo'] == 'ALUNO' else 30
-        
-        # Usar data/hora local
-        hoje = datetime.now()
-        dueDate = (hoje + timedelta(days=dias)).strftime('%Y-%m-%d')
-        loanDate = hoje.strftime('%Y-%m-%d %H:%M:%S')
-
-        # Verificar disponibilidade
-        c.execute('SELECT copiasDisponiveis FROM livro WHERE bookId = ?', (bookId,))
-        result = c.fetchone()
-        if not result or result[0] <= 0:
-            conn.close()
-            return "Livro indisponível", 400
-
+        # O campo bookId aceita vários IDs separados por vírgula
         try:
-            c.execute('''
-                INSERT INTO emprestimo (userId, bookId, loanDate, dueDate) 
-                VALUES (?, ?, ?, ?)
-            ''', (userId, bookId, loanDate, dueDate))
-
-            c.execute('UPDATE livro SET copiasDisponiveis = copiasDisponiveis - 1 WHERE bookId = ?', (bookId,))
-            conn.commit()
+            bookIds = [int(b) for b in request.form['bookId'].split(',')]
+        except ValueError:
+            return "ID de livro inválido", 400
+        try:
+            if len(bookIds) == 1:
+                emprestar(conn, request.form['userId'], bookIds[0], request.form['tipo'])
+            else:
+                resultado = emprestar_varios(conn, request.form['userId'], bookIds, request.form['tipo'])
+                if not resultado['emprestados']:
+                    ids = ', '.join(str(r['bookId']) for r in resultado['recusados'])
+                    return f"Livros indisponíveis: {ids}", 400
+        except ErroCirculacao as e:
+            return str(e), 400
         except sqlite3.IntegrityError as e:
-            conn.close()
             return f"Erro ao registrar empréstimo: {str(e)}", 400
+        return redirect(url_for('emprestimos'))
 
-    c.execute('''
+    emprestimos, proximo = pagina_listagem(c, '''
         SELECT e.loanId, u.nome, l.titulo, e.loanDate, e.dueDate, e.status 
         FROM emprestimo e
         JOIN usuario u ON e.userId = u.id
         JOIN livro l ON e.bookId = l.bookId
-        ORDER BY e.loanId DESC
-    ''')
-    emprestimos = c.fetchall()
-    conn.close()
-    return render_template('emprestimos.html', emprestimos=emprestimos)
+    ''', 'e.loanId')
+    return render_template('emprestimos.html', emprestimos=emprestimos, proximo=proximo)
+
+def id_json(valor):
+    """Valida um ID vindo de um corpo JSON: só inteiros (não bool, string
+    nem número com casas decimais, que int() aceitaria)"""
+    if type(valor) is not int:
+        raise TypeError(f"ID inválido: {valor!r}")
+    return valor
+
+def ids_json(valor):
+    """Valida uma lista de IDs vinda de um corpo JSON. Uma string ou um
+    objeto seriam percorridos caractere a caractere ou pelas chaves."""
+    if not isinstance(valor, list):
+        raise TypeError(f"lista de IDs inválida: {valor!r}")
+    return [id_json(i) for i in valor]
+
+@app.route('/api/emprestimos/lote', methods=['POST'])
+def api_emprestimos_lote():
+    """Empréstimo de vários livros para um usuário em uma só transação.
+    Corpo JSON: {"userId", "bookIds": [...], "tipo", "parcial": false}"""
+    dados = request.get_json(silent=True) or {}
+    try:
+        userId = id_json(dados['userId'])
+        bookIds = ids_json(dados['bookIds'])
+    except (KeyError, TypeError):
+        return jsonify({"erro": "Informe userId e a lista bookIds"}), 400
+
+    try:
+        resultado = emprestar_varios(get_db(), userId, bookIds, dados.get('tipo', 'ALUNO'),
+                                     parcial=bool(dados.get('parcial')))
+    except ErroCirculacao as e:
+        return jsonify({"erro": str(e)}), 400
+    except sqlite3.IntegrityError as e:
+        return jsonify({"erro": f"Erro ao registrar empréstimo: {str(e)}"}), 400
+    return jsonify(resultado), 200 if resultado['emprestados'] else 400
+
+@app.route('/devolucoes', methods=['POST'])
+def devolucoes():
+    """Devolução pelo formulário da página de empréstimos (IDs separados por vírgula)"""
+    try:
+        loanIds = [int(i) for i in request.form['loanIds'].split(',')]
+    except ValueError:
+        return "ID de empréstimo inválido", 400
+    resultado = devolver(get_db(), loanIds)
+    if not resultado['devolvidos']:
+        return "Nenhum empréstimo ativo com esses IDs", 400
+    return redirect(url_for('emprestimos'))
+
+@app.route('/api/devolucoes', methods=['POST'])
+def api_devolucoes():
+    """Devolução de um ou vários empréstimos. Corpo JSON: {"loanIds": [...]}"""
+    dados = request.get_json(silent=True) or {}
+    try:
+        loanIds = ids_json(dados['loanIds'])
+    except (KeyError, TypeError):
+        return jsonify({"erro": "Informe a lista loanIds"}), 400
+    return jsonify(devolver(get_db(), loanIds))
+
+RELATORIO_FROM = '''
+    FROM emprestimo e
+    JOIN usuario u ON e.userId = u.id
+    JOIN livro l ON e.bookId = l.bookId
+    WHERE 1=1
+'''
+CONSULTA_RELATORIO = 'SELECT e.loanId, u.matricula, l.titulo, e.loanDate, e.dueDate, e.status' + RELATORIO_FROM
+# INDEXED BY: sem estatísticas do histórico o planejador parte de usuario e
+# ordena tudo numa árvore temporária em vez de seguir o índice de loanDate
+CONSULTA_HISTORICO = CONSULTA_RELATORIO.replace(
+    'FROM emprestimo e', 'FROM emprestimo_historico e INDEXED BY idx_emprestimo_historico_loanDate')
+
+def consulta_relatorio(c, start, filtro, params):
+    """SELECT do relatório com `filtro` aplicado. Os empréstimos arquivados
+    em emprestimo_historico só entram (UNION ALL) quando o período começa
+    antes do último empréstimo arquivado; o ORDER BY que o chamador
+    acrescenta vale para a união inteira. Retorna (consulta, parâmetros)."""
+    c.execute('SELECT MAX(loanDate) FROM emprestimo_historico')
+    ultimo = c.fetchone()[0]
+    if ultimo is None or (start and start > ultimo):
+        return CONSULTA_RELATORIO + filtro, params
+    return CONSULTA_RELATORIO + filtro + ' UNION ALL ' + CONSULTA_HISTORICO + filtro, params + params
+
+def normalizar_data(valor):
+    """Valida uma data AAAA-MM-DD e devolve no formato canônico (ou None)"""
+    if not valor:
+        return None
+    return datetime.strptime(valor, '%Y-%m-%d').strftime('%Y-%m-%d')
+
+def filtro_datas(start, end):
+    """Monta o filtro de período sobre e.loanDate como intervalo simples,
+    sem envolver a coluna em date(), para que o índice possa ser usado"""
+    filtro = ''
+    params = []
+    if start:
+        filtro += ' AND e.loanDate >= ?'
+        params.append(normalizar_data(start))
+    if end:
+        fim = datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1)
+        filtro += ' AND e.loanDate < ?'
+        params.append(fim.strftime('%Y-%m-%d'))
+    return filtro, params
+
+def total_emprestimos(c, start, end):
+    """Total de empréstimos no período lido dos contadores mantidos por
+    triggers (contador e emprestimo_diario): O(1) sem filtro e O(dias) com
+    filtro, em vez de um COUNT(*). Os filtros são sempre em dias inteiros,
+    casando com os baldes diários."""
+    if not start and not end:
+        c.execute("SELECT valor FROM contador WHERE nome = 'emprestimos'")
+        return c.fetchone()[0]
+    c.execute('''
+        SELECT COALESCE(SUM(total), 0) FROM emprestimo_diario
+        WHERE dia >= COALESCE(?, '') AND dia <= COALESCE(?, '9999-12-31')
+    ''', (start, end))
+    return c.fetchone()[0]
+
+def codificar_cursor(loan_date, loan_id):
+    """Cursor opaco com a chave (loanDate, loanId) do último item da página"""
+    bruto = json.dumps([loan_date, loan_id]).encode()
+    return base64.urlsafe_b64encode(bruto).decode().rstrip('=')
+
+def filtro_cursor(cursor):
+    """Converte o cursor recebido no filtro de chave da próxima página"""
+    if not cursor:
+        return '', []
+    try:
+        bruto = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        loan_date, loan_id = json.loads(bruto)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"cursor inválido: {e}")
+    if not isinstance(loan_date, str) or not isinstance(loan_id, int):
+        raise ValueError("cursor inválido")
+    return ' AND (e.loanDate, e.loanId) < (?, ?)', [loan_date, loan_id]
 
 @app.route('/relatorios')
 def relatorios():
     return render_template('relatorios.html')
 
+PARAMETROS_RELATORIO = ('start', 'end', 'page', 'cursor', 'total', 'per_page')
+POR_PAGINA_RELATORIO = 20
+MAX_POR_PAGINA_RELATORIO = 200
+
+def versao_dados(c):
+    """Geração dos dados do relatório: muda a cada gravação em usuario,
+    livro ou emprestimo (contadores mantidos por triggers)"""
+    c.execute("SELECT tabela, versao FROM tabela_versao WHERE tabela IN ('usuario', 'livro', 'emprestimo')")
+    return tuple(sorted(c.fetchall()))
+
 @app.route('/api/relatorio/emprestimos')
+@condicional('usuario', 'livro', 'emprestimo')
 def api_emprestimos():
-    conn = get_db()
-    c = conn.cursor()
+    """Relatório paginado de empréstimos.
 
-    start = request.args.get('start')
-    end = request.args.get('end')
-    page = int(request.args.get('page', 1))
-    per_page = 20  
+    Aceita `page` (paginação por número, com total) ou `cursor` (paginação
+    por chave, em tempo constante em qualquer profundidade). No modo cursor
+    o total exato só é calculado quando `total=1` é informado. `per_page`
+    vai de 1 a MAX_POR_PAGINA_RELATORIO (padrão 20).
+    """
+    conn = get_db_leitura()
+    c = conn.cursor()
 
-    query = '''
-        SELECT e.loanId, u.matricula, l.titulo, e.loanDate, e.dueDate, e.status
-        FROM emprestimo e
-        JOIN usuario u ON e.userId = u.id
-        JOIN livro l ON e.bookId = l.bookId
-        WHERE 1=1
-    '''
-    params = []
+    # A versão é lida antes da consulta: se houver gravação no meio, o
+    # resultado fica marcado com a versão antiga e é refeito na próxima leitura
+    chave = tuple(request.args.get(p) for p in PARAMETROS_RELATORIO)
+    versao = versao_dados(c)
+    result = cache_relatorio.obter(chave, versao)
+    if result is not None:
+        return jsonify(result)
 
-    if start:
-        query += ' AND date(e.loanDate) >= date(?)'
-        params.append(start)
-    if end:
-        query += ' AND date(e.loanDate) <= date(?)'
-        params.append(end)
+    modo_cursor = 'cursor' in request.args
 
-    count_query = query.replace('SELECT e.loanId, u.matricula, l.titulo, e.loanDate, e.dueDate, e.status', 'SELECT COUNT(*)')
-    c.execute(count_query, params)
-    total = c.fetchone()[0]
-    total_pages = math.ceil(total / per_page)
+    try:
+        per_page = int(request.args.get('per_page', POR_PAGINA_RELATORIO))
+        if not 1 <= per_page <= MAX_POR_PAGINA_RELATORIO:
+            raise ValueError
+        start = normalizar_data(request.args.get('start'))
+        end = normalizar_data(request.args.get('end'))
+        filtro, params = filtro_datas(start, end)
+        if modo_cursor:
+            page = None
+            filtro_pagina, params_pagina = filtro_cursor(request.args['cursor'])
+            offset = 0
+        else:
+            page = int(request.args.get('page', 1))
+            filtro_pagina, params_pagina = '', []
+            offset = (max(page, 1) - 1) * per_page
+    except ValueError:
+        return jsonify({"erro": "Parâmetros de data, página, cursor ou per_page "
+                                f"(1 a {MAX_POR_PAGINA_RELATORIO}) inválidos"}), 400
 
-    query += ' ORDER BY e.loanDate DESC LIMIT ? OFFSET ?'
-    params.extend([per_page, (page - 1) * per_page])
+    pagination = {"per_page": per_page}
+    if not modo_cursor or request.args.get('total') == '1':
+        total = total_emprestimos(c, start, end)
+        pagination["total"] = total
+        pagination["total_pages"] = math.ceil(total / per_page)
+    if page is not None:
+        pagination["page"] = page
 
-    c.execute(query, params)
+    # Busca uma linha a mais para saber se existe próxima página
+    query, params = consulta_relatorio(c, start, filtro + filtro_pagina, params + params_pagina)
+    c.execute(query + ' ORDER BY e.loanDate DESC, e.loanId DESC LIMIT ? OFFSET ?',
+              params + [per_page + 1, offset])
     rows = c.fetchall()
 
+    pagination["next_cursor"] = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        pagination["next_cursor"] = codificar_cursor(rows[-1][3], rows[-1][0])
+
     result = {
         "data": [
             {
@@ -166,15 +648,196 @@ def api_emprestimos():
                 "status": r[5]
             } for r in rows
         ],
-        "pagination": {
-            "page": page,
-            "per_page": per_page,
-            "total": total,
-            "total_pages": total_pages
-        }
+        "pagination": pagination
     }
-    conn.close()
+    cache_relatorio.guardar(chave, versao, result)
     return jsonify(result)
 
+CAMPOS_EXPORTACAO = ('loanId', 'matricula', 'titulo', 'emprestimo', 'devolucao_prevista', 'status')
+
+def linhas_exportacao(query, params, formato, lote=1000):
+    """Gera o conteúdo da exportação a partir do cursor, lote a lote.
+
+    Usa uma conexão própria com uma transação de leitura aberta do início ao
+    fim: no modo WAL isso fixa um snapshot consistente sem bloquear os
+    empréstimos gravados enquanto a exportação corre.
+    """
+    conn = conectar_leitura(pool.path)
+    try:
+        conn.execute('BEGIN')
+        c = conn.execute(query, params)
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+        if formato == 'csv':
+            escritor.writerow(CAMPOS_EXPORTACAO)
+        while True:
+            rows = c.fetchmany(lote)
+            if not rows:
+                break
+            for r in rows:
+                valores = (r[0], r[1], r[2], r[3][:10], r[4][:10], r[5])
+                if formato == 'csv':
+                    escritor.writerow(valores)
+                else:
+                    buffer.write(json.dumps(dict(zip(CAMPOS_EXPORTACAO, valores)), ensure_ascii=False) + '\n')
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+    finally:
+        conn.rollback()
+        conn.close()
+
+@app.route('/api/relatorio/emprestimos/exportar')
+def exportar_emprestimos():
+    """Exportação completa do relatório em CSV ou NDJSON, em streaming"""
+    formato = request.args.get('formato', 'csv')
+    if formato not in ('csv', 'ndjson'):
+        return jsonify({"erro": "Formato deve ser csv ou ndjson"}), 400
+    try:
+        start = normalizar_data(request.args.get('start'))
+        filtro, params = filtro_datas(start, normalizar_data(request.args.get('end')))
+    except ValueError:
+        return jsonify({"erro": "Datas devem estar no formato AAAA-MM-DD"}), 400
+
+    query, params = consulta_relatorio(get_db_leitura().cursor(), start, filtro, params)
+    query += ' ORDER BY e.loanDate DESC, e.loanId DESC'
+    mimetype = 'text/csv' if formato == 'csv' else 'application/x-ndjson'
+    return Response(linhas_exportacao(query, params, formato), mimetype=mimetype, headers={
+        "Content-Disposition": f"attachment; filename=emprestimos.{formato}"
+    })
+
+def parametros_analise():
+    """Lê start, end, agrupar e tipo da URL; lança ValueError se inválidos"""
+    agrupar = request.args.get('agrupar', 'mes')
+    tipo = request.args.get('tipo') or None
+    if agrupar not in PERIODOS or (tipo and tipo not in TIPOS_USUARIO):
+        raise ValueError
+    return (normalizar_data(request.args.get('start')),
+            normalizar_data(request.args.get('end')), agrupar, tipo)
+
+ERRO_ANALISE = "Parâmetros inválidos: datas AAAA-MM-DD, agrupar (dia, semana, mes, ano) e tipo de usuário"
+
+@app.route('/api/analise/emprestimos')
+@condicional('usuario', 'emprestimo')
+def api_analise_emprestimos():
+    """Empréstimos por período (`agrupar`), filtráveis por tipo de usuário
+    ou por livro (`bookId`)"""
+    try:
+        start, end, agrupar, tipo = parametros_analise()
+        bookId = request.args.get('bookId', type=int)
+        serie = emprestimos_por_periodo(get_db_leitura(), start, end, agrupar, tipo, bookId)
+    except ValueError:
+        return jsonify({"erro": ERRO_ANALISE}), 400
+    return jsonify({"agrupar": agrupar, "data": serie})
+
+@app.route('/api/analise/atrasos')
+@condicional('usuario', 'emprestimo')
+def api_analise_atrasos():
+    """Taxa de atraso por período"""
+    try:
+        start, end, agrupar, tipo = parametros_analise()
+    except ValueError:
+        return jsonify({"erro": ERRO_ANALISE}), 400
+    return jsonify({"agrupar": agrupar, "data": taxa_atraso(get_db_leitura(), start, end, agrupar, tipo)})
+
+@app.route('/api/analise/picos')
+@condicional('usuario', 'emprestimo')
+def api_analise_picos():
+    """Dias com mais empréstimos e média por dia da semana"""
+    try:
+        start, end, _, tipo = parametros_analise()
+    except ValueError:
+        return jsonify({"erro": ERRO_ANALISE}), 400
+    limite = min(max(request.args.get('limite', 10, type=int), 1), 100)
+    return jsonify(dias_pico(get_db_leitura(), start, end, tipo, limite))
+
+@app.route('/api/relatorio/ranking')
+def api_ranking():
+    """Os `n` livros (ou usuários, com entidade=usuarios) com mais
+    empréstimos nos últimos `dias` (7, 30, 90, 365 ou 0 para todo o período)"""
+    entidade = request.args.get('entidade', 'livros')
+    dias = request.args.get('dias', 30, type=int)
+    n = request.args.get('n', 10, type=int)
+    if (entidade, dias) not in rankings or not 1 <= n <= TAMANHO_RANKING:
+        return jsonify({"erro": f"entidade deve ser livros ou usuarios, dias um de {JANELAS_RANKING} "
+                                f"e n entre 1 e {TAMANHO_RANKING}"}), 400
+
+    conn = get_db_leitura()
+    topo = rankings[(entidade, dias)].atualizar(conn)[:n]
+    ids = [id_ for id_, _ in topo]
+    marcas = ','.join('?' * len(ids))
+    if entidade == 'livros':
+        c = conn.execute(f'SELECT bookId, titulo, autores FROM livro WHERE bookId IN ({marcas})', ids)
+        dados = {r[0]: {"bookId": r[0], "titulo": r[1], "autores": r[2]} for r in c.fetchall()}
+    else:
+        c = conn.execute(f'SELECT id, nome, matricula, tipo FROM usuario WHERE id IN ({marcas})', ids)
+        dados = {r[0]: {"userId": r[0], "nome": r[1], "matricula": r[2], "tipo": r[3]} for r in c.fetchall()}
+    return jsonify({
+        "entidade": entidade,
+        "dias": dias,
+        "data": [dict(dados.get(id_, {}), posicao=i, emprestimos=total)
+                 for i, (id_, total) in enumerate(topo, start=1)],
+    })
+
+@app.route('/api/diagnostico')
+def api_diagnostico():
+    return jsonify({
+        "pool": pool.estatisticas(),
+        "cache_usuarios": cache_usuarios.estatisticas(),
+        "cache_relatorio": cache_relatorio.estatisticas(),
+        "tarefas": ultimas_execucoes(get_db_leitura()),
+    })
+
+def somente_local(view):
+    """Recusa requisições que não venham da própria máquina"""
+    @wraps(view)
+    def envoltorio(*args, **kwargs):
+        if request.remote_addr not in ('127.0.0.1', '::1'):
+            return "Acesso restrito à máquina local", 403
+        return view(*args, **kwargs)
+    return envoltorio
+
+@app.route('/metrics')
+@somente_local
+def metrics():
+    """Métricas no formato texto do Prometheus, só para a máquina local"""
+    estatisticas_pool = pool.estatisticas()
+    caches = {'usuarios': cache_usuarios.estatisticas(), 'relatorio': cache_relatorio.estatisticas()}
+    extras = [
+        ('biblioteca_pool_conexoes', 'gauge', 'Conexões abertas no pool.',
+         [({}, estatisticas_pool['conexoes'])]),
+        ('biblioteca_pool_ociosas', 'gauge', 'Conexões ociosas à espera nas filas do pool.',
+         [({}, estatisticas_pool['ociosas'])]),
+        ('biblioteca_pool_obtencoes_total', 'counter', 'Conexões obtidas do pool.',
+         [({'resultado': 'hit'}, estatisticas_pool['hits']),
+          ({'resultado': 'miss'}, estatisticas_pool['misses'])]),
+        ('biblioteca_cache_entradas', 'gauge', 'Entradas em cada cache.',
+         [({'cache': nome}, e['entradas']) for nome, e in caches.items()]),
+        ('biblioteca_cache_consultas_total', 'counter', 'Consultas aos caches.',
+         [({'cache': nome, 'resultado': resultado}, e[campo]) for nome, e in caches.items()
+          for resultado, campo in (('hit', 'hits'), ('miss', 'misses'))]),
+        ('biblioteca_cache_evictions_total', 'counter', 'Entradas descartadas por falta de espaço.',
+         [({'cache': nome}, e['evictions']) for nome, e in caches.items()]),
+    ]
+    return Response(metricas.exportar(extras), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/consultas-lentas', methods=['GET', 'DELETE'])
+@somente_local
+def admin_consultas_lentas():
+    """Consultas acima de CONSULTA_LENTA_MS, com o plano de execução, em
+    ordem de tempo total. DELETE esvazia o registro."""
+    if request.method == 'DELETE':
+        consultas_lentas.limpar()
+        return '', 204
+    return jsonify({
+        "limite_ms": app.config.get('CONSULTA_LENTA_MS', 100),
+        "consultas": consultas_lentas.listar(),
+    })
+
 if __name__ == '__main__':
+    # Com o reloader do modo debug, só o processo filho roda o varredor
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        iniciar_varredor(pool.path, app.config.get('VARREDURA_ATRASOS_S', 3600))
     app.run(debug=True)
\ No newline at end of file
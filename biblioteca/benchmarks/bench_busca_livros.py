@@ -0,0 +1,73 @@
+"""Benchmark da busca no catálogo (/api/livros/busca).
+
+Cria uma base temporária com o catálogo de gerar_dados.py e mede a latência
+das buscas por prefixos curtos (que casam com boa parte do catálogo), por
+palavras inteiras, por vários termos e por ISBN, na primeira página e numa
+página funda.
+
+    python benchmarks/bench_busca_livros.py --livros 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import unicodedata
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from gerar_dados import gerar, PALAVRAS
+
+
+def percentis(amostras):
+    amostras = sorted(amostras)
+    def p(q):
+        return amostras[min(len(amostras) - 1, int(q * len(amostras)))]
+    return f'p50={p(0.5):.2f}ms p95={p(0.95):.2f}ms p99={p(0.99):.2f}ms media={statistics.mean(amostras):.2f}ms'
+
+
+def sem_acentos(palavra):
+    return unicodedata.normalize('NFKD', palavra).encode('ascii', 'ignore').decode().lower()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--livros', type=int, default=200000)
+    parser.add_argument('--consultas', type=int, default=200)
+    parser.add_argument('--semente', type=int, default=42)
+    args = parser.parse_args()
+    rnd = random.Random(args.semente)
+
+    with tempfile.TemporaryDirectory() as pasta:
+        path = os.path.join(pasta, 'bench.db')
+        gerar(path, 100, args.livros, 0, semente=args.semente, hoje=date(2025, 6, 30))
+
+        from app import app, pool
+        pool.path = path
+        cliente = app.test_client()
+        palavras = [sem_acentos(p) for p in PALAVRAS]
+        grupos = {
+            'prefixo curto': lambda: rnd.choice(palavras)[:rnd.randint(1, 3)],
+            'palavra': lambda: rnd.choice(palavras),
+            'dois termos': lambda: ' '.join(p[:4] for p in rnd.sample(palavras, 2)),
+            'isbn': lambda: f'978{rnd.randint(1, args.livros):010d}',
+        }
+
+        for rotulo, gerar_q in grupos.items():
+            for pagina in (1, 20):
+                amostras = []
+                for _ in range(args.consultas):
+                    q = gerar_q()
+                    inicio = time.perf_counter()
+                    cliente.get(f'/api/livros/busca?q={q}&page={pagina}')
+                    amostras.append((time.perf_counter() - inicio) * 1000)
+                print(f'{rotulo:>13} página {pagina:>2}: {percentis(amostras)}')
+        pool.fechar_todas()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Benchmark do autocompletar de usuários (/api/usuarios/busca).
+
+Cria uma base temporária com muitos usuários e mede a latência das buscas
+por prefixo de matrícula e de nome, com e sem o cache de prefixos.
+
+    python benchmarks/bench_busca_usuarios.py --usuarios 100000
+
+A matrícula tem 5 dígitos, então o schema comporta no máximo 100 mil usuários.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+NOMES = ['Ana', 'Bruno', 'Carla', 'Davi', 'Élida', 'Fábio', 'Gustavo', 'Helena', 'Íris', 'João',
+         'Júlia', 'Lucas', 'Márcia', 'Natália', 'Otávio', 'Paula', 'Rafael', 'Sônia', 'Tiago', 'Vitória']
+SOBRENOMES = ['Silva', 'Souza', 'Oliveira', 'Santos', 'Pereira', 'Lima', 'Gonçalves', 'Araújo', 'Ribeiro', 'Conceição']
+
+
+def percentis(amostras):
+    amostras = sorted(amostras)
+    def p(q):
+        return amostras[min(len(amostras) - 1, int(q * len(amostras)))]
+    return f'p50={p(0.5):.2f}ms p95={p(0.95):.2f}ms p99={p(0.99):.2f}ms media={statistics.mean(amostras):.2f}ms'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--usuarios', type=int, default=100000)
+    parser.add_argument('--consultas', type=int, default=2000)
+    args = parser.parse_args()
+    rnd = random.Random(42)
+
+    with tempfile.TemporaryDirectory() as pasta:
+        database.DB_PATH = os.path.join(pasta, 'bench.db')
+        database.init_db()
+        conn = database.conectar(database.DB_PATH)
+        conn.executemany('INSERT INTO usuario (nome, matricula, tipo) VALUES (?, ?, ?)', (
+            (f'{rnd.choice(NOMES)} {rnd.choice(SOBRENOMES)} {rnd.choice(SOBRENOMES)}', f'{i:05d}', 'ALUNO')
+            for i in range(min(args.usuarios, 100000))
+        ))
+        conn.commit()
+        conn.close()
+
+        from app import app, pool, cache_usuarios
+        pool.path = database.DB_PATH
+        cliente = app.test_client()
+        prefixos = [str(rnd.randint(0, 999)) for _ in range(args.consultas // 2)] + \
+                   [rnd.choice(NOMES)[:rnd.randint(2, 4)] for _ in range(args.consultas // 2)]
+
+        for rotulo, repetir in (('sem cache', False), ('com cache', True)):
+            for tipo, consultas in (('matricula', prefixos[:len(prefixos) // 2]), ('nome', prefixos[len(prefixos) // 2:])):
+                amostras = []
+                for q in consultas:
+                    if not repetir:
+                        cache_usuarios.limpar()
+                    inicio = time.perf_counter()
+                    cliente.get(f'/api/usuarios/busca?q={q}')
+                    amostras.append((time.perf_counter() - inicio) * 1000)
+                print(f'{rotulo:>10} {tipo:>9}: {percentis(amostras)}')
+        pool.fechar_todas()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Benchmark de empréstimos concorrentes.
+
+Compara o fluxo antigo (SELECT da disponibilidade, INSERT e UPDATE numa
+transação implícita) com circulacao.emprestar() sob várias threads
+disputando os mesmos livros. Mostra vazão, erros de lock e corridas
+perdidas: no fluxo antigo, quem leu uma cópia disponível que outro já
+levou só é barrado pelo CHECK(copiasDisponiveis >= 0), com erro 400.
+
+    python benchmarks/bench_emprestimos.py --threads 16 --tentativas 200
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from circulacao import emprestar, ErroCirculacao
+
+
+def emprestar_antigo(conn, userId, bookId, tipo):
+    """Fluxo anterior do POST /emprestimos, mantido apenas para comparação"""
+    dias = 14 if tipo == 'ALUNO' else 30
+    hoje = datetime.now()
+    dueDate = (hoje + timedelta(days=dias)).strftime('%Y-%m-%d')
+    loanDate = hoje.strftime('%Y-%m-%d %H:%M:%S')
+
+    c = conn.cursor()
+    c.execute('SELECT copiasDisponiveis FROM livro WHERE bookId = ?', (bookId,))
+    result = c.fetchone()
+    if not result or result[0] <= 0:
+        conn.rollback()
+        raise ErroCirculacao("Livro indisponível")
+    # Cede a vez a outra thread entre a leitura e a escrita
+    time.sleep(0)
+    c.execute('''
+        INSERT INTO emprestimo (userId, bookId, loanDate, dueDate)
+        VALUES (?, ?, ?, ?)
+    ''', (userId, bookId, loanDate, dueDate))
+    c.execute('UPDATE livro SET copiasDisponiveis = copiasDisponiveis - 1 WHERE bookId = ?', (bookId,))
+    conn.commit()
+
+
+def preparar(path, livros, copias):
+    database.DB_PATH = path
+    database.init_db()
+    conn = database.conectar(path)
+    conn.executemany('INSERT INTO usuario (nome, matricula, tipo) VALUES (?, ?, ?)',
+                     [(f'Aluno {i}', f'{i:05d}', 'ALUNO') for i in range(1, 101)])
+    conn.executemany('INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES (?, ?, ?, ?)',
+                     [(f'Livro {i}', 'Autor', copias, copias) for i in range(1, livros + 1)])
+    conn.commit()
+    conn.close()
+
+
+def rodar(funcao, threads, tentativas, livros, copias):
+    with tempfile.TemporaryDirectory() as pasta:
+        path = os.path.join(pasta, 'bench.db')
+        preparar(path, livros, copias)
+        contagem = {'ok': 0, 'indisponivel': 0, 'lock': 0, 'corrida': 0}
+        lock = threading.Lock()
+
+        def balcao(n):
+            conn = database.conectar(path)
+            for i in range(tentativas):
+                bookId = (n + i) % livros + 1
+                try:
+                    funcao(conn, n % 100 + 1, bookId, 'ALUNO')
+                    chave = 'ok'
+                except ErroCirculacao:
+                    chave = 'indisponivel'
+                except sqlite3.IntegrityError:
+                    conn.rollback()
+                    chave = 'corrida'
+                except sqlite3.OperationalError:
+                    conn.rollback()
+                    chave = 'lock'
+                with lock:
+                    contagem[chave] += 1
+            conn.close()
+
+        inicio = time.perf_counter()
+        ts = [threading.Thread(target=balcao, args=(n,)) for n in range(threads)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+        duracao = time.perf_counter() - inicio
+
+        conn = sqlite3.connect(path)
+        emprestados = conn.execute('SELECT COUNT(*) FROM emprestimo').fetchone()[0]
+        negativos = conn.execute('SELECT COUNT(*) FROM livro WHERE copiasDisponiveis < 0').fetchone()[0]
+        conn.close()
+        return {
+            'duracao_s': round(duracao, 3),
+            'tentativas_por_s': round(threads * tentativas / duracao, 1),
+            'emprestimos_por_s': round(contagem['ok'] / duracao, 1),
+            'sucesso': contagem['ok'],
+            'indisponivel': contagem['indisponivel'],
+            'erros_lock': contagem['lock'],
+            'corridas_perdidas': contagem['corrida'],
+            'emprestados_a_mais': max(0, emprestados - livros * copias),
+            'livros_negativos': negativos,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--tentativas', type=int, default=200)
+    parser.add_argument('--livros', type=int, default=20)
+    parser.add_argument('--copias', type=int, default=5)
+    args = parser.parse_args()
+
+    for nome, funcao in (('antigo', emprestar_antigo), ('novo', emprestar)):
+        resultado = rodar(funcao, args.threads, args.tentativas, args.livros, args.copias)
+        print(nome, resultado)
+
+
+if __name__ == '__main__':
+    main()
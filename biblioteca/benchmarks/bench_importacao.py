@@ -0,0 +1,64 @@
+"""Benchmark da importação em lote do catálogo.
+
+Gera um CSV sintético e mede linhas/s de importacao.importar_livros()
+contra o cadastro linha a linha com um commit por livro, como no
+formulário de /livros.
+
+    python benchmarks/bench_importacao.py --linhas 50000
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from importacao import importar_livros, ler_registros, validar_livro, INSERIR_LIVRO, TAMANHO_LOTE
+
+
+def gerar_csv(linhas):
+    buffer = io.StringIO()
+    buffer.write('titulo,autores,isbn,edicao,ano,copiasTotal\n')
+    for i in range(linhas):
+        isbn = f'{9780000000000 + i}' if i % 3 else ''
+        buffer.write(f'Título {i},Autor {i % 997},{isbn},{i % 5 + 1}ª,{1950 + i % 70},{i % 4 + 1}\n')
+    return buffer.getvalue()
+
+
+def um_commit_por_linha(conn, registros):
+    for _, dados in registros:
+        conn.execute(INSERIR_LIVRO, validar_livro(dados))
+        conn.commit()
+
+
+def medir(nome, funcao, conteudo, linhas):
+    with tempfile.TemporaryDirectory() as pasta:
+        database.DB_PATH = os.path.join(pasta, 'bench.db')
+        database.init_db()
+        conn = database.conectar(database.DB_PATH)
+        inicio = time.perf_counter()
+        funcao(conn, ler_registros(io.StringIO(conteudo), 'csv'))
+        duracao = time.perf_counter() - inicio
+        conn.close()
+    print(f'{nome:>20}: {linhas} linhas em {duracao:.2f}s ({linhas / duracao:,.0f} linhas/s)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--linhas', type=int, default=50000)
+    parser.add_argument('--lote', type=int, default=TAMANHO_LOTE)
+    parser.add_argument('--amostra-commit', type=int, default=2000,
+                        help='linhas usadas no cadastro com um commit por linha')
+    args = parser.parse_args()
+
+    medir(f'lotes de {args.lote}', lambda conn, r: importar_livros(conn, r, args.lote),
+          gerar_csv(args.linhas), args.linhas)
+    medir('commit por linha', um_commit_por_linha,
+          gerar_csv(args.amostra_commit), args.amostra_commit)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Benchmark de inicialização.
+
+Mede, em processos novos, o tempo de `import app` e quantas conexões ao
+SQLite ele abre (deve ser zero: o schema só é conferido na primeira
+conexão). Depois mede o custo de migrar um banco novo e o da conferência
+quando o schema já está atualizado.
+
+    python benchmarks/bench_inicializacao.py --repeticoes 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+import database
+
+SCRIPT_IMPORT = '''
+import sqlite3, time
+abertas = []
+original = sqlite3.connect
+sqlite3.connect = lambda *a, **k: abertas.append(a) or original(*a, **k)
+inicio = time.perf_counter()
+import app
+print((time.perf_counter() - inicio) * 1000, len(abertas))
+'''
+
+
+def medir_import(repeticoes):
+    tempos = []
+    conexoes = 0
+    with tempfile.TemporaryDirectory() as pasta:
+        for _ in range(repeticoes):
+            saida = subprocess.run([sys.executable, '-c', SCRIPT_IMPORT], cwd=pasta,
+                                   env=dict(os.environ, PYTHONPATH=RAIZ),
+                                   capture_output=True, text=True, check=True)
+            ms, abertas = saida.stdout.split()
+            tempos.append(float(ms))
+            conexoes = max(conexoes, int(abertas))
+        arquivos = os.listdir(pasta)
+    return {
+        'import_app_ms_mediana': round(statistics.median(tempos), 2),
+        'conexoes_abertas': conexoes,
+        'arquivos_criados': arquivos,
+    }
+
+
+def medir_migracao(repeticoes):
+    with tempfile.TemporaryDirectory() as pasta:
+        path = os.path.join(pasta, 'bench.db')
+        inicio = time.perf_counter()
+        database.init_db(path)
+        banco_novo = (time.perf_counter() - inicio) * 1000
+
+        tempos = []
+        conn = database.conectar(path)
+        for _ in range(repeticoes):
+            inicio = time.perf_counter()
+            database.migrar(conn)
+            tempos.append((time.perf_counter() - inicio) * 1000)
+        conn.close()
+    return {
+        'migrar_banco_novo_ms': round(banco_novo, 2),
+        'migrar_schema_atual_ms_mediana': round(statistics.median(tempos), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeticoes', type=int, default=10)
+    args = parser.parse_args()
+
+    print('import', medir_import(args.repeticoes))
+    print('migracao', medir_migracao(args.repeticoes * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""Benchmark de empréstimos sob carga de relatórios.
+
+Enquanto `--leitores` threads leem o relatório de empréstimos inteiro em
+lotes (como a exportação), uma thread faz empréstimos seguidos e mede a
+latência de cada um. Três modos:
+
+    antes        journal DELETE e conexões de escrita também para ler: o
+                 COMMIT espera todos os leitores soltarem o lock SHARED
+    wal          modo WAL, leitores ainda em conexões de escrita
+    depois       modo WAL e leitores em conexões somente leitura
+                 (conectar_leitura), cada leitura num snapshot
+
+    python benchmarks/bench_leitura_escrita.py --leitores 8 --segundos 5
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from app import CONSULTA_RELATORIO
+from circulacao import emprestar, ErroCirculacao
+from gerar_dados import gerar
+
+CONSULTA = CONSULTA_RELATORIO + ' ORDER BY e.loanDate DESC, e.loanId DESC'
+LOTE = 500
+
+
+def _conectar_antigo(path):
+    """Conexão como era antes do WAL: journal padrão e espera por lock"""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.execute('PRAGMA busy_timeout = 5000')
+    return conn
+
+
+MODOS = {
+    # modo: (journal_mode, conexão do empréstimo, conexão dos leitores)
+    'antes': ('DELETE', _conectar_antigo, _conectar_antigo),
+    'wal': ('WAL', database.conectar, database.conectar),
+    'depois': ('WAL', database.conectar, database.conectar_leitura),
+}
+
+
+def ler_relatorio(conn, snapshot, parar, contagem):
+    while not parar.is_set():
+        if snapshot:
+            conn.execute('BEGIN')
+        c = conn.execute(CONSULTA)
+        while not parar.is_set():
+            linhas = c.fetchmany(LOTE)
+            if not linhas:
+                break
+        c.close()
+        if conn.in_transaction:
+            conn.rollback()
+        contagem[0] += 1
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))]
+
+
+def rodar(path, modo, leitores, segundos, semente):
+    journal, abrir_escrita, abrir_leitura = MODOS[modo]
+    conn = sqlite3.connect(path)
+    conn.execute(f'PRAGMA journal_mode = {journal}')
+    usuarios = conn.execute('SELECT COUNT(*) FROM usuario').fetchone()[0]
+    livros = conn.execute('SELECT COUNT(*) FROM livro').fetchone()[0]
+    conn.close()
+
+    snapshot = abrir_leitura is database.conectar_leitura
+    parar = threading.Event()
+    contagens = []
+    conexoes = []
+    threads = []
+    for _ in range(leitores):
+        leitura = abrir_leitura(path)
+        conexoes.append(leitura)
+        contagem = [0]
+        contagens.append(contagem)
+        threads.append(threading.Thread(target=ler_relatorio, args=(leitura, snapshot, parar, contagem)))
+    for t in threads:
+        t.start()
+
+    rnd = random.Random(semente)
+    escrita = abrir_escrita(path)
+    tempos = []
+    erros_lock = 0
+    indisponiveis = 0
+    fim = time.perf_counter() + segundos
+    while time.perf_counter() < fim:
+        inicio = time.perf_counter()
+        try:
+            emprestar(escrita, rnd.randint(1, usuarios), rnd.randint(livros // 2, livros), 'ALUNO')
+        except ErroCirculacao:
+            indisponiveis += 1
+            continue
+        except sqlite3.OperationalError:
+            erros_lock += 1
+            continue
+        tempos.append((time.perf_counter() - inicio) * 1000)
+
+    parar.set()
+    for t in threads:
+        t.join()
+    for c in conexoes + [escrita]:
+        c.close()
+
+    resultado = {
+        'emprestimos': len(tempos),
+        'erros_lock': erros_lock,
+        'indisponiveis': indisponiveis,
+        'relatorios_lidos': sum(c[0] for c in contagens),
+    }
+    if tempos:
+        resultado.update({
+            'p50_ms': round(statistics.median(tempos), 2),
+            'p95_ms': round(percentil(tempos, 0.95), 2),
+            'p99_ms': round(percentil(tempos, 0.99), 2),
+            'max_ms': round(max(tempos), 2),
+        })
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--leitores', type=int, default=8)
+    parser.add_argument('--segundos', type=float, default=5)
+    parser.add_argument('--usuarios', type=int, default=2000)
+    parser.add_argument('--livros', type=int, default=5000)
+    parser.add_argument('--emprestimos', type=int, default=50000)
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--modos', nargs='+', choices=MODOS, default=list(MODOS))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as pasta:
+        for modo in args.modos:
+            # Um banco novo por modo, para que os empréstimos de um não pesem no outro
+            path = os.path.join(pasta, f'{modo}.db')
+            gerar(path, args.usuarios, args.livros, args.emprestimos,
+                  semente=args.semente, hoje=date(2025, 6, 30))
+            print(modo, rodar(path, modo, args.leitores, args.segundos, args.semente))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""Benchmark de todas as rotas pelo cliente de testes do Flask.
+
+Gera (ou copia) um banco com benchmarks/gerar_dados.py e mede, para cada
+rota, latência p50/p95/p99 e vazão. O resultado é gravado em JSON e
+comparado com a baseline: a rota cujo p95 piorar além da tolerância, ou
+que não tiver entrada na baseline, é listada e o script termina com
+código 1.
+
+    python benchmarks/bench_rotas.py --saida resultado.json
+    python benchmarks/bench_rotas.py --banco dados.db --requisicoes 500
+    python benchmarks/bench_rotas.py --gravar-baseline
+
+O banco informado em --banco é copiado antes, porque as rotas POST gravam.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import gerar_dados
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline_rotas.json')
+
+
+class Contexto:
+    """Dados do banco usados para montar requisições plausíveis"""
+
+    def __init__(self, path, rnd):
+        conn = sqlite3.connect(path)
+        self.rnd = rnd
+        self.usuarios = conn.execute('SELECT MAX(id) FROM usuario').fetchone()[0]
+        self.livros = conn.execute('SELECT MAX(bookId) FROM livro').fetchone()[0]
+        self.emprestimos = conn.execute('SELECT MAX(loanId) FROM emprestimo').fetchone()[0]
+        self.inicio, self.fim = (date.fromisoformat(d[:10]) for d in conn.execute(
+            'SELECT MIN(loanDate), MAX(loanDate) FROM emprestimo').fetchone())
+        self.abertos = [r[0] for r in conn.execute(
+            "SELECT loanId FROM emprestimo WHERE status IN ('ACTIVE', 'OVERDUE')")]
+        usadas = {r[0] for r in conn.execute('SELECT matricula FROM usuario')}
+        self.matriculas_livres = [m for m in (f'{i:05d}' for i in range(100000)) if m not in usadas]
+        conn.close()
+        rnd.shuffle(self.abertos)
+        rnd.shuffle(self.matriculas_livres)
+        self.novos = 0
+
+    def dia(self):
+        return self.inicio + timedelta(days=self.rnd.randint(0, (self.fim - self.inicio).days))
+
+    def palavra(self):
+        return self.rnd.choice(gerar_dados.PALAVRAS)[:self.rnd.randint(3, 8)]
+
+    def loan_ids(self, n):
+        ids, self.abertos = self.abertos[:n], self.abertos[n:]
+        return ids or [self.rnd.randint(1, self.emprestimos)]
+
+
+def _cursor(ctx):
+    from app import codificar_cursor
+    dia = ctx.dia()
+    return codificar_cursor(f'{dia} 12:00:00', ctx.rnd.randint(1, ctx.emprestimos))
+
+
+def _periodo(ctx, dias):
+    inicio = ctx.dia()
+    return f'start={inicio}&end={inicio + timedelta(days=dias)}'
+
+
+def _novo_livro(ctx):
+    ctx.novos += 1
+    return {'titulo': f'Livro Novo {ctx.novos}', 'autores': 'Autor', 'copiasTotal': '2'}
+
+
+def _novo_usuario(ctx):
+    if not ctx.matriculas_livres:
+        return None
+    return {'nome': 'Usuário Novo', 'matricula': ctx.matriculas_livres.pop(), 'tipo': 'ALUNO'}
+
+
+def _csv_livros(ctx, n=100):
+    linhas = ['titulo,autores,copiasTotal']
+    for _ in range(n):
+        ctx.novos += 1
+        linhas.append(f'Importado {ctx.novos},Autor,1')
+    return '\n'.join(linhas)
+
+
+# nome: função que recebe o contexto e devolve (método, url, argumentos do
+# cliente de testes), ou None quando a rota não se aplica a este banco
+ROTAS = {
+    'GET /': lambda ctx: ('GET', '/', {}),
+    'GET /usuarios': lambda ctx: ('GET', '/usuarios', {}),
+    'GET /usuarios?antes': lambda ctx: ('GET', f'/usuarios?antes={ctx.rnd.randint(2, ctx.usuarios)}', {}),
+    'POST /usuarios': lambda ctx: (lambda dados: dados and ('POST', '/usuarios', {'data': dados}))(_novo_usuario(ctx)),
+    'GET /api/usuarios/busca matricula': lambda ctx: ('GET', f'/api/usuarios/busca?q={ctx.rnd.randint(0, 999)}', {}),
+    'GET /api/usuarios/busca nome': lambda ctx: ('GET', f'/api/usuarios/busca?q={ctx.rnd.choice(gerar_dados.NOMES)[:3]}', {}),
+    'GET /livros': lambda ctx: ('GET', '/livros', {}),
+    'GET /livros?antes': lambda ctx: ('GET', f'/livros?antes={ctx.rnd.randint(2, ctx.livros)}', {}),
+    'GET /livros?q': lambda ctx: ('GET', f'/livros?q={ctx.palavra()}', {}),
+    'POST /livros': lambda ctx: ('POST', '/livros', {'data': _novo_livro(ctx)}),
+    'GET /api/livros/busca': lambda ctx: ('GET', f'/api/livros/busca?q={ctx.palavra()}', {}),
+    'POST /api/livros/importar': lambda ctx: ('POST', '/api/livros/importar', {
+        'data': _csv_livros(ctx), 'content_type': 'text/csv'}),
+    'GET /emprestimos': lambda ctx: ('GET', '/emprestimos', {}),
+    'GET /emprestimos?antes': lambda ctx: ('GET', f'/emprestimos?antes={ctx.rnd.randint(2, ctx.emprestimos)}', {}),
+    'POST /emprestimos': lambda ctx: ('POST', '/emprestimos', {'data': {
+        'userId': str(ctx.rnd.randint(1, ctx.usuarios)), 'bookId': str(ctx.rnd.randint(1, ctx.livros)),
+        'tipo': 'ALUNO'}}),
+    'POST /api/emprestimos/lote': lambda ctx: ('POST', '/api/emprestimos/lote', {'json': {
+        'userId': ctx.rnd.randint(1, ctx.usuarios), 'tipo': 'ALUNO', 'parcial': True,
+        'bookIds': [ctx.rnd.randint(1, ctx.livros) for _ in range(3)]}}),
+    'POST /devolucoes': lambda ctx: ('POST', '/devolucoes', {'data': {
+        'loanIds': ','.join(map(str, ctx.loan_ids(1)))}}),
+    'POST /api/devolucoes': lambda ctx: ('POST', '/api/devolucoes', {'json': {'loanIds': ctx.loan_ids(5)}}),
+    'GET /relatorios': lambda ctx: ('GET', '/relatorios', {}),
+    'GET /api/relatorio/emprestimos page': lambda ctx: (
+        'GET', f'/api/relatorio/emprestimos?page={ctx.rnd.randint(1, 50)}', {}),
+    'GET /api/relatorio/emprestimos periodo': lambda ctx: (
+        'GET', f'/api/relatorio/emprestimos?{_periodo(ctx, 30)}', {}),
+    'GET /api/relatorio/emprestimos cursor': lambda ctx: (
+        'GET', f'/api/relatorio/emprestimos?cursor={_cursor(ctx)}', {}),
+    'GET /api/relatorio/emprestimos/exportar': lambda ctx: (
+        'GET', f'/api/relatorio/emprestimos/exportar?{_periodo(ctx, 1)}', {}),
+    'GET /api/relatorio/ranking livros': lambda ctx: (
+        'GET', f'/api/relatorio/ranking?entidade=livros&dias={ctx.rnd.choice((7, 30, 365, 0))}', {}),
+    'GET /api/relatorio/ranking usuarios': lambda ctx: (
+        'GET', f'/api/relatorio/ranking?entidade=usuarios&dias={ctx.rnd.choice((7, 30, 365, 0))}', {}),
+    'GET /api/analise/emprestimos': lambda ctx: (
+        'GET', f'/api/analise/emprestimos?agrupar=mes&{_periodo(ctx, 365)}', {}),
+    'GET /api/analise/atrasos': lambda ctx: ('GET', f'/api/analise/atrasos?agrupar=semana&{_periodo(ctx, 365)}', {}),
+    'GET /api/analise/picos': lambda ctx: ('GET', f'/api/analise/picos?{_periodo(ctx, 365)}', {}),
+    'GET /api/diagnostico': lambda ctx: ('GET', '/api/diagnostico', {}),
+    'GET /metrics': lambda ctx: ('GET', '/metrics', {}),
+    'GET /admin/consultas-lentas': lambda ctx: ('GET', '/admin/consultas-lentas', {}),
+}
+
+
+def percentil(amostras, q):
+    return amostras[min(len(amostras) - 1, int(q * len(amostras)))]
+
+
+def medir(cliente, ctx, montar, requisicoes, aquecimento=3):
+    amostras = []
+    erros = 0
+    for i in range(aquecimento + requisicoes):
+        if i == aquecimento:
+            total = time.perf_counter()
+        pedido = montar(ctx)
+        if pedido is None:
+            break
+        metodo, url, argumentos = pedido
+        inicio = time.perf_counter()
+        resposta = cliente.open(url, method=metodo, **argumentos)
+        resposta.get_data()
+        if i >= aquecimento:
+            amostras.append((time.perf_counter() - inicio) * 1000)
+            erros += resposta.status_code >= 500
+    if not amostras:
+        return None
+    amostras.sort()
+    return {
+        "requisicoes": len(amostras),
+        "erros": erros,
+        "p50_ms": round(percentil(amostras, 0.50), 3),
+        "p95_ms": round(percentil(amostras, 0.95), 3),
+        "p99_ms": round(percentil(amostras, 0.99), 3),
+        "max_ms": round(amostras[-1], 3),
+        "media_ms": round(statistics.mean(amostras), 3),
+        "req_s": round(len(amostras) / (time.perf_counter() - total), 1),
+    }
+
+
+def comparar(resultado, baseline, tolerancia, piso_ms):
+    """Rotas cujo p95 piorou mais que `tolerancia` (fração) e mais que
+    `piso_ms` em relação à baseline, e rotas medidas que não estão na
+    baseline (com baseline_p95_ms None), que assim não passam sem comparação"""
+    regressoes = []
+    for nome, atual in resultado["rotas"].items():
+        anterior = baseline["rotas"].get(nome)
+        if anterior is None:
+            regressoes.append({"rota": nome, "p95_ms": atual["p95_ms"], "baseline_p95_ms": None})
+            continue
+        limite = anterior["p95_ms"] * (1 + tolerancia)
+        if atual["p95_ms"] > limite and atual["p95_ms"] - anterior["p95_ms"] > piso_ms:
+            regressoes.append({"rota": nome, "p95_ms": atual["p95_ms"], "baseline_p95_ms": anterior["p95_ms"]})
+    return regressoes
+
+
+def rodar(path, requisicoes, semente, filtro=None):
+    import app as aplicacao
+    aplicacao.pool.path = path
+    aplicacao.app.config['TESTING'] = True
+    cliente = aplicacao.app.test_client()
+    ctx = Contexto(path, random.Random(semente))
+
+    rotas = {}
+    for nome, montar in ROTAS.items():
+        if filtro and filtro not in nome:
+            continue
+        medida = medir(cliente, ctx, montar, requisicoes)
+        if medida is not None:
+            rotas[nome] = medida
+            print(f'{nome:45} p50={medida["p50_ms"]:8.2f}ms p95={medida["p95_ms"]:8.2f}ms '
+                  f'p99={medida["p99_ms"]:8.2f}ms {medida["req_s"]:8.1f} req/s')
+    aplicacao.pool.fechar_todas()
+    return rotas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--banco', help="banco já gerado (é copiado antes de rodar)")
+    parser.add_argument('--usuarios', type=int, default=20000)
+    parser.add_argument('--livros', type=int, default=50000)
+    parser.add_argument('--emprestimos', type=int, default=200000)
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--requisicoes', type=int, default=200, help="requisições medidas por rota")
+    parser.add_argument('--rota', help="mede só as rotas cujo nome contém este texto")
+    parser.add_argument('--saida', help="arquivo JSON com o resultado")
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--tolerancia', type=float, default=0.25, help="piora aceita no p95 (0.25 = 25%%)")
+    parser.add_argument('--piso-ms', type=float, default=1.0, help="diferença mínima no p95 para acusar regressão")
+    parser.add_argument('--gravar-baseline', action='store_true')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as pasta:
+        path = os.path.join(pasta, 'bench.db')
+        if args.banco:
+            shutil.copyfile(args.banco, path)
+            volumes = {"banco": os.path.basename(args.banco)}
+        else:
+            # Data fixa para que a mesma semente gere sempre o mesmo banco
+            volumes = gerar_dados.gerar(path, args.usuarios, args.livros, args.emprestimos,
+                                        semente=args.semente, hoje=date(2025, 6, 30))
+            print('dados', volumes)
+            volumes.pop('duracao_s')
+        database.DB_PATH = path
+        rotas = rodar(path, args.requisicoes, args.semente, args.rota)
+
+    resultado = {
+        "meta": {
+            "volumes": volumes,
+            "requisicoes": args.requisicoes,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "data": time.strftime('%Y-%m-%d %H:%M:%S'),
+        },
+        "rotas": rotas,
+    }
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            json.dump(resultado, arquivo, ensure_ascii=False, indent=2)
+    if args.gravar_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as arquivo:
+            json.dump(resultado, arquivo, ensure_ascii=False, indent=2)
+        print('baseline gravada em', args.baseline)
+        return
+
+    if not os.path.exists(args.baseline):
+        print('sem baseline para comparar; use --gravar-baseline')
+        return
+    with open(args.baseline, encoding='utf-8') as arquivo:
+        baseline = json.load(arquivo)
+    if baseline["meta"]["volumes"] != volumes:
+        print('aviso: baseline gerada com outros volumes', baseline["meta"]["volumes"])
+    regressoes = comparar(resultado, baseline, args.tolerancia, args.piso_ms)
+    for r in regressoes:
+        if r["baseline_p95_ms"] is None:
+            print(f'SEM BASELINE {r["rota"]}: p95 {r["p95_ms"]}ms; regrave com --gravar-baseline')
+        else:
+            print(f'REGRESSÃO {r["rota"]}: p95 {r["p95_ms"]}ms (baseline {r["baseline_p95_ms"]}ms)')
+    if regressoes:
+        sys.exit(1)
+    print('sem regressões em relação à baseline')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""Gerador de dados sintéticos para benchmarks.
+
+Preenche um banco com o schema de database.py usando volumes configuráveis
+e uma semente fixa: a mesma semente e a mesma --hoje geram o mesmo banco.
+As datas seguem uma distribuição realista: o movimento cresce ao longo do
+período, cai nos fins de semana e nas férias (janeiro e julho), e poucos
+livros e usuários concentram a maior parte dos empréstimos.
+
+    python benchmarks/gerar_dados.py dados.db --usuarios 100000 --livros 1000000 --emprestimos 5000000
+
+A matrícula tem 5 dígitos, então o schema comporta no máximo 100 mil usuários.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from circulacao import MULTA_DIARIA, prazo_dias
+
+MAX_USUARIOS = 100000
+TAMANHO_LOTE = 10000
+
+NOMES = ['Ana', 'Bruno', 'Carla', 'Davi', 'Élida', 'Fábio', 'Gustavo', 'Helena', 'Íris', 'João',
+         'Júlia', 'Lucas', 'Márcia', 'Natália', 'Otávio', 'Paula', 'Rafael', 'Sônia', 'Tiago', 'Vitória']
+SOBRENOMES = ['Silva', 'Souza', 'Oliveira', 'Santos', 'Pereira', 'Lima', 'Gonçalves', 'Araújo',
+              'Ribeiro', 'Conceição', 'Carvalho', 'Almeida', 'Costa', 'Rocha', 'Martins']
+PALAVRAS = ['Introdução', 'Fundamentos', 'Cálculo', 'Álgebra', 'Linear', 'Física', 'Química',
+            'Programação', 'Python', 'Banco', 'Dados', 'Redes', 'Sistemas', 'Operacionais',
+            'História', 'Brasil', 'Literatura', 'Economia', 'Estatística', 'Biologia', 'Engenharia',
+            'Software', 'Algoritmos', 'Estruturas', 'Compiladores', 'Direito', 'Filosofia', 'Arte']
+TIPOS = (('ALUNO', 0.85), ('PROFESSOR', 0.10), ('FUNCIONARIO', 0.05))
+
+
+def _sorteio_enviesado(rnd, n, expoente):
+    """ID entre 1 e n com poucos IDs baixos concentrando os sorteios"""
+    return 1 + int(n * rnd.random() ** expoente)
+
+
+def _peso_dia(dia, indice, total_dias, crescimento):
+    peso = 1 + crescimento * indice / max(1, total_dias - 1)
+    if dia.weekday() >= 5:
+        peso *= 0.3
+    if dia.month in (1, 7):
+        peso *= 0.4
+    return peso
+
+
+def emprestimos_por_dia(total, inicio, dias, crescimento):
+    """Distribui `total` empréstimos pelos dias do período segundo os pesos"""
+    pesos = [_peso_dia(inicio + timedelta(days=i), i, dias, crescimento) for i in range(dias)]
+    soma = sum(pesos)
+    quantidades = [int(total * p / soma) for p in pesos]
+    for i in range(total - sum(quantidades)):
+        quantidades[-1 - i % dias] += 1
+    return quantidades
+
+
+def gerar_usuarios(rnd, n):
+    for i in range(1, n + 1):
+        nome = f'{rnd.choice(NOMES)} {rnd.choice(SOBRENOMES)} {rnd.choice(SOBRENOMES)}'
+        tipo = rnd.choices([t for t, _ in TIPOS], [p for _, p in TIPOS])[0]
+        email = f'usuario{i}@exemplo.com' if rnd.random() < 0.7 else None
+        status = 'ATIVO' if rnd.random() < 0.97 else 'INATIVO'
+        yield nome, f'{i - 1:05d}', tipo, email, status
+
+
+def gerar_livros(rnd, n):
+    for i in range(1, n + 1):
+        titulo = ' '.join(rnd.sample(PALAVRAS, rnd.randint(2, 5)))
+        autores = f'{rnd.choice(NOMES)} {rnd.choice(SOBRENOMES)}'
+        isbn = f'978{i:010d}' if rnd.random() < 0.8 else None
+        copias = rnd.choice((1, 1, 2, 2, 3, 5))
+        yield titulo, autores, isbn, None, rnd.randint(1950, 2024), copias, copias, 'DISPONIVEL'
+
+
+def gerar_emprestimos(rnd, quantidades, inicio, hoje, tipos, copias):
+    """Gera os empréstimos em ordem de data. Um empréstimo só fica em aberto
+    se ainda houver cópia do livro, para respeitar copiasDisponiveis."""
+    abertos = [0] * (len(copias) + 1)
+    for indice, quantidade in enumerate(quantidades):
+        dia = inicio + timedelta(days=indice)
+        segundos = sorted(rnd.randint(8 * 3600, 21 * 3600) for _ in range(quantidade))
+        for segundo in segundos:
+            userId = _sorteio_enviesado(rnd, len(tipos), 1.5)
+            bookId = _sorteio_enviesado(rnd, len(copias), 2.5)
+            loanDate = datetime.combine(dia, datetime.min.time()) + timedelta(seconds=segundo)
+            dueDate = dia + timedelta(days=prazo_dias(tipos[userId - 1]))
+
+            sorteio = rnd.random()
+            if sorteio < 0.005:
+                yield userId, bookId, loanDate, dueDate, None, 'CANCEL', 0.0
+                continue
+            if sorteio < 0.85:
+                devolucao = dia + timedelta(days=rnd.randint(0, (dueDate - dia).days))
+            elif sorteio < 0.97:
+                devolucao = dueDate + timedelta(days=rnd.randint(1, 30))
+            else:
+                devolucao = None
+
+            if (devolucao is not None and devolucao <= hoje) or abertos[bookId] >= copias[bookId - 1]:
+                devolucao = min(devolucao or hoje, hoje)
+                multa = max(0, (devolucao - dueDate).days) * MULTA_DIARIA
+                yield userId, bookId, loanDate, dueDate, devolucao, 'RETURNED', multa
+            else:
+                abertos[bookId] += 1
+                if dueDate >= hoje:
+                    yield userId, bookId, loanDate, dueDate, None, 'ACTIVE', 0.0
+                else:
+                    yield userId, bookId, loanDate, dueDate, None, 'OVERDUE', (hoje - dueDate).days * MULTA_DIARIA
+
+
+def _inserir(conn, comando, linhas):
+    lote = []
+    for linha in linhas:
+        lote.append(linha)
+        if len(lote) >= TAMANHO_LOTE:
+            conn.executemany(comando, lote)
+            conn.commit()
+            lote = []
+    if lote:
+        conn.executemany(comando, lote)
+        conn.commit()
+
+
+def gerar(path, usuarios, livros, emprestimos, dias=730, crescimento=1.0, semente=42, hoje=None):
+    """Cria e preenche o banco em `path`. Retorna os volumes e a duração."""
+    if usuarios > MAX_USUARIOS:
+        raise ValueError(f"no máximo {MAX_USUARIOS} usuários (matrícula de 5 dígitos)")
+    rnd = random.Random(semente)
+    hoje = hoje or date.today()
+    inicio = hoje - timedelta(days=dias - 1)
+    comeco = time.perf_counter()
+
+    database.init_db(path)
+    conn = database.conectar(path)
+    tipos = []
+    copias = []
+
+    def usuarios_gerados():
+        for u in gerar_usuarios(rnd, usuarios):
+            tipos.append(u[2])
+            yield u
+
+    def livros_gerados():
+        for l in gerar_livros(rnd, livros):
+            copias.append(l[5])
+            yield l
+
+    _inserir(conn, '''
+        INSERT INTO usuario (nome, matricula, tipo, email, status) VALUES (?, ?, ?, ?, ?)
+    ''', usuarios_gerados())
+    _inserir(conn, '''
+        INSERT INTO livro (titulo, autores, ISBN, edicao, ano, copiasTotal, copiasDisponiveis, status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', livros_gerados())
+
+    quantidades = emprestimos_por_dia(emprestimos, inicio, dias, crescimento)
+    _inserir(conn, '''
+        INSERT INTO emprestimo (userId, bookId, loanDate, dueDate, returnDate, status, fine)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        (u, b, l.strftime('%Y-%m-%d %H:%M:%S'), d.isoformat(),
+         r.strftime('%Y-%m-%d 18:00:00') if r else None, s, f)
+        for u, b, l, d, r, s, f in gerar_emprestimos(rnd, quantidades, inicio, hoje, tipos, copias)
+    ))
+
+    # Baixa de estoque dos empréstimos em aberto, num único UPDATE agrupado
+    conn.execute('''
+        UPDATE livro SET copiasDisponiveis = copiasTotal - a.n
+        FROM (
+            SELECT bookId, COUNT(*) AS n FROM emprestimo
+            WHERE status IN ('ACTIVE', 'OVERDUE')
+            GROUP BY bookId
+        ) AS a
+        WHERE livro.bookId = a.bookId
+    ''')
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+    return {
+        "usuarios": usuarios,
+        "livros": livros,
+        "emprestimos": emprestimos,
+        "duracao_s": round(time.perf_counter() - comeco, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('banco')
+    parser.add_argument('--usuarios', type=int, default=20000)
+    parser.add_argument('--livros', type=int, default=50000)
+    parser.add_argument('--emprestimos', type=int, default=200000)
+    parser.add_argument('--dias', type=int, default=730)
+    parser.add_argument('--crescimento', type=float, default=1.0,
+                        help="quanto o movimento diário cresce do início ao fim do período (1.0 = dobra)")
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--hoje', type=date.fromisoformat, default=None)
+    args = parser.parse_args()
+
+    if os.path.exists(args.banco):
+        parser.error(f"{args.banco} já existe")
+    print(gerar(args.banco, args.usuarios, args.livros, args.emprestimos,
+                args.dias, args.crescimento, args.semente, args.hoje))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+from collections import OrderedDict
+import threading
+
+
+class CacheLRU:
+    """Cache em memória com tamanho limitado e descarte do menos usado.
+
+    Cada entrada guarda a versão dos dados com que foi calculada; na leitura
+    a entrada só vale se a versão atual for a mesma, então nunca se devolve
+    um resultado anterior à última gravação.
+    """
+
+    def __init__(self, capacidade=256):
+        self.capacidade = capacidade
+        self._dados = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def obter(self, chave, versao):
+        with self._lock:
+            entrada = self._dados.get(chave)
+            if entrada is None or entrada[0] != versao:
+                self.misses += 1
+                return None
+            self._dados.move_to_end(chave)
+            self.hits += 1
+            return entrada[1]
+
+    def guardar(self, chave, versao, valor):
+        with self._lock:
+            self._dados[chave] = (versao, valor)
+            self._dados.move_to_end(chave)
+            while len(self._dados) > self.capacidade:
+                self._dados.popitem(last=False)
+                self.evictions += 1
+
+    def limpar(self):
+        with self._lock:
+            self._dados.clear()
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                "entradas": len(self._dados),
+                "capacidade": self.capacidade,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
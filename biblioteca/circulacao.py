@@ -0,0 +1,160 @@
+from datetime import datetime, timedelta
+
+
+# Multa por dia de atraso, em reais
+MULTA_DIARIA = 1.0
+
+# Máximo de IDs por comando, abaixo do limite de parâmetros do SQLite
+TAMANHO_BLOCO = 500
+
+
+class ErroCirculacao(Exception):
+    """Operação de empréstimo/devolução recusada por regra de negócio"""
+
+
+def prazo_dias(tipo):
+    """Prazo do empréstimo: 14 dias para alunos, 30 para os demais"""
+    return 14 if tipo == 'ALUNO' else 30
+
+
+def emprestar(conn, userId, bookId, tipo, agora=None):
+    """Registra um empréstimo e retorna o loanId.
+
+    A transação pega o lock de escrita logo no início (BEGIN IMMEDIATE) e a
+    baixa de estoque é um único UPDATE condicional: se nenhuma linha for
+    afetada não havia cópia disponível. Assim não existe leitura seguida de
+    escrita que permita emprestar a mesma cópia duas vezes.
+    """
+    # Usar data/hora local
+    agora = agora or datetime.now()
+    dueDate = (agora + timedelta(days=prazo_dias(tipo))).strftime('%Y-%m-%d')
+    loanDate = agora.strftime('%Y-%m-%d %H:%M:%S')
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        c = conn.execute('''
+            UPDATE livro SET copiasDisponiveis = copiasDisponiveis - 1
+            WHERE bookId = ? AND copiasDisponiveis > 0
+        ''', (bookId,))
+        if c.rowcount == 0:
+            raise ErroCirculacao("Livro indisponível")
+
+        c = conn.execute('''
+            INSERT INTO emprestimo (userId, bookId, loanDate, dueDate)
+            VALUES (?, ?, ?, ?)
+        ''', (userId, bookId, loanDate, dueDate))
+        conn.commit()
+        return c.lastrowid
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def emprestar_varios(conn, userId, bookIds, tipo, parcial=False, agora=None):
+    """Empresta vários livros ao mesmo usuário numa única transação.
+
+    A disponibilidade de todos os livros é lida numa só consulta, já com o
+    lock de escrita. Sem `parcial`, qualquer livro indisponível cancela o
+    lote inteiro; com `parcial`, os disponíveis são emprestados e os demais
+    voltam em `recusados`. Retorna {"emprestados": [...], "recusados": [...]}.
+    """
+    if not bookIds:
+        raise ErroCirculacao("Nenhum livro informado")
+    agora = agora or datetime.now()
+    dueDate = (agora + timedelta(days=prazo_dias(tipo))).strftime('%Y-%m-%d')
+    loanDate = agora.strftime('%Y-%m-%d %H:%M:%S')
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        distintos = list(dict.fromkeys(bookIds))
+        c = conn.execute(f'''
+            SELECT bookId, copiasDisponiveis FROM livro
+            WHERE bookId IN ({','.join('?' * len(distintos))})
+        ''', distintos)
+        restantes = dict(c.fetchall())
+
+        aceitos = []
+        recusados = []
+        for bookId in bookIds:
+            if bookId not in restantes:
+                recusados.append({"bookId": bookId, "erro": "Livro não encontrado"})
+            elif restantes[bookId] <= 0:
+                recusados.append({"bookId": bookId, "erro": "Livro indisponível"})
+            else:
+                restantes[bookId] -= 1
+                aceitos.append(bookId)
+
+        if not aceitos or (recusados and not parcial):
+            conn.rollback()
+            return {"emprestados": [], "recusados": recusados}
+
+        baixas = {}
+        for bookId in aceitos:
+            baixas[bookId] = baixas.get(bookId, 0) + 1
+        conn.executemany('''
+            UPDATE livro SET copiasDisponiveis = copiasDisponiveis - ?
+            WHERE bookId = ?
+        ''', [(n, bookId) for bookId, n in baixas.items()])
+
+        emprestados = []
+        for bookId in aceitos:
+            c = conn.execute('''
+                INSERT INTO emprestimo (userId, bookId, loanDate, dueDate)
+                VALUES (?, ?, ?, ?)
+            ''', (userId, bookId, loanDate, dueDate))
+            emprestados.append({"bookId": bookId, "loanId": c.lastrowid})
+        conn.commit()
+        return {"emprestados": emprestados, "recusados": recusados}
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def devolver(conn, loanIds, agora=None):
+    """Registra a devolução de um ou vários empréstimos numa transação.
+
+    Para cada bloco de IDs, um único UPDATE agrupado por livro devolve as
+    cópias ao estoque e outro UPDATE marca os empréstimos como RETURNED,
+    calculando a multa a partir do dueDate. IDs inexistentes ou já
+    devolvidos são ignorados e informados em `ignorados`.
+    """
+    agora = agora or datetime.now()
+    returnDate = agora.strftime('%Y-%m-%d %H:%M:%S')
+    distintos = list(dict.fromkeys(loanIds))
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        devolvidos = []
+        for i in range(0, len(distintos), TAMANHO_BLOCO):
+            bloco = distintos[i:i + TAMANHO_BLOCO]
+            marcas = ','.join('?' * len(bloco))
+            conn.execute(f'''
+                UPDATE livro
+                SET copiasDisponiveis = MIN(copiasTotal, copiasDisponiveis + d.n)
+                FROM (
+                    SELECT bookId, COUNT(*) AS n FROM emprestimo
+                    WHERE loanId IN ({marcas}) AND status IN ('ACTIVE', 'OVERDUE')
+                    GROUP BY bookId
+                ) AS d
+                WHERE livro.bookId = d.bookId
+            ''', bloco)
+            c = conn.execute(f'''
+                UPDATE emprestimo
+                SET returnDate = ?,
+                    status = 'RETURNED',
+                    fine = MAX(0, CAST(julianday(date(?)) - julianday(date(dueDate)) AS INTEGER)) * ?
+                WHERE loanId IN ({marcas}) AND status IN ('ACTIVE', 'OVERDUE')
+                RETURNING loanId, fine
+            ''', [returnDate, returnDate, MULTA_DIARIA] + bloco)
+            devolvidos.extend({"loanId": loanId, "fine": fine} for loanId, fine in c.fetchall())
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    encontrados = {d["loanId"] for d in devolvidos}
+    return {
+        "devolvidos": devolvidos,
+        "ignorados": [loanId for loanId in distintos if loanId not in encontrados],
+        "multa_total": sum(d["fine"] for d in devolvidos),
+    }
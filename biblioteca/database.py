@@ -1,10 +1,646 @@
+import argparse
 from datetime import datetime
+import queue
 import sqlite3
+import threading
+from urllib.parse import quote
 
-def init_db():
-    conn = sqlite3.connect('biblioteca.db')
-    # ATIVAR FOREIGN KEYS - CRÍTICO!
-    conn.execute("PRAGMA foreign_keys = ON")
+DB_PATH = 'biblioteca.db'
+# Conexões ociosas guardadas em cada fila do pool
+TAMANHO_POOL = 8
+
+# Pragmas aplicados uma única vez, quando a conexão é aberta
+PRAGMAS = (
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+    "PRAGMA busy_timeout = 5000",
+)
+
+
+# Caminhos cujo schema já foi conferido neste processo
+_schemas_verificados = set()
+_lock_schema = threading.Lock()
+
+
+def conectar(path=DB_PATH):
+    """Abre uma conexão nova já configurada com os pragmas. Na primeira
+    conexão do processo a um banco, aplica as migrações pendentes."""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    if path not in _schemas_verificados:
+        with _lock_schema:
+            if path not in _schemas_verificados:
+                migrar(conn)
+                _schemas_verificados.add(path)
+    return conn
+
+
+# Conexões de leitura não podem trocar o journal_mode nem gravar; o modo
+# WAL fica registrado no arquivo pela primeira conexão de escrita
+PRAGMAS_LEITURA = (
+    "PRAGMA query_only = ON",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+    "PRAGMA busy_timeout = 5000",
+)
+
+
+def conectar_leitura(path=DB_PATH):
+    """Abre uma conexão somente leitura (URI file:...?mode=ro). Em WAL ela
+    nunca bloqueia nem é bloqueada pelas gravações."""
+    if path not in _schemas_verificados:
+        # O schema só pode ser criado ou migrado por uma conexão de escrita
+        conectar(path).close()
+    conn = sqlite3.connect(f'file:{quote(path)}?mode=ro', uri=True, check_same_thread=False)
+    for pragma in PRAGMAS_LEITURA:
+        conn.execute(pragma)
+    return conn
+
+
+class PoolConexoes:
+    """Conexões compartilhadas entre as threads: uma fila de conexões de
+    escrita e outra de somente leitura, cada uma guardando no máximo
+    `tamanho` conexões ociosas. Sob carga maior abrem-se conexões extras,
+    fechadas quando devolvidas com a fila cheia."""
+
+    def __init__(self, path=DB_PATH, tamanho=TAMANHO_POOL):
+        self.path = path
+        self.tamanho = tamanho
+        self._escrita = queue.Queue(tamanho)
+        self._leitura = queue.Queue(tamanho)
+        self._lock = threading.Lock()
+        self.abertas = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _obter(self, fila, abrir):
+        try:
+            conn = fila.get_nowait()
+        except queue.Empty:
+            conn = None
+        with self._lock:
+            if conn is not None:
+                self.hits += 1
+                return conn
+            self.misses += 1
+        conn = abrir(self.path)
+        with self._lock:
+            self.abertas += 1
+        return conn
+
+    def obter(self):
+        return self._obter(self._escrita, conectar)
+
+    def obter_leitura(self):
+        return self._obter(self._leitura, conectar_leitura)
+
+    def _fechar(self, conn):
+        conn.close()
+        with self._lock:
+            self.abertas -= 1
+
+    def liberar(self, conn, leitura=False):
+        """Devolve a conexão ao pool descartando transações pendentes. Se a
+        fila já estiver cheia, a conexão é fechada."""
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            (self._leitura if leitura else self._escrita).put_nowait(conn)
+        except queue.Full:
+            self._fechar(conn)
+
+    def fechar_todas(self):
+        """Fecha as conexões ociosas (ex.: antes de apagar o arquivo do banco)"""
+        for fila in (self._escrita, self._leitura):
+            while True:
+                try:
+                    conn = fila.get_nowait()
+                except queue.Empty:
+                    break
+                self._fechar(conn)
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                "conexoes": self.abertas,
+                "ociosas": self._escrita.qsize() + self._leitura.qsize(),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def _triggers_versao(tabela):
+    """Triggers que incrementam a versão de `tabela` em tabela_versao a cada
+    INSERT, UPDATE ou DELETE, para validar caches sem consultar a tabela"""
+    return tuple(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{tabela}_versao_{operacao.lower()} AFTER {operacao} ON {tabela}
+        BEGIN
+            UPDATE tabela_versao SET versao = versao + 1, alterado_em = datetime('now')
+            WHERE tabela = '{tabela}';
+        END
+    ''' for operacao in ('INSERT', 'UPDATE', 'DELETE'))
+
+
+# Índices secundários versionados. Cada versão é aplicada uma única vez,
+# em ordem, e registrada em PRAGMA user_version. Um passo é um comando SQL
+# ou uma função que recebe a conexão.
+def _atrasado(linha):
+    """Expressão que vale 1 quando o empréstimo está atrasado ou foi
+    devolvido depois do prazo"""
+    return (f"({linha}.status = 'OVERDUE' OR ({linha}.status = 'RETURNED' "
+            f"AND IFNULL(date({linha}.returnDate) > {linha}.dueDate, 0)))")
+
+
+def _somar_diario(linha, sinal):
+    """Comando de trigger que soma (+) ou subtrai (-) o empréstimo `linha`
+    (NEW ou OLD) em emprestimo_diario"""
+    return f'''
+            INSERT INTO emprestimo_diario (dia, status, tipo, total, atrasados)
+            VALUES (substr({linha}.loanDate, 1, 10), {linha}.status,
+                    (SELECT tipo FROM usuario WHERE id = {linha}.userId),
+                    {sinal}1, {sinal}{_atrasado(linha)})
+            ON CONFLICT (dia, status, tipo) DO UPDATE
+            SET total = total + excluded.total, atrasados = atrasados + excluded.atrasados;'''
+
+
+def _mover_tipo(linha, sinal):
+    """Comando de trigger de usuario que soma (+) ou subtrai (-) todos os
+    empréstimos do usuário, ativos e arquivados, nos baldes de `linha`.tipo"""
+    return f'''
+            INSERT INTO emprestimo_diario (dia, status, tipo, total, atrasados)
+            SELECT substr(e.loanDate, 1, 10), e.status, {linha}.tipo,
+                   {sinal}COUNT(*), {sinal}SUM({_atrasado('e')})
+            FROM (
+                SELECT loanDate, dueDate, returnDate, status FROM emprestimo WHERE userId = NEW.id
+                UNION ALL
+                SELECT loanDate, dueDate, returnDate, status FROM emprestimo_historico WHERE userId = NEW.id
+            ) AS e
+            WHERE 1
+            GROUP BY 1, 2
+            ON CONFLICT (dia, status, tipo) DO UPDATE
+            SET total = total + excluded.total, atrasados = atrasados + excluded.atrasados;'''
+
+
+# Colunas de emprestimo que não existiam nos bancos criados antes de
+# devoluções e multas (ex.: o biblioteca.db distribuído com o projeto)
+COLUNAS_EMPRESTIMO = (
+    ('copyId', 'INTEGER'),
+    ('returnDate', 'TEXT'),
+    ('fine', 'REAL DEFAULT 0.0'),
+)
+
+
+def _completar_emprestimo(conn):
+    """Passo de migração: acrescenta a emprestimo as colunas de
+    COLUNAS_EMPRESTIMO que faltarem"""
+    existentes = {r[1] for r in conn.execute("PRAGMA table_info(emprestimo)")}
+    for coluna, tipo in COLUNAS_EMPRESTIMO:
+        if coluna not in existentes:
+            conn.execute(f"ALTER TABLE emprestimo ADD COLUMN {coluna} {tipo}")
+
+
+def _fora_do_historico(linha):
+    """Condição de trigger que vale 1 quando a exclusão de `linha` não é um
+    arquivamento (o empréstimo não foi copiado para emprestimo_historico)"""
+    return f"NOT EXISTS (SELECT 1 FROM emprestimo_historico WHERE loanId = {linha}.loanId)"
+
+
+MIGRACOES = (
+    (1, (
+        "CREATE INDEX IF NOT EXISTS idx_emprestimo_loanDate ON emprestimo (loanDate)",
+        "CREATE INDEX IF NOT EXISTS idx_emprestimo_userId ON emprestimo (userId)",
+        "CREATE INDEX IF NOT EXISTS idx_emprestimo_bookId ON emprestimo (bookId)",
+        "CREATE INDEX IF NOT EXISTS idx_emprestimo_status ON emprestimo (status, dueDate)",
+    )),
+    # Contadores mantidos por triggers: total geral em `contador` e totais
+    # por dia (substr(loanDate, 1, 10)) e status em `emprestimo_resumo_diario`
+    (2, (
+        '''
+        CREATE TABLE IF NOT EXISTS contador (
+            nome TEXT PRIMARY KEY,
+            valor INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS emprestimo_resumo_diario (
+            dia TEXT NOT NULL,
+            status TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, status)
+        ) WITHOUT ROWID
+        ''',
+        "INSERT OR REPLACE INTO contador (nome, valor) VALUES ('emprestimos', (SELECT COUNT(*) FROM emprestimo))",
+        "DELETE FROM emprestimo_resumo_diario",
+        '''
+        INSERT INTO emprestimo_resumo_diario (dia, status, total)
+        SELECT substr(loanDate, 1, 10), status, COUNT(*) FROM emprestimo GROUP BY 1, 2
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_emprestimo_contador_insert AFTER INSERT ON emprestimo
+        BEGIN
+            UPDATE contador SET valor = valor + 1 WHERE nome = 'emprestimos';
+            INSERT INTO emprestimo_resumo_diario (dia, status, total)
+            VALUES (substr(NEW.loanDate, 1, 10), NEW.status, 1)
+            ON CONFLICT (dia, status) DO UPDATE SET total = total + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_emprestimo_contador_delete AFTER DELETE ON emprestimo
+        BEGIN
+            UPDATE contador SET valor = valor - 1 WHERE nome = 'emprestimos';
+            UPDATE emprestimo_resumo_diario SET total = total - 1
+            WHERE dia = substr(OLD.loanDate, 1, 10) AND status = OLD.status;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_emprestimo_contador_update AFTER UPDATE OF loanDate, status ON emprestimo
+        WHEN substr(OLD.loanDate, 1, 10) IS NOT substr(NEW.loanDate, 1, 10) OR OLD.status IS NOT NEW.status
+        BEGIN
+            UPDATE emprestimo_resumo_diario SET total = total - 1
+            WHERE dia = substr(OLD.loanDate, 1, 10) AND status = OLD.status;
+            INSERT INTO emprestimo_resumo_diario (dia, status, total)
+            VALUES (substr(NEW.loanDate, 1, 10), NEW.status, 1)
+            ON CONFLICT (dia, status) DO UPDATE SET total = total + 1;
+        END
+        ''',
+    )),
+    # Varredura de atrasos: índice parcial só com empréstimos em aberto e
+    # histórico de execução das tarefas agendadas
+    (3, (
+        '''
+        CREATE INDEX IF NOT EXISTS idx_emprestimo_abertos ON emprestimo (dueDate)
+        WHERE status IN ('ACTIVE', 'OVERDUE')
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS tarefa_execucao (
+            id INTEGER PRIMARY KEY,
+            tarefa TEXT NOT NULL,
+            inicio TEXT NOT NULL,
+            duracao_ms REAL NOT NULL,
+            linhas INTEGER NOT NULL
+        )
+        ''',
+    )),
+    # Busca textual no catálogo: índice FTS5 externo sobre livro, mantido
+    # por triggers, e índice para busca exata por ISBN
+    (4, (
+        "CREATE INDEX IF NOT EXISTS idx_livro_isbn ON livro (ISBN)",
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS livro_fts USING fts5(
+            titulo, autores,
+            content='livro', content_rowid='bookId',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+        ''',
+        "INSERT INTO livro_fts (livro_fts) VALUES ('rebuild')",
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_livro_fts_insert AFTER INSERT ON livro
+        BEGIN
+            INSERT INTO livro_fts (rowid, titulo, autores) VALUES (NEW.bookId, NEW.titulo, NEW.autores);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_livro_fts_delete AFTER DELETE ON livro
+        BEGIN
+            INSERT INTO livro_fts (livro_fts, rowid, titulo, autores)
+            VALUES ('delete', OLD.bookId, OLD.titulo, OLD.autores);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_livro_fts_update AFTER UPDATE OF titulo, autores ON livro
+        BEGIN
+            INSERT INTO livro_fts (livro_fts, rowid, titulo, autores)
+            VALUES ('delete', OLD.bookId, OLD.titulo, OLD.autores);
+            INSERT INTO livro_fts (rowid, titulo, autores) VALUES (NEW.bookId, NEW.titulo, NEW.autores);
+        END
+        ''',
+    )),
+    # Busca de usuários: índice FTS5 sobre nome (sem acentos, por prefixo)
+    # e contador de versão da tabela, incrementado a cada gravação
+    (5, (
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS usuario_fts USING fts5(
+            nome,
+            content='usuario', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+        ''',
+        "INSERT INTO usuario_fts (usuario_fts) VALUES ('rebuild')",
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_usuario_fts_insert AFTER INSERT ON usuario
+        BEGIN
+            INSERT INTO usuario_fts (rowid, nome) VALUES (NEW.id, NEW.nome);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_usuario_fts_delete AFTER DELETE ON usuario
+        BEGIN
+            INSERT INTO usuario_fts (usuario_fts, rowid, nome) VALUES ('delete', OLD.id, OLD.nome);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_usuario_fts_update AFTER UPDATE OF nome ON usuario
+        BEGIN
+            INSERT INTO usuario_fts (usuario_fts, rowid, nome) VALUES ('delete', OLD.id, OLD.nome);
+            INSERT INTO usuario_fts (rowid, nome) VALUES (NEW.id, NEW.nome);
+        END
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS tabela_versao (
+            tabela TEXT PRIMARY KEY,
+            versao INTEGER NOT NULL DEFAULT 0,
+            alterado_em TEXT NOT NULL DEFAULT (datetime('now'))
+        ) WITHOUT ROWID
+        ''',
+        "INSERT OR IGNORE INTO tabela_versao (tabela) VALUES ('usuario')",
+        *_triggers_versao('usuario'),
+    )),
+    # Versões de livro e emprestimo, usadas junto com a de usuario para
+    # invalidar o cache do relatório
+    (6, (
+        "INSERT OR IGNORE INTO tabela_versao (tabela) VALUES ('livro'), ('emprestimo')",
+        *_triggers_versao('livro'),
+        *_triggers_versao('emprestimo'),
+    )),
+    # Agregados diários para as análises: por status e tipo de usuário (com
+    # quantos atrasaram) e por livro. O tipo é o do usuário no momento em
+    # que o empréstimo é gravado. Antes, bancos antigos recebem as colunas
+    # de emprestimo lidas daqui em diante (returnDate, fine, copyId).
+    (7, (
+        _completar_emprestimo,
+        '''
+        CREATE TABLE IF NOT EXISTS emprestimo_diario (
+            dia TEXT NOT NULL,
+            status TEXT NOT NULL,
+            tipo TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            atrasados INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, status, tipo)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS emprestimo_diario_livro (
+            dia TEXT NOT NULL,
+            bookId INTEGER NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, bookId)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_emprestimo_diario_livro_bookId ON emprestimo_diario_livro (bookId, dia)",
+        "DELETE FROM emprestimo_diario",
+        f'''
+        INSERT INTO emprestimo_diario (dia, status, tipo, total, atrasados)
+        SELECT substr(e.loanDate, 1, 10), e.status, u.tipo, COUNT(*), SUM({_atrasado('e')})
+        FROM emprestimo e JOIN usuario u ON u.id = e.userId
+        GROUP BY 1, 2, 3
+        ''',
+        "DELETE FROM emprestimo_diario_livro",
+        '''
+        INSERT INTO emprestimo_diario_livro (dia, bookId, total)
+        SELECT substr(loanDate, 1, 10), bookId, COUNT(*) FROM emprestimo GROUP BY 1, 2
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_emprestimo_diario_insert AFTER INSERT ON emprestimo
+        BEGIN
+            {_somar_diario('NEW', '+')}
+            INSERT INTO emprestimo_diario_livro (dia, bookId, total)
+            VALUES (substr(NEW.loanDate, 1, 10), NEW.bookId, 1)
+            ON CONFLICT (dia, bookId) DO UPDATE SET total = total + 1;
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_emprestimo_diario_delete AFTER DELETE ON emprestimo
+        BEGIN
+            {_somar_diario('OLD', '-')}
+            UPDATE emprestimo_diario_livro SET total = total - 1
+            WHERE dia = substr(OLD.loanDate, 1, 10) AND bookId = OLD.bookId;
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_emprestimo_diario_update
+        AFTER UPDATE OF loanDate, status, returnDate, dueDate, userId ON emprestimo
+        WHEN substr(OLD.loanDate, 1, 10) IS NOT substr(NEW.loanDate, 1, 10) OR OLD.status IS NOT NEW.status
+          OR OLD.userId IS NOT NEW.userId OR {_atrasado('OLD')} IS NOT {_atrasado('NEW')}
+        BEGIN
+            {_somar_diario('OLD', '-')}
+            {_somar_diario('NEW', '+')}
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_emprestimo_diario_livro_update
+        AFTER UPDATE OF loanDate, bookId ON emprestimo
+        WHEN substr(OLD.loanDate, 1, 10) IS NOT substr(NEW.loanDate, 1, 10) OR OLD.bookId IS NOT NEW.bookId
+        BEGIN
+            UPDATE emprestimo_diario_livro SET total = total - 1
+            WHERE dia = substr(OLD.loanDate, 1, 10) AND bookId = OLD.bookId;
+            INSERT INTO emprestimo_diario_livro (dia, bookId, total)
+            VALUES (substr(NEW.loanDate, 1, 10), NEW.bookId, 1)
+            ON CONFLICT (dia, bookId) DO UPDATE SET total = total + 1;
+        END
+        ''',
+    )),
+    # Rankings: empréstimos por usuário e dia (o equivalente por livro já
+    # existe) e um contador de alterações que invalidam as contagens em
+    # memória, que de resto só crescem com novos empréstimos
+    (8, (
+        '''
+        CREATE TABLE IF NOT EXISTS emprestimo_diario_usuario (
+            dia TEXT NOT NULL,
+            userId INTEGER NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, userId)
+        ) WITHOUT ROWID
+        ''',
+        "DELETE FROM emprestimo_diario_usuario",
+        '''
+        INSERT INTO emprestimo_diario_usuario (dia, userId, total)
+        SELECT substr(loanDate, 1, 10), userId, COUNT(*) FROM emprestimo GROUP BY 1, 2
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_emprestimo_diario_usuario_insert AFTER INSERT ON emprestimo
+        BEGIN
+            INSERT INTO emprestimo_diario_usuario (dia, userId, total)
+            VALUES (substr(NEW.loanDate, 1, 10), NEW.userId, 1)
+            ON CONFLICT (dia, userId) DO UPDATE SET total = total + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_emprestimo_diario_usuario_delete AFTER DELETE ON emprestimo
+        BEGIN
+            UPDATE emprestimo_diario_usuario SET total = total - 1
+            WHERE dia = substr(OLD.loanDate, 1, 10) AND userId = OLD.userId;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_emprestimo_diario_usuario_update
+        AFTER UPDATE OF loanDate, userId ON emprestimo
+        WHEN substr(OLD.loanDate, 1, 10) IS NOT substr(NEW.loanDate, 1, 10) OR OLD.userId IS NOT NEW.userId
+        BEGIN
+            UPDATE emprestimo_diario_usuario SET total = total - 1
+            WHERE dia = substr(OLD.loanDate, 1, 10) AND userId = OLD.userId;
+            INSERT INTO emprestimo_diario_usuario (dia, userId, total)
+            VALUES (substr(NEW.loanDate, 1, 10), NEW.userId, 1)
+            ON CONFLICT (dia, userId) DO UPDATE SET total = total + 1;
+        END
+        ''',
+        "INSERT OR IGNORE INTO contador (nome, valor) VALUES ('ranking_invalidacoes', 0)",
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_emprestimo_ranking_delete AFTER DELETE ON emprestimo
+        BEGIN
+            UPDATE contador SET valor = valor + 1 WHERE nome = 'ranking_invalidacoes';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_emprestimo_ranking_update
+        AFTER UPDATE OF loanDate, bookId, userId ON emprestimo
+        WHEN substr(OLD.loanDate, 1, 10) IS NOT substr(NEW.loanDate, 1, 10)
+          OR OLD.bookId IS NOT NEW.bookId OR OLD.userId IS NOT NEW.userId
+        BEGIN
+            UPDATE contador SET valor = valor + 1 WHERE nome = 'ranking_invalidacoes';
+        END
+        ''',
+    )),
+    # Arquivo de empréstimos encerrados. O arquivamento copia a linha para
+    # emprestimo_historico antes de apagá-la de emprestimo; os triggers de
+    # exclusão ignoram essas linhas, então contadores, agregados e rankings
+    # continuam contando os empréstimos arquivados.
+    (9, (
+        '''
+        CREATE TABLE IF NOT EXISTS emprestimo_historico (
+            loanId INTEGER PRIMARY KEY,
+            userId INTEGER NOT NULL,
+            bookId INTEGER NOT NULL,
+            copyId INTEGER,
+            loanDate TEXT NOT NULL,
+            dueDate TEXT NOT NULL,
+            returnDate TEXT,
+            status TEXT NOT NULL CHECK(status IN ('RETURNED', 'CANCEL')),
+            fine REAL DEFAULT 0.0,
+            FOREIGN KEY (userId) REFERENCES usuario (id) ON DELETE RESTRICT,
+            FOREIGN KEY (bookId) REFERENCES livro (bookId) ON DELETE RESTRICT
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_emprestimo_historico_loanDate ON emprestimo_historico (loanDate)",
+        "CREATE INDEX IF NOT EXISTS idx_emprestimo_historico_userId ON emprestimo_historico (userId)",
+        "CREATE INDEX IF NOT EXISTS idx_emprestimo_historico_bookId ON emprestimo_historico (bookId)",
+        "DROP TRIGGER IF EXISTS trg_emprestimo_contador_delete",
+        f'''
+        CREATE TRIGGER trg_emprestimo_contador_delete AFTER DELETE ON emprestimo
+        WHEN {_fora_do_historico('OLD')}
+        BEGIN
+            UPDATE contador SET valor = valor - 1 WHERE nome = 'emprestimos';
+            UPDATE emprestimo_resumo_diario SET total = total - 1
+            WHERE dia = substr(OLD.loanDate, 1, 10) AND status = OLD.status;
+        END
+        ''',
+        "DROP TRIGGER IF EXISTS trg_emprestimo_diario_delete",
+        f'''
+        CREATE TRIGGER trg_emprestimo_diario_delete AFTER DELETE ON emprestimo
+        WHEN {_fora_do_historico('OLD')}
+        BEGIN
+            {_somar_diario('OLD', '-')}
+            UPDATE emprestimo_diario_livro SET total = total - 1
+            WHERE dia = substr(OLD.loanDate, 1, 10) AND bookId = OLD.bookId;
+        END
+        ''',
+        "DROP TRIGGER IF EXISTS trg_emprestimo_diario_usuario_delete",
+        f'''
+        CREATE TRIGGER trg_emprestimo_diario_usuario_delete AFTER DELETE ON emprestimo
+        WHEN {_fora_do_historico('OLD')}
+        BEGIN
+            UPDATE emprestimo_diario_usuario SET total = total - 1
+            WHERE dia = substr(OLD.loanDate, 1, 10) AND userId = OLD.userId;
+        END
+        ''',
+        "DROP TRIGGER IF EXISTS trg_emprestimo_ranking_delete",
+        f'''
+        CREATE TRIGGER trg_emprestimo_ranking_delete AFTER DELETE ON emprestimo
+        WHEN {_fora_do_historico('OLD')}
+        BEGIN
+            UPDATE contador SET valor = valor + 1 WHERE nome = 'ranking_invalidacoes';
+        END
+        ''',
+    )),
+    # O tipo em emprestimo_diario passa a ser sempre o tipo atual do usuário:
+    # mudar o tipo move os empréstimos dele, inclusive os arquivados, para os
+    # baldes do novo tipo, e a subtração feita pelos triggers de emprestimo
+    # (que leem o tipo atual) cai no mesmo balde da soma. O total por dia e
+    # status passa a vir de emprestimo_diario, e emprestimo_resumo_diario,
+    # que repetia esses totais, deixa de existir.
+    (10, (
+        "DROP TRIGGER IF EXISTS trg_emprestimo_contador_insert",
+        '''
+        CREATE TRIGGER trg_emprestimo_contador_insert AFTER INSERT ON emprestimo
+        BEGIN
+            UPDATE contador SET valor = valor + 1 WHERE nome = 'emprestimos';
+        END
+        ''',
+        "DROP TRIGGER IF EXISTS trg_emprestimo_contador_delete",
+        f'''
+        CREATE TRIGGER trg_emprestimo_contador_delete AFTER DELETE ON emprestimo
+        WHEN {_fora_do_historico('OLD')}
+        BEGIN
+            UPDATE contador SET valor = valor - 1 WHERE nome = 'emprestimos';
+        END
+        ''',
+        "DROP TRIGGER IF EXISTS trg_emprestimo_contador_update",
+        "DROP TABLE IF EXISTS emprestimo_resumo_diario",
+        "DELETE FROM emprestimo_diario",
+        f'''
+        INSERT INTO emprestimo_diario (dia, status, tipo, total, atrasados)
+        SELECT substr(e.loanDate, 1, 10), e.status, u.tipo, COUNT(*), SUM({_atrasado('e')})
+        FROM (
+            SELECT userId, loanDate, dueDate, returnDate, status FROM emprestimo
+            UNION ALL
+            SELECT userId, loanDate, dueDate, returnDate, status FROM emprestimo_historico
+        ) AS e JOIN usuario u ON u.id = e.userId
+        GROUP BY 1, 2, 3
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_usuario_tipo_diario AFTER UPDATE OF tipo ON usuario
+        WHEN OLD.tipo IS NOT NEW.tipo
+        BEGIN
+            {_mover_tipo('OLD', '-')}
+            {_mover_tipo('NEW', '+')}
+        END
+        ''',
+    )),
+)
+
+SCHEMA_VERSAO = MIGRACOES[-1][0]
+
+
+def aplicar_migracoes(conn):
+    """Aplica as migrações pendentes de acordo com PRAGMA user_version.
+    Cada versão roda numa transação própria junto com a troca de versão. A
+    versão é relida já com o lock de escrita: se outro processo aplicou o
+    passo nesse meio tempo, ele é pulado em vez de rodar de novo."""
+    for numero, comandos in MIGRACOES:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= numero:
+                conn.rollback()
+                continue
+            for comando in comandos:
+                if callable(comando):
+                    comando(conn)
+                else:
+                    conn.execute(comando)
+            conn.execute(f"PRAGMA user_version = {numero}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def _criar_tabelas(conn):
+    """Tabelas base, anteriores ao controle por user_version"""
     c = conn.cursor()
 
     c.execute('''
@@ -57,4 +693,41 @@ def init_db():
     ''')
 
     conn.commit()
-    conn.close()
\ No newline at end of file
+
+
+def migrar(conn):
+    """Leva o banco até SCHEMA_VERSAO. Quando o schema já está atualizado
+    custa só a leitura de PRAGMA user_version. Retorna a versão final."""
+    versao = conn.execute("PRAGMA user_version").fetchone()[0]
+    if versao >= SCHEMA_VERSAO:
+        return versao
+    _criar_tabelas(conn)
+    aplicar_migracoes(conn)
+    return SCHEMA_VERSAO
+
+
+def init_db(path=None):
+    """Aplica as migrações explicitamente (CLI, testes, scripts)"""
+    path = path or DB_PATH
+    conn = sqlite3.connect(path)
+    # ATIVAR FOREIGN KEYS - CRÍTICO!
+    conn.execute("PRAGMA foreign_keys = ON")
+    # O modo WAL fica gravado no arquivo; sem ele as conexões de leitura
+    # voltariam a bloquear as gravações
+    conn.execute("PRAGMA journal_mode = WAL")
+    versao = migrar(conn)
+    conn.close()
+    with _lock_schema:
+        _schemas_verificados.add(path)
+    return versao
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aplica as migrações pendentes do banco")
+    parser.add_argument('banco', nargs='?', default=DB_PATH)
+    args = parser.parse_args()
+    print(f"{args.banco}: schema na versão {init_db(args.banco)}")
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
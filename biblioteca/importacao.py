@@ -0,0 +1,258 @@
+"""Importação em lote de arquivos CSV ou JSON Lines.
+
+As linhas são validadas com as mesmas regras dos CHECKs de database.py e
+gravadas com executemany em transações de TAMANHO_LOTE linhas. Linhas
+inválidas não interrompem a carga: voltam no relatório com o motivo.
+
+    python importacao.py livros catalogo.csv
+    python importacao.py usuarios matriculas.csv
+"""
+import argparse
+import csv
+import io
+import json
+import sqlite3
+import sys
+
+import database
+
+TAMANHO_LOTE = 1000
+
+
+def ler_registros(fluxo, formato):
+    """Gera (número da linha, dicionário) a partir de um arquivo texto"""
+    if formato == 'csv':
+        leitor = csv.DictReader(fluxo)
+        for registro in leitor:
+            yield leitor.line_num, registro
+    elif formato == 'jsonl':
+        for linha, texto in enumerate(fluxo, start=1):
+            if not texto.strip():
+                continue
+            try:
+                yield linha, json.loads(texto)
+            except json.JSONDecodeError:
+                yield linha, None
+    else:
+        raise ValueError(f"formato desconhecido: {formato}")
+
+
+def formato_do_arquivo(nome):
+    return 'jsonl' if nome.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def _texto(dados, campo):
+    valor = dados.get(campo)
+    if valor is None:
+        return None
+    valor = str(valor).strip()
+    return valor or None
+
+
+def _inteiro(dados, campo):
+    valor = _texto(dados, campo)
+    if valor is None:
+        return None
+    try:
+        return int(valor)
+    except ValueError:
+        raise ValueError(f"{campo} deve ser um número inteiro")
+
+
+def validar_livro(dados):
+    """Valida um registro de livro e devolve a tupla pronta para o INSERT.
+    Lança ValueError com o motivo quando alguma regra do schema é violada."""
+    if not isinstance(dados, dict):
+        raise ValueError("linha não é um registro válido")
+    titulo = _texto(dados, 'titulo')
+    autores = _texto(dados, 'autores')
+    isbn = _texto(dados, 'isbn') or _texto(dados, 'ISBN')
+    edicao = _texto(dados, 'edicao')
+    ano = _inteiro(dados, 'ano')
+    copias = _inteiro(dados, 'copiasTotal')
+
+    if not titulo or len(titulo) > 200:
+        raise ValueError("titulo deve ter entre 1 e 200 caracteres")
+    if not autores or len(autores) > 100:
+        raise ValueError("autores deve ter entre 1 e 100 caracteres")
+    if isbn is not None and not 10 <= len(isbn) <= 13:
+        raise ValueError("ISBN deve ter entre 10 e 13 caracteres")
+    if ano is not None and ano < 0:
+        raise ValueError("ano não pode ser negativo")
+    if copias is None or copias <= 0:
+        raise ValueError("copiasTotal deve ser maior que zero")
+    return (titulo, autores, isbn, edicao, ano, copias, copias, 'DISPONIVEL')
+
+
+TIPOS_USUARIO = ('ALUNO', 'PROFESSOR', 'FUNCIONARIO')
+
+
+def validar_usuario(dados):
+    """Valida um registro de usuário e devolve a tupla pronta para o INSERT"""
+    if not isinstance(dados, dict):
+        raise ValueError("linha não é um registro válido")
+    nome = _texto(dados, 'nome')
+    matricula = _texto(dados, 'matricula')
+    tipo = (_texto(dados, 'tipo') or '').upper()
+    email = _texto(dados, 'email')
+
+    if not nome or len(nome) > 100:
+        raise ValueError("nome deve ter entre 1 e 100 caracteres")
+    if not matricula or len(matricula) != 5 or not matricula.isascii() or not matricula.isdigit():
+        raise ValueError("matricula deve ter exatamente 5 dígitos")
+    if tipo not in TIPOS_USUARIO:
+        raise ValueError("tipo deve ser ALUNO, PROFESSOR ou FUNCIONARIO")
+    if email is not None and ('@' not in email or len(email) < 5):
+        raise ValueError("email inválido")
+    return (nome, matricula, tipo, email)
+
+
+INSERIR_LIVRO = '''
+    INSERT INTO livro (titulo, autores, ISBN, edicao, ano, copiasTotal, copiasDisponiveis, status)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+def _gravar_lote(conn, comando, lote, rejeitados):
+    """Grava um lote numa transação. Se o executemany falhar por restrição,
+    refaz linha a linha para separar apenas as linhas problemáticas."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany(comando, [valores for _, valores in lote])
+        conn.commit()
+        return len(lote)
+    except sqlite3.IntegrityError:
+        conn.rollback()
+
+    inseridos = 0
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for linha, valores in lote:
+            try:
+                conn.execute(comando, valores)
+                inseridos += 1
+            except sqlite3.IntegrityError as e:
+                rejeitados.append({"linha": linha, "erro": str(e)})
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return inseridos
+
+
+def importar_livros(conn, registros, tamanho_lote=TAMANHO_LOTE):
+    """Importa livros a partir de (linha, dicionário) e devolve o relatório"""
+    inseridos = 0
+    rejeitados = []
+    lote = []
+    for linha, dados in registros:
+        try:
+            lote.append((linha, validar_livro(dados)))
+        except ValueError as e:
+            rejeitados.append({"linha": linha, "erro": str(e)})
+            continue
+        if len(lote) >= tamanho_lote:
+            inseridos += _gravar_lote(conn, INSERIR_LIVRO, lote, rejeitados)
+            lote = []
+    if lote:
+        inseridos += _gravar_lote(conn, INSERIR_LIVRO, lote, rejeitados)
+    rejeitados.sort(key=lambda r: r["linha"])
+    return {"inseridos": inseridos, "rejeitados": rejeitados}
+
+
+INSERIR_USUARIO = '''
+    INSERT INTO usuario (nome, matricula, tipo, email) VALUES (?, ?, ?, ?)
+'''
+
+
+def _separar_duplicados(conn, lote, vistos, rejeitados):
+    """Remove do lote as matrículas/emails já cadastrados ou repetidos no
+    próprio arquivo, com uma única consulta indexada por lote"""
+    matriculas = [valores[1] for _, valores in lote]
+    emails = [valores[3] for _, valores in lote if valores[3] is not None]
+    marcas_m = ','.join('?' * len(matriculas))
+    marcas_e = ','.join('?' * len(emails)) or 'NULL'
+    c = conn.execute(f'''
+        SELECT matricula, email FROM usuario
+        WHERE matricula IN ({marcas_m}) OR email IN ({marcas_e})
+    ''', matriculas + emails)
+    existentes_m = set()
+    existentes_e = set()
+    for matricula, email in c:
+        existentes_m.add(matricula)
+        existentes_e.add(email)
+
+    aceitos = []
+    for linha, valores in lote:
+        matricula, email = valores[1], valores[3]
+        if matricula in existentes_m:
+            motivo = f"matricula {matricula} já cadastrada"
+        elif matricula in vistos:
+            motivo = f"matricula {matricula} repetida no arquivo"
+        elif email is not None and email in existentes_e:
+            motivo = f"email {email} já cadastrado"
+        elif email is not None and email in vistos:
+            motivo = f"email {email} repetido no arquivo"
+        else:
+            vistos.add(matricula)
+            if email is not None:
+                vistos.add(email)
+            aceitos.append((linha, valores))
+            continue
+        rejeitados.append({"linha": linha, "erro": motivo})
+    return aceitos
+
+
+def importar_usuarios(conn, registros, tamanho_lote=TAMANHO_LOTE):
+    """Matrícula em lote: importa usuários e devolve o relatório. Duplicados
+    são rejeitados individualmente sem abortar o restante da carga."""
+    inseridos = 0
+    rejeitados = []
+    vistos = set()
+    lote = []
+
+    def gravar(lote):
+        aceitos = _separar_duplicados(conn, lote, vistos, rejeitados)
+        return _gravar_lote(conn, INSERIR_USUARIO, aceitos, rejeitados) if aceitos else 0
+
+    for linha, dados in registros:
+        try:
+            lote.append((linha, validar_usuario(dados)))
+        except ValueError as e:
+            rejeitados.append({"linha": linha, "erro": str(e)})
+            continue
+        if len(lote) >= tamanho_lote:
+            inseridos += gravar(lote)
+            lote = []
+    if lote:
+        inseridos += gravar(lote)
+    rejeitados.sort(key=lambda r: r["linha"])
+    return {"inseridos": inseridos, "rejeitados": rejeitados}
+
+
+IMPORTADORES = {
+    'livros': importar_livros,
+    'usuarios': importar_usuarios,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Importação em lote para a biblioteca")
+    parser.add_argument('tipo', choices=sorted(IMPORTADORES))
+    parser.add_argument('arquivo')
+    parser.add_argument('--formato', choices=('csv', 'jsonl'))
+    parser.add_argument('--lote', type=int, default=TAMANHO_LOTE)
+    args = parser.parse_args()
+
+    database.init_db()
+    conn = database.conectar()
+    formato = args.formato or formato_do_arquivo(args.arquivo)
+    with io.open(args.arquivo, encoding='utf-8-sig', newline='') as fluxo:
+        relatorio = IMPORTADORES[args.tipo](conn, ler_registros(fluxo, formato), args.lote)
+    conn.close()
+    json.dump(relatorio, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+"""Instrumentação de SQL, log de consultas lentas e métricas por rota no
+formato texto do Prometheus."""
+from collections import OrderedDict
+from datetime import datetime
+import hashlib
+import logging
+import re
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Limites superiores dos buckets dos histogramas, em segundos
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class CursorInstrumentado:
+    """Cursor que mede o tempo gasto em execute e nos fetch.
+
+    No SQLite as linhas são produzidas durante o fetch, então o tempo de um
+    comando só termina de ser contado quando o resultado se esgota, quando
+    o cursor executa outro comando ou quando a conexão é encerrada.
+    """
+
+    def __init__(self, cursor, conexao):
+        self._cursor = cursor
+        self._conexao = conexao
+        self._comando = None
+
+    def __getattr__(self, nome):
+        return getattr(self._cursor, nome)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def _medir(self, funcao, *args):
+        inicio = time.perf_counter()
+        try:
+            return funcao(*args)
+        finally:
+            duracao = time.perf_counter() - inicio
+            self._conexao.segundos += duracao
+            if self._comando is not None:
+                self._comando[2] += duracao
+
+    def _executar(self, funcao, sql, params):
+        self._encerrar()
+        self._conexao.consultas += 1
+        self._comando = [sql, params, 0.0, 0]
+        self._medir(funcao, sql, params)
+        if self._cursor.description is None:
+            self._encerrar()
+        return self
+
+    def execute(self, sql, params=()):
+        return self._executar(self._cursor.execute, sql, params)
+
+    def executemany(self, sql, params):
+        return self._executar(self._cursor.executemany, sql, params)
+
+    def _contar(self, linhas, esgotou):
+        if self._comando is not None:
+            self._comando[3] += linhas
+            if esgotou:
+                self._encerrar()
+
+    def fetchone(self):
+        linha = self._medir(self._cursor.fetchone)
+        self._contar(linha is not None, linha is None)
+        return linha
+
+    def fetchmany(self, tamanho=None):
+        tamanho = tamanho or self._cursor.arraysize
+        linhas = self._medir(self._cursor.fetchmany, tamanho)
+        self._contar(len(linhas), len(linhas) < tamanho)
+        return linhas
+
+    def fetchall(self):
+        linhas = self._medir(self._cursor.fetchall)
+        self._contar(len(linhas), True)
+        return linhas
+
+    def close(self):
+        self._encerrar()
+        self._cursor.close()
+
+    def _encerrar(self):
+        if self._comando is None:
+            return
+        sql, params, duracao, linhas = self._comando
+        self._comando = None
+        if self._cursor.description is None:
+            linhas = max(self._cursor.rowcount, 0)
+        self._conexao.comando_encerrado(sql, params, duracao, linhas)
+
+
+class ConexaoInstrumentada:
+    """Envolve uma conexão sqlite3 contando comandos e somando o tempo gasto
+    no SQLite. `ao_encerrar(sql, params, duracao, linhas)`, se informado, é
+    chamado ao fim de cada comando."""
+
+    def __init__(self, conn, ao_encerrar=None):
+        self.conexao = conn
+        self.ao_encerrar = ao_encerrar
+        self.consultas = 0
+        self.segundos = 0.0
+        self._cursores = []
+
+    def __getattr__(self, nome):
+        return getattr(self.conexao, nome)
+
+    def cursor(self):
+        cursor = CursorInstrumentado(self.conexao.cursor(), self)
+        self._cursores.append(cursor)
+        return cursor
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, params):
+        return self.cursor().executemany(sql, params)
+
+    def _medir(self, funcao):
+        inicio = time.perf_counter()
+        try:
+            return funcao()
+        finally:
+            self.segundos += time.perf_counter() - inicio
+
+    def commit(self):
+        self._medir(self.conexao.commit)
+
+    def rollback(self):
+        self._medir(self.conexao.rollback)
+
+    def comando_encerrado(self, sql, params, duracao, linhas):
+        if self.ao_encerrar is not None:
+            self.ao_encerrar(sql, params, duracao, linhas)
+
+    def encerrar(self):
+        """Fecha a contagem dos comandos ainda abertos e devolve a conexão
+        original"""
+        for cursor in self._cursores:
+            cursor._encerrar()
+        self._cursores = []
+        return self.conexao
+
+
+class Histograma:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.contagens = [0] * len(buckets)
+        self.soma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        for i, limite in enumerate(self.buckets):
+            if valor <= limite:
+                self.contagens[i] += 1
+                break
+        self.soma += valor
+        self.total += 1
+
+    def linhas(self, nome, rotulos):
+        acumulado = 0
+        for limite, contagem in zip(self.buckets, self.contagens):
+            acumulado += contagem
+            yield f'{nome}_bucket{{{rotulos},le="{limite}"}} {acumulado}'
+        yield f'{nome}_bucket{{{rotulos},le="+Inf"}} {self.total}'
+        yield f'{nome}_sum{{{rotulos}}} {self.soma:.6f}'
+        yield f'{nome}_count{{{rotulos}}} {self.total}'
+
+
+def _rotulo(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metricas:
+    """Acumula as medidas das requisições por rota"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requisicoes = {}
+        self.latencia = {}
+        self.etapas = {}
+
+    def registrar(self, rota, metodo, status, duracao, etapas):
+        """`etapas`: segundos por parte da requisição, ex. {"sql": ..., "render": ...}.
+        O número de comandos SQL vem em etapas["consultas"]."""
+        with self._lock:
+            chave = (rota, metodo, status)
+            self.requisicoes[chave] = self.requisicoes.get(chave, 0) + 1
+            self.latencia.setdefault(rota, Histograma()).observar(duracao)
+            acumulado = self.etapas.setdefault(rota, {})
+            for etapa, valor in etapas.items():
+                acumulado[etapa] = acumulado.get(etapa, 0) + valor
+
+    def limpar(self):
+        with self._lock:
+            self.requisicoes.clear()
+            self.latencia.clear()
+            self.etapas.clear()
+
+    def exportar(self, extras=()):
+        """Texto no formato de exposição do Prometheus. `extras` são tuplas
+        (nome, tipo, ajuda, [(rótulos, valor)]) com métricas de fora."""
+        saida = []
+        with self._lock:
+            saida.append('# HELP biblioteca_requisicoes_total Requisições atendidas.')
+            saida.append('# TYPE biblioteca_requisicoes_total counter')
+            for (rota, metodo, status), total in sorted(self.requisicoes.items()):
+                saida.append(f'biblioteca_requisicoes_total{{rota="{_rotulo(rota)}",'
+                             f'metodo="{metodo}",status="{status}"}} {total}')
+
+            saida.append('# HELP biblioteca_requisicao_segundos Latência das requisições por rota.')
+            saida.append('# TYPE biblioteca_requisicao_segundos histogram')
+            for rota, histograma in sorted(self.latencia.items()):
+                saida.extend(histograma.linhas('biblioteca_requisicao_segundos', f'rota="{_rotulo(rota)}"'))
+
+            saida.append('# HELP biblioteca_sql_consultas_total Comandos SQL executados.')
+            saida.append('# TYPE biblioteca_sql_consultas_total counter')
+            for rota, etapas in sorted(self.etapas.items()):
+                saida.append(f'biblioteca_sql_consultas_total{{rota="{_rotulo(rota)}"}} '
+                             f'{etapas.get("consultas", 0)}')
+
+            saida.append('# HELP biblioteca_etapa_segundos_total Tempo gasto por etapa da requisição.')
+            saida.append('# TYPE biblioteca_etapa_segundos_total counter')
+            for rota, etapas in sorted(self.etapas.items()):
+                for etapa, valor in sorted(etapas.items()):
+                    if etapa != 'consultas':
+                        saida.append(f'biblioteca_etapa_segundos_total{{rota="{_rotulo(rota)}",'
+                                     f'etapa="{etapa}"}} {valor:.6f}')
+
+        for nome, tipo, ajuda, valores in extras:
+            saida.append(f'# HELP {nome} {ajuda}')
+            saida.append(f'# TYPE {nome} {tipo}')
+            for rotulos, valor in valores:
+                texto = ','.join(f'{k}="{_rotulo(v)}"' for k, v in rotulos.items())
+                saida.append(f'{nome}{{{texto}}} {valor}' if texto else f'{nome} {valor}')
+        return '\n'.join(saida) + '\n'
+
+
+def normalizar_sql(sql):
+    """Troca literais por ? e listas de marcadores por (?, ...), para que
+    variações do mesmo comando tenham a mesma impressão digital"""
+    texto = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    texto = re.sub(r'(?<![\w.])\d+(?:\.\d+)?(?![\w.])', '?', texto)
+    texto = re.sub(r'\(\s*\?(?:\s*,\s*\?)+\s*\)', '(?, ...)', texto)
+    return ' '.join(texto.split())
+
+
+def formato_parametros(params):
+    """Tipos dos parâmetros, sem os valores (ex.: ['str', 'int'])"""
+    if isinstance(params, dict):
+        return {nome: type(valor).__name__ for nome, valor in params.items()}
+    return [type(valor).__name__ for valor in params]
+
+
+PLANEJAVEIS = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+class ConsultasLentas:
+    """Registro das consultas acima do limite, agrupadas pela impressão
+    digital do SQL normalizado. Guarda no máximo `capacidade` comandos,
+    descartando o visto há mais tempo.
+
+    O EXPLAIN QUERY PLAN roda quando o comando aparece pela primeira vez e
+    depois no máximo a cada `intervalo_plano` segundos, para não somar
+    consultas justamente quando o banco já está lento."""
+
+    def __init__(self, capacidade=200, intervalo_plano=300):
+        self.capacidade = capacidade
+        self.intervalo_plano = intervalo_plano
+        self._entradas = OrderedDict()
+        self._planos_em = {}
+        self._lock = threading.Lock()
+
+    def registrar(self, conn, sql, params, duracao, linhas, rota=None):
+        normalizado = normalizar_sql(sql)
+        digital = hashlib.sha1(normalizado.encode()).hexdigest()[:16]
+        # executemany: o plano e o formato vêm da primeira linha de parâmetros
+        if isinstance(params, list) and params and isinstance(params[0], (tuple, list, dict)):
+            params = params[0]
+        instante = time.monotonic()
+        with self._lock:
+            planejado = self._planos_em.get(digital)
+        plano = None
+        if planejado is None or instante - planejado >= self.intervalo_plano:
+            plano = self._plano(conn, sql, params)
+        duracao_ms = round(duracao * 1000, 3)
+        agora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        with self._lock:
+            entrada = self._entradas.pop(digital, None)
+            if entrada is None:
+                entrada = {
+                    "digital": digital,
+                    "sql": normalizado,
+                    "execucoes": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "rotas": [],
+                    "primeira": agora,
+                }
+                log.warning("consulta lenta (%.1f ms, %s linhas): %s | plano: %s",
+                            duracao_ms, linhas, normalizado, ' | '.join(plano or []))
+            entrada["execucoes"] += 1
+            entrada["total_ms"] = round(entrada["total_ms"] + duracao_ms, 3)
+            entrada["max_ms"] = max(entrada["max_ms"], duracao_ms)
+            entrada["ultima_ms"] = duracao_ms
+            entrada["linhas"] = linhas
+            entrada["parametros"] = formato_parametros(params)
+            if plano is not None:
+                entrada["plano"] = plano
+                entrada["varredura"] = any(p.startswith('SCAN ') for p in plano)
+                entrada["plano_em"] = agora
+                self._planos_em[digital] = instante
+            entrada["ultima"] = agora
+            if rota and rota not in entrada["rotas"]:
+                entrada["rotas"].append(rota)
+            self._entradas[digital] = entrada
+            while len(self._entradas) > self.capacidade:
+                descartada, _ = self._entradas.popitem(last=False)
+                self._planos_em.pop(descartada, None)
+
+    def _plano(self, conn, sql, params):
+        if not sql.lstrip().upper().startswith(PLANEJAVEIS):
+            return []
+        try:
+            c = conn.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [linha[3] for linha in c.fetchall()]
+        except Exception as e:
+            return [f"erro ao obter o plano: {e}"]
+
+    def listar(self):
+        """Entradas em ordem decrescente de tempo total"""
+        with self._lock:
+            entradas = [dict(e, rotas=list(e["rotas"])) for e in self._entradas.values()]
+        return sorted(entradas, key=lambda e: e["total_ms"], reverse=True)
+
+    def limpar(self):
+        with self._lock:
+            self._entradas.clear()
+            self._planos_em.clear()
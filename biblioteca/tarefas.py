@@ -0,0 +1,190 @@
+"""Tarefas de manutenção que rodam fora das requisições.
+
+    python tarefas.py atrasados
+    python tarefas.py arquivar --dias 365
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+import database
+from circulacao import MULTA_DIARIA
+
+TAMANHO_LOTE = 500
+# Idade mínima, em dias desde o empréstimo, para arquivar um empréstimo encerrado
+DIAS_ARQUIVAMENTO = 365
+
+COLUNAS_EMPRESTIMO = 'loanId, userId, bookId, copyId, loanDate, dueDate, returnDate, status, fine'
+
+log = logging.getLogger(__name__)
+
+
+def registrar_execucao(conn, tarefa, inicio, duracao_ms, linhas):
+    conn.execute('''
+        INSERT INTO tarefa_execucao (tarefa, inicio, duracao_ms, linhas)
+        VALUES (?, ?, ?, ?)
+    ''', (tarefa, inicio.strftime('%Y-%m-%d %H:%M:%S'), duracao_ms, linhas))
+    conn.commit()
+
+
+def marcar_atrasados(conn, agora=None, lote=TAMANHO_LOTE):
+    """Marca como OVERDUE os empréstimos em aberto com dueDate vencido e
+    atualiza a multa acumulada.
+
+    Percorre só os candidatos pelo índice parcial idx_emprestimo_abertos,
+    em lotes ordenados por (dueDate, loanId). Cada lote é um UPDATE em
+    conjunto na sua própria transação curta, para não segurar o lock de
+    escrita enquanto a varredura avança. Linhas cuja situação não mudou
+    não são regravadas.
+    """
+    agora = agora or datetime.now()
+    hoje = agora.strftime('%Y-%m-%d')
+    inicio = time.perf_counter()
+    alteradas = 0
+    cursor = ('', 0)
+
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # INDEXED BY: sem ele o planejador prefere idx_emprestimo_status,
+            # que exige ordenar todos os candidatos a cada lote
+            c = conn.execute('''
+                SELECT dueDate, loanId FROM emprestimo INDEXED BY idx_emprestimo_abertos
+                WHERE status IN ('ACTIVE', 'OVERDUE') AND dueDate < ?
+                  AND (dueDate, loanId) > (?, ?)
+                ORDER BY dueDate, loanId
+                LIMIT ?
+            ''', (hoje, cursor[0], cursor[1], lote))
+            chaves = c.fetchall()
+            if not chaves:
+                conn.commit()
+                break
+            ids = [loanId for _, loanId in chaves]
+            c = conn.execute(f'''
+                UPDATE emprestimo
+                SET status = 'OVERDUE',
+                    fine = CAST(julianday(?) - julianday(date(dueDate)) AS INTEGER) * ?
+                WHERE loanId IN ({','.join('?' * len(ids))})
+                  AND (status = 'ACTIVE'
+                       OR fine IS NOT CAST(julianday(?) - julianday(date(dueDate)) AS INTEGER) * ?)
+            ''', [hoje, MULTA_DIARIA] + ids + [hoje, MULTA_DIARIA])
+            alteradas += c.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        cursor = chaves[-1]
+
+    duracao_ms = round((time.perf_counter() - inicio) * 1000, 2)
+    registrar_execucao(conn, 'atrasados', agora, duracao_ms, alteradas)
+    return {"linhas": alteradas, "duracao_ms": duracao_ms}
+
+
+def arquivar_emprestimos(conn, dias=DIAS_ARQUIVAMENTO, agora=None, lote=TAMANHO_LOTE):
+    """Move para emprestimo_historico os empréstimos devolvidos ou
+    cancelados feitos há mais de `dias` dias.
+
+    Percorre emprestimo pelo índice de loanDate em lotes ordenados por
+    (loanDate, loanId), cada um na sua própria transação curta: copia as
+    linhas para o histórico e só então as apaga, o que faz os triggers de
+    exclusão manterem contadores e agregados como estavam.
+    """
+    agora = agora or datetime.now()
+    limite = (agora - timedelta(days=dias)).strftime('%Y-%m-%d')
+    inicio = time.perf_counter()
+    arquivadas = 0
+    cursor = ('', 0)
+
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            c = conn.execute('''
+                SELECT loanDate, loanId FROM emprestimo
+                WHERE loanDate < ? AND (loanDate, loanId) > (?, ?)
+                  AND status IN ('RETURNED', 'CANCEL')
+                ORDER BY loanDate, loanId
+                LIMIT ?
+            ''', (limite, cursor[0], cursor[1], lote))
+            chaves = c.fetchall()
+            if not chaves:
+                conn.commit()
+                break
+            ids = [loanId for _, loanId in chaves]
+            marcas = ','.join('?' * len(ids))
+            conn.execute(f'''
+                INSERT INTO emprestimo_historico ({COLUNAS_EMPRESTIMO})
+                SELECT {COLUNAS_EMPRESTIMO} FROM emprestimo WHERE loanId IN ({marcas})
+            ''', ids)
+            c = conn.execute(f'DELETE FROM emprestimo WHERE loanId IN ({marcas})', ids)
+            arquivadas += c.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        cursor = chaves[-1]
+
+    duracao_ms = round((time.perf_counter() - inicio) * 1000, 2)
+    registrar_execucao(conn, 'arquivar', agora, duracao_ms, arquivadas)
+    return {"linhas": arquivadas, "duracao_ms": duracao_ms}
+
+
+def iniciar_varredor(path, intervalo_s):
+    """Roda marcar_atrasados numa thread de fundo a cada `intervalo_s`.
+    Uma rodada que falhe (ex.: banco travado além do busy_timeout) é
+    registrada no log e tentada de novo no próximo intervalo.
+    Retorna o Event que, quando sinalizado, encerra a thread."""
+    parar = threading.Event()
+
+    def laco():
+        while not parar.is_set():
+            try:
+                conn = database.conectar(path)
+                try:
+                    marcar_atrasados(conn)
+                finally:
+                    conn.close()
+            except Exception:
+                log.exception("falha na varredura de atrasos; nova tentativa em %s s", intervalo_s)
+            parar.wait(intervalo_s)
+
+    threading.Thread(target=laco, name='varredor-atrasos', daemon=True).start()
+    return parar
+
+
+def ultimas_execucoes(conn, limite=10):
+    c = conn.execute('''
+        SELECT tarefa, inicio, duracao_ms, linhas FROM tarefa_execucao
+        ORDER BY id DESC LIMIT ?
+    ''', (limite,))
+    return [
+        {"tarefa": r[0], "inicio": r[1], "duracao_ms": r[2], "linhas": r[3]}
+        for r in c.fetchall()
+    ]
+
+
+TAREFAS = {
+    'atrasados': lambda conn, args: marcar_atrasados(conn, lote=args.lote),
+    'arquivar': lambda conn, args: arquivar_emprestimos(conn, dias=args.dias, lote=args.lote),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tarefas de manutenção da biblioteca")
+    parser.add_argument('tarefa', choices=sorted(TAREFAS))
+    parser.add_argument('--lote', type=int, default=TAMANHO_LOTE)
+    parser.add_argument('--dias', type=int, default=DIAS_ARQUIVAMENTO,
+                        help="arquivar: idade mínima dos empréstimos encerrados")
+    args = parser.parse_args()
+
+    database.init_db()
+    conn = database.conectar()
+    resultado = TAREFAS[args.tarefa](conn, args)
+    conn.close()
+    print(json.dumps(resultado, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,74 @@
 import unittest
 import sqlite3
 import json
-from datetime import datetime, timedelta
+import csv
+import io
+import threading
+import subprocess
+import tempfile
+import time
+from datetime import date, datetime, timedelta
 import sys
 import os
 
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 
-from app import app
-from database import init_db
+from app import app, pool, get_db, get_db_leitura, metricas, consultas_lentas, rankings, cache_usuarios, cache_relatorio, CONSULTA_RELATORIO, filtro_datas, linhas_exportacao
+from database import init_db, conectar, conectar_leitura, migrar, aplicar_migracoes, SCHEMA_VERSAO
+from circulacao import emprestar, devolver, ErroCirculacao, MULTA_DIARIA
+from importacao import importar_livros, importar_usuarios, ler_registros
+from tarefas import marcar_atrasados, arquivar_emprestimos, iniciar_varredor
+from metricas import ConexaoInstrumentada, ConsultasLentas, normalizar_sql
+from analise import Ranking
+
+
+# Schema do biblioteca.db distribuído com o projeto, anterior às migrações:
+# emprestimo ainda sem copyId, returnDate e fine
+ESQUEMA_ANTIGO = (
+    '''CREATE TABLE usuario (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                nome TEXT NOT NULL,
+                matricula TEXT NOT NULL UNIQUE,
+                tipo TEXT NOT NULL,
+                email TEXT,
+                ativoDeRegistro TEXT NOT NULL DEFAULT (date('now')),
+                status TEXT NOT NULL DEFAULT 'ATIVO'
+            )''',
+    '''CREATE TABLE livro (
+                bookId INTEGER PRIMARY KEY AUTOINCREMENT,
+                titulo TEXT NOT NULL,
+                autores TEXT NOT NULL,
+                ISBN TEXT,
+                edicao TEXT,
+                ano INTEGER,
+                copiasTotal INTEGER NOT NULL,
+                copiasDisponiveis INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'DISPONIVEL'
+            )''',
+    '''CREATE TABLE emprestimo (
+                loanId INTEGER PRIMARY KEY AUTOINCREMENT,
+                userId INTEGER NOT NULL,
+                bookId INTEGER NOT NULL,
+                loanDate TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
+                dueDate TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'ACTIVE',
+                FOREIGN KEY (userId) REFERENCES usuario (id) ON DELETE RESTRICT,
+                FOREIGN KEY (bookId) REFERENCES livro (bookId) ON DELETE RESTRICT
+            )''',
+)
+
+
+def remover_banco():
+    """Fecha as conexões do pool, esvazia os caches e apaga o banco com
+    seus arquivos WAL"""
+    pool.fechar_todas()
+    cache_usuarios.limpar()
+    cache_relatorio.limpar()
+    for ranking in rankings.values():
+        ranking.limpar()
+    for arquivo in ('biblioteca.db', 'biblioteca.db-wal', 'biblioteca.db-shm'):
+        if os.path.exists(arquivo):
+            os.remove(arquivo)
 
 
 class TestBiblioteca(unittest.TestCase):
@@ -20,14 +80,12 @@ class TestBiblioteca(unittest.TestCase):
         self.app.config['TESTING'] = True
         self.client = self.app.test_client()
 
-        if os.path.exists('biblioteca.db'):
-            os.remove('biblioteca.db')
+        remover_banco()
         init_db()
         
     def tearDown(self):
         """Limpeza após cada teste"""
-        if os.path.exists('biblioteca.db'):
-            os.remove('biblioteca.db')
+        remover_banco()
 
 
 class TestUsuarios(TestBiblioteca):
@@ -450,6 +508,1484 @@ class TestRelatorios(TestBiblioteca):
         self.assertLessEqual(len(data['data']), 20)
 
 
+class TestIndicesRelatorio(TestBiblioteca):
+    """Testes dos índices usados pelo relatório de empréstimos"""
+
+    def plano(self, start=None, end=None):
+        filtro, params = filtro_datas(start, end)
+        conn = sqlite3.connect('biblioteca.db')
+        c = conn.cursor()
+        c.execute('EXPLAIN QUERY PLAN ' + CONSULTA_RELATORIO + filtro +
+                  ' ORDER BY e.loanDate DESC LIMIT 20', params)
+        plano = ' | '.join(r[3] for r in c.fetchall())
+        conn.close()
+        return plano
+
+    def test_indices_criados_e_versionados(self):
+        """Testa que init_db cria os índices e registra a versão do schema"""
+        conn = sqlite3.connect('biblioteca.db')
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'emprestimo'")
+        indices = {r[0] for r in c.fetchall()}
+        c.execute('PRAGMA user_version')
+        versao = c.fetchone()[0]
+        conn.close()
+
+        self.assertTrue({'idx_emprestimo_loanDate', 'idx_emprestimo_userId',
+                         'idx_emprestimo_bookId', 'idx_emprestimo_status'} <= indices)
+        self.assertEqual(versao, SCHEMA_VERSAO)
+
+    def test_filtro_periodo_usa_indice(self):
+        """Testa que o filtro por período usa o índice de loanDate"""
+        plano = self.plano('2024-01-01', '2024-01-31')
+        self.assertIn('SEARCH e USING INDEX idx_emprestimo_loanDate', plano)
+
+    def test_ordenacao_sem_filtro_usa_indice(self):
+        """Testa que a ordenação por data dispensa o sort temporário"""
+        plano = self.plano()
+        self.assertIn('idx_emprestimo_loanDate', plano)
+        self.assertNotIn('TEMP B-TREE', plano)
+
+    def test_filtro_fim_inclui_dia_inteiro(self):
+        """Testa que o filtro de fim inclui empréstimos feitos no próprio dia"""
+        conn = sqlite3.connect('biblioteca.db')
+        c = conn.cursor()
+        c.execute("INSERT INTO usuario (nome, matricula, tipo) VALUES ('A', '10101', 'ALUNO')")
+        c.execute("INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES ('L', 'A', 1, 1)")
+        c.execute("INSERT INTO emprestimo (userId, bookId, loanDate, dueDate) VALUES (1, 1, '2024-03-10 18:30:00', '2024-03-24')")
+        conn.commit()
+        conn.close()
+
+        response = self.client.get('/api/relatorio/emprestimos?start=2024-03-10&end=2024-03-10')
+        self.assertEqual(len(json.loads(response.data)['data']), 1)
+        response = self.client.get('/api/relatorio/emprestimos?start=2024-03-11')
+        self.assertEqual(len(json.loads(response.data)['data']), 0)
+
+    def test_data_invalida(self):
+        """Testa que datas fora do formato AAAA-MM-DD são rejeitadas"""
+        response = self.client.get('/api/relatorio/emprestimos?start=10/03/2024')
+        self.assertEqual(response.status_code, 400)
+
+
+class TestPaginacaoCursor(TestBiblioteca):
+    """Testes da paginação por cursor do relatório"""
+
+    def setUp(self):
+        """Cria 45 empréstimos, alguns com a mesma data"""
+        super().setUp()
+        conn = sqlite3.connect('biblioteca.db')
+        c = conn.cursor()
+        c.execute("INSERT INTO usuario (nome, matricula, tipo) VALUES ('A', '10101', 'ALUNO')")
+        c.execute("INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES ('L', 'A', 50, 50)")
+        for i in range(45):
+            loan_date = f'2024-03-{10 + i // 4:02d} 10:00:00'
+            c.execute('INSERT INTO emprestimo (userId, bookId, loanDate, dueDate) VALUES (1, 1, ?, ?)',
+                      (loan_date, '2024-05-01'))
+        conn.commit()
+        conn.close()
+
+    def test_percorre_todas_as_paginas(self):
+        """Testa que seguir next_cursor percorre todos os registros sem repetição"""
+        ids = []
+        url = '/api/relatorio/emprestimos?cursor='
+        while True:
+            data = json.loads(self.client.get(url).data)
+            ids.extend(r['loanId'] for r in data['data'])
+            cursor = data['pagination']['next_cursor']
+            if cursor is None:
+                break
+            url = f'/api/relatorio/emprestimos?cursor={cursor}'
+
+        self.assertEqual(len(ids), 45)
+        self.assertEqual(len(set(ids)), 45)
+
+    def test_cursor_igual_a_paginacao_por_numero(self):
+        """Testa que a segunda página por cursor coincide com page=2"""
+        primeira = json.loads(self.client.get('/api/relatorio/emprestimos?cursor=').data)
+        cursor = primeira['pagination']['next_cursor']
+        por_cursor = json.loads(self.client.get(f'/api/relatorio/emprestimos?cursor={cursor}').data)
+        por_numero = json.loads(self.client.get('/api/relatorio/emprestimos?page=2').data)
+
+        self.assertEqual(por_cursor['data'], por_numero['data'])
+
+    def test_total_apenas_quando_solicitado(self):
+        """Testa que o modo cursor só calcula o total com total=1"""
+        sem_total = json.loads(self.client.get('/api/relatorio/emprestimos?cursor=').data)
+        com_total = json.loads(self.client.get('/api/relatorio/emprestimos?cursor=&total=1').data)
+
+        self.assertNotIn('total', sem_total['pagination'])
+        self.assertEqual(com_total['pagination']['total'], 45)
+
+    def test_cursor_invalido(self):
+        """Testa que cursor malformado retorna 400"""
+        response = self.client.get('/api/relatorio/emprestimos?cursor=nao-e-cursor')
+        self.assertEqual(response.status_code, 400)
+
+    def test_per_page_configuravel(self):
+        """Testa que per_page muda o tamanho da página e o total de páginas"""
+        data = json.loads(self.client.get('/api/relatorio/emprestimos?cursor=&total=1&per_page=7').data)
+        self.assertEqual(len(data['data']), 7)
+        self.assertEqual(data['pagination']['per_page'], 7)
+        self.assertEqual(data['pagination']['total_pages'], 7)
+
+        cursor = data['pagination']['next_cursor']
+        segunda = json.loads(self.client.get(f'/api/relatorio/emprestimos?cursor={cursor}&per_page=7').data)
+        por_numero = json.loads(self.client.get('/api/relatorio/emprestimos?page=2&per_page=7').data)
+        self.assertEqual(segunda['data'], por_numero['data'])
+
+    def test_per_page_fora_do_limite(self):
+        """Testa que per_page zero, acima do máximo ou não numérico retorna 400"""
+        for valor in ('0', '201', 'x'):
+            response = self.client.get(f'/api/relatorio/emprestimos?per_page={valor}')
+            self.assertEqual(response.status_code, 400, valor)
+
+
+class TestContadores(TestBiblioteca):
+    """Testes dos contadores mantidos por triggers"""
+
+    def setUp(self):
+        super().setUp()
+        self.conn = sqlite3.connect('biblioteca.db')
+        c = self.conn.cursor()
+        c.execute("INSERT INTO usuario (nome, matricula, tipo) VALUES ('A', '10101', 'ALUNO')")
+        c.execute("INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES ('L', 'A', 50, 50)")
+        for dia in ('2024-03-01', '2024-03-01', '2024-03-02', '2024-03-05'):
+            c.execute('INSERT INTO emprestimo (userId, bookId, loanDate, dueDate) VALUES (1, 1, ?, ?)',
+                      (dia + ' 09:00:00', '2024-04-01'))
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+        super().tearDown()
+
+    def total(self, query=''):
+        response = self.client.get('/api/relatorio/emprestimos' + query)
+        return json.loads(response.data)['pagination']['total']
+
+    def test_total_sem_filtro(self):
+        """Testa que o total geral acompanha inserções e exclusões"""
+        self.assertEqual(self.total(), 4)
+        self.conn.execute('DELETE FROM emprestimo WHERE loanId = 1')
+        self.conn.commit()
+        self.assertEqual(self.total(), 3)
+
+    def test_total_por_periodo(self):
+        """Testa que o total filtrado soma os baldes diários do período"""
+        self.assertEqual(self.total('?start=2024-03-01&end=2024-03-01'), 2)
+        self.assertEqual(self.total('?start=2024-03-02'), 2)
+        self.assertEqual(self.total('?end=2024-03-02'), 3)
+
+    def test_mudanca_de_status_e_data(self):
+        """Testa que as atualizações movem o empréstimo entre baldes"""
+        c = self.conn.cursor()
+        c.execute("UPDATE emprestimo SET status = 'RETURNED' WHERE loanId = 1")
+        c.execute("UPDATE emprestimo SET loanDate = '2024-03-05 12:00:00' WHERE loanId = 2")
+        self.conn.commit()
+
+        c.execute('''
+            SELECT dia, status, SUM(total) FROM emprestimo_diario
+            GROUP BY dia, status HAVING SUM(total) > 0 ORDER BY dia, status
+        ''')
+        self.assertEqual(c.fetchall(), [
+            ('2024-03-01', 'RETURNED', 1),
+            ('2024-03-02', 'ACTIVE', 1),
+            ('2024-03-05', 'ACTIVE', 2),
+        ])
+        self.assertEqual(self.total('?start=2024-03-05&end=2024-03-05'), 2)
+
+
+class TestListagensPaginadas(TestBiblioteca):
+    """Testes da paginação das páginas HTML"""
+
+    def setUp(self):
+        super().setUp()
+        conn = sqlite3.connect('biblioteca.db')
+        conn.executemany('INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES (?, ?, 1, 1)',
+                         [(f'Livro {i:03d}', 'Autor') for i in range(1, 121)])
+        conn.commit()
+        conn.close()
+
+    def test_primeira_pagina_limitada(self):
+        """Testa que a listagem mostra só uma página, a partir do mais recente"""
+        html = self.client.get('/livros').get_data(as_text=True)
+
+        self.assertIn('Livro 120', html)
+        self.assertIn('Livro 071', html)
+        self.assertNotIn('Livro 070', html)
+        self.assertIn('antes=71', html)
+
+    def test_navegacao_por_cursor(self):
+        """Testa que o link de próxima página continua de onde a anterior parou"""
+        html = self.client.get('/livros?antes=71').get_data(as_text=True)
+        self.assertIn('Livro 070', html)
+        self.assertNotIn('Livro 071', html)
+
+        html = self.client.get('/livros?antes=21').get_data(as_text=True)
+        self.assertIn('Livro 001', html)
+        self.assertNotIn('Próxima página', html)
+
+    def test_post_redireciona_para_listagem(self):
+        """Testa que o cadastro redireciona para a primeira página"""
+        response = self.client.post('/livros', data={
+            'titulo': 'Novo',
+            'autores': 'Autor',
+            'copiasTotal': '1'
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.headers['Location'].endswith('/livros'))
+
+
+class TestExportacao(TestBiblioteca):
+    """Testes da exportação em streaming do relatório"""
+
+    def setUp(self):
+        super().setUp()
+        conn = sqlite3.connect('biblioteca.db')
+        c = conn.cursor()
+        c.execute("INSERT INTO usuario (nome, matricula, tipo) VALUES ('A', '10101', 'ALUNO')")
+        c.execute("INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES ('Livro, com vírgula', 'A', 50, 50)")
+        for i in range(1, 11):
+            c.execute('INSERT INTO emprestimo (userId, bookId, loanDate, dueDate) VALUES (1, 1, ?, ?)',
+                      (f'2024-03-{i:02d} 10:00:00', '2024-05-01'))
+        conn.commit()
+        conn.close()
+
+    def test_exportacao_csv(self):
+        """Testa a exportação CSV com cabeçalho e filtro de período"""
+        response = self.client.get('/api/relatorio/emprestimos/exportar?start=2024-03-05&end=2024-03-06')
+        self.assertEqual(response.mimetype, 'text/csv')
+
+        linhas = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual(linhas[0][0], 'loanId')
+        self.assertEqual([l[3] for l in linhas[1:]], ['2024-03-06', '2024-03-05'])
+        self.assertEqual(linhas[1][2], 'Livro, com vírgula')
+
+    def test_exportacao_ndjson(self):
+        """Testa a exportação NDJSON com um objeto por linha"""
+        response = self.client.get('/api/relatorio/emprestimos/exportar?formato=ndjson')
+        registros = [json.loads(l) for l in response.get_data(as_text=True).splitlines()]
+
+        self.assertEqual(len(registros), 10)
+        self.assertEqual(registros[0]['matricula'], '10101')
+
+    def test_formato_invalido(self):
+        """Testa que formatos desconhecidos são rejeitados"""
+        response = self.client.get('/api/relatorio/emprestimos/exportar?formato=xml')
+        self.assertEqual(response.status_code, 400)
+
+    def test_exportacao_le_snapshot(self):
+        """Testa que gravações durante a exportação não bloqueiam nem aparecem nela"""
+        query = CONSULTA_RELATORIO + ' ORDER BY e.loanDate DESC, e.loanId DESC'
+        gerador = linhas_exportacao(query, [], 'ndjson', lote=3)
+        partes = [next(gerador)]
+
+        conn = sqlite3.connect('biblioteca.db', timeout=0)
+        conn.execute("INSERT INTO emprestimo (userId, bookId, loanDate, dueDate) VALUES (1, 1, '2000-01-01', '2000-01-15')")
+        conn.commit()
+        conn.close()
+
+        partes.extend(gerador)
+        self.assertEqual(len(''.join(partes).splitlines()), 10)
+
+
+class TestEmprestimoConcorrente(TestBiblioteca):
+    """Testes de empréstimos simultâneos do mesmo livro"""
+
+    def setUp(self):
+        super().setUp()
+        conn = sqlite3.connect('biblioteca.db')
+        c = conn.cursor()
+        c.executemany('INSERT INTO usuario (nome, matricula, tipo) VALUES (?, ?, ?)',
+                      [(f'Aluno {i}', f'{i:05d}', 'ALUNO') for i in range(1, 21)])
+        c.execute("INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES ('Disputado', 'A', 30, 30)")
+        self.book_id = c.lastrowid
+        conn.commit()
+        conn.close()
+
+    def test_sem_venda_a_mais(self):
+        """Testa que 100 tentativas paralelas emprestam exatamente as 30 cópias"""
+        resultados = []
+        erros = []
+
+        def balcao(userId):
+            conn = conectar('biblioteca.db')
+            try:
+                for _ in range(5):
+                    try:
+                        resultados.append(emprestar(conn, userId, self.book_id, 'ALUNO'))
+                    except ErroCirculacao:
+                        pass
+            except Exception as e:
+                erros.append(e)
+            finally:
+                conn.close()
+
+        threads = [threading.Thread(target=balcao, args=(i,)) for i in range(1, 21)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        conn = sqlite3.connect('biblioteca.db')
+        c = conn.cursor()
+        c.execute('SELECT copiasDisponiveis FROM livro WHERE bookId = ?', (self.book_id,))
+        disponiveis = c.fetchone()[0]
+        c.execute('SELECT COUNT(*) FROM emprestimo WHERE bookId = ?', (self.book_id,))
+        emprestados = c.fetchone()[0]
+        conn.close()
+
+        self.assertEqual(erros, [])
+        self.assertEqual(len(resultados), 30)
+        self.assertEqual(emprestados, 30)
+        self.assertEqual(disponiveis, 0)
+
+    def test_usuario_inexistente_nao_baixa_estoque(self):
+        """Testa que a falha de chave estrangeira desfaz a baixa de estoque"""
+        conn = conectar('biblioteca.db')
+        with self.assertRaises(sqlite3.IntegrityError):
+            emprestar(conn, 999, self.book_id, 'ALUNO')
+        c = conn.execute('SELECT copiasDisponiveis FROM livro WHERE bookId = ?', (self.book_id,))
+        self.assertEqual(c.fetchone()[0], 30)
+        conn.close()
+
+
+class TestImportacaoLivros(TestBiblioteca):
+    """Testes da importação em lote do catálogo"""
+
+    CSV = (
+        'titulo,autores,isbn,edicao,ano,copiasTotal\n'
+        'Livro A,Autor A,1234567890,1ª,2020,3\n'
+        ',Sem Titulo,,,,1\n'
+        'Livro B,Autor B,123,,,1\n'
+        'Livro C,Autor C,,,abc,1\n'
+        'Livro D,Autor D,,,,0\n'
+        'Livro E,Autor E,,,,2\n'
+    )
+
+    def livros(self):
+        conn = sqlite3.connect('biblioteca.db')
+        c = conn.cursor()
+        c.execute('SELECT titulo, copiasTotal, copiasDisponiveis FROM livro ORDER BY bookId')
+        livros = c.fetchall()
+        conn.close()
+        return livros
+
+    def test_importacao_csv_com_relatorio(self):
+        """Testa que linhas válidas entram e inválidas voltam com o motivo"""
+        response = self.client.post('/api/livros/importar', data={
+            'arquivo': (io.BytesIO(self.CSV.encode()), 'catalogo.csv')
+        }, content_type='multipart/form-data')
+        relatorio = json.loads(response.data)
+
+        self.assertEqual(relatorio['inseridos'], 2)
+        self.assertEqual([r['linha'] for r in relatorio['rejeitados']], [3, 4, 5, 6])
+        self.assertIn('ISBN', relatorio['rejeitados'][1]['erro'])
+        self.assertEqual(self.livros(), [('Livro A', 3, 3), ('Livro E', 2, 2)])
+
+    def test_importacao_jsonl_em_lotes(self):
+        """Testa a importação JSON Lines dividida em vários lotes"""
+        linhas = [json.dumps({'titulo': f'Livro {i}', 'autores': 'Autor', 'copiasTotal': 1})
+                  for i in range(25)]
+        linhas.insert(10, '{quebrado')
+        conn = sqlite3.connect('biblioteca.db')
+        relatorio = importar_livros(conn, ler_registros(io.StringIO('\n'.join(linhas)), 'jsonl'),
+                                    tamanho_lote=7)
+        conn.close()
+
+        self.assertEqual(relatorio['inseridos'], 25)
+        self.assertEqual(relatorio['rejeitados'], [{'linha': 11, 'erro': 'linha não é um registro válido'}])
+        self.assertEqual(len(self.livros()), 25)
+
+    def test_corpo_da_requisicao_ndjson(self):
+        """Testa o envio do arquivo direto no corpo da requisição"""
+        corpo = '{"titulo": "X", "autores": "Y", "copiasTotal": 2}\n'
+        response = self.client.post('/api/livros/importar', data=corpo,
+                                    content_type='application/x-ndjson')
+        self.assertEqual(json.loads(response.data)['inseridos'], 1)
+
+
+class TestImportacaoUsuarios(TestBiblioteca):
+    """Testes da matrícula em lote de usuários"""
+
+    def setUp(self):
+        super().setUp()
+        self.client.post('/usuarios', data={
+            'nome': 'Já Cadastrado',
+            'matricula': '10000',
+            'tipo': 'ALUNO',
+            'email': 'ja@teste.com'
+        })
+
+    def test_matricula_em_lote_com_duplicados(self):
+        """Testa que duplicados são rejeitados com motivo sem abortar a carga"""
+        conteudo = (
+            'nome,matricula,tipo,email\n'
+            'Ana,10001,ALUNO,ana@teste.com\n'
+            'Bruno,10000,ALUNO,\n'
+            'Carla,10002,PROFESSOR,ja@teste.com\n'
+            'Davi,10001,ALUNO,\n'
+            'Eva,10003,VISITANTE,\n'
+            'Fábio,1234,ALUNO,\n'
+            'Gil,10004,funcionario,\n'
+            'Hugo,10005,ALUNO,ana@teste.com\n'
+        )
+        response = self.client.post('/api/usuarios/importar', data={
+            'arquivo': (io.BytesIO(conteudo.encode()), 'matriculas.csv')
+        }, content_type='multipart/form-data')
+        relatorio = json.loads(response.data)
+
+        self.assertEqual(relatorio['inseridos'], 2)
+        motivos = {r['linha']: r['erro'] for r in relatorio['rejeitados']}
+        self.assertEqual(sorted(motivos), [3, 4, 5, 6, 7, 9])
+        self.assertIn('já cadastrada', motivos[3])
+        self.assertIn('já cadastrado', motivos[4])
+        self.assertIn('repetida no arquivo', motivos[5])
+        self.assertIn('repetido no arquivo', motivos[9])
+
+        conn = sqlite3.connect('biblioteca.db')
+        c = conn.cursor()
+        c.execute('SELECT matricula, tipo FROM usuario ORDER BY matricula')
+        self.assertEqual(c.fetchall(), [('10000', 'ALUNO'), ('10001', 'ALUNO'), ('10004', 'FUNCIONARIO')])
+        conn.close()
+
+    def test_duplicados_entre_lotes(self):
+        """Testa que matrículas repetidas em lotes diferentes são detectadas"""
+        registros = [(i, {'nome': 'N', 'matricula': f'{20000 + i % 5}', 'tipo': 'ALUNO'})
+                     for i in range(1, 13)]
+        conn = sqlite3.connect('biblioteca.db')
+        relatorio = importar_usuarios(conn, registros, tamanho_lote=4)
+        conn.close()
+
+        self.assertEqual(relatorio['inseridos'], 5)
+        self.assertEqual(len(relatorio['rejeitados']), 7)
+
+
+class TestEmprestimoLote(TestBiblioteca):
+    """Testes do empréstimo de vários livros em uma requisição"""
+
+    def setUp(self):
+        super().setUp()
+        conn = sqlite3.connect('biblioteca.db')
+        c = conn.cursor()
+        c.execute("INSERT INTO usuario (nome, matricula, tipo) VALUES ('A', '10101', 'ALUNO')")
+        self.user_id = c.lastrowid
+        c.executemany('INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES (?, ?, ?, ?)',
+                      [('L1', 'A', 2, 2), ('L2', 'A', 1, 1), ('L3', 'A', 1, 0)])
+        conn.commit()
+        conn.close()
+
+    def estado(self):
+        conn = sqlite3.connect('biblioteca.db')
+        c = conn.cursor()
+        c.execute('SELECT copiasDisponiveis FROM livro ORDER BY bookId')
+        copias = [r[0] for r in c.fetchall()]
+        c.execute('SELECT COUNT(*) FROM emprestimo')
+        total = c.fetchone()[0]
+        conn.close()
+        return copias, total
+
+    def test_lote_completo(self):
+        """Testa que todos os livros são emprestados na mesma transação"""
+        response = self.client.post('/api/emprestimos/lote', json={
+            'userId': self.user_id, 'bookIds': [1, 2, 1]
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([e['bookId'] for e in data['emprestados']], [1, 2, 1])
+        self.assertEqual(self.estado(), ([0, 0, 0], 3))
+
+    def test_tudo_ou_nada(self):
+        """Testa que um livro indisponível cancela o lote inteiro"""
+        response = self.client.post('/api/emprestimos/lote', json={
+            'userId': self.user_id, 'bookIds': [1, 3, 99]
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([r['bookId'] for r in data['recusados']], [3, 99])
+        self.assertEqual(self.estado(), ([2, 1, 0], 0))
+
+    def test_sucesso_parcial(self):
+        """Testa que no modo parcial os disponíveis são emprestados"""
+        response = self.client.post('/api/emprestimos/lote', json={
+            'userId': self.user_id, 'bookIds': [2, 2, 3], 'parcial': True
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(len(data['emprestados']), 1)
+        self.assertEqual(len(data['recusados']), 2)
+        self.assertEqual(self.estado(), ([2, 0, 0], 1))
+
+    def test_ids_precisam_ser_inteiros_em_lista(self):
+        """Testa que bookIds como string ou objeto e userId fora de inteiro
+        são recusados em vez de percorridos ou convertidos"""
+        for corpo in ({'userId': self.user_id, 'bookIds': '11'},
+                      {'userId': self.user_id, 'bookIds': {'1': 1}},
+                      {'userId': self.user_id, 'bookIds': [1, '2']},
+                      {'userId': str(self.user_id), 'bookIds': [1]},
+                      {'userId': True, 'bookIds': [1]},
+                      {'userId': [self.user_id], 'bookIds': [1]}):
+            response = self.client.post('/api/emprestimos/lote', json=corpo)
+            self.assertEqual(response.status_code, 400, corpo)
+        self.assertEqual(self.estado(), ([2, 1, 0], 0))
+
+    def test_formulario_com_varios_ids(self):
+        """Testa o formulário de empréstimo com IDs separados por vírgula"""
+        self.client.post('/emprestimos', data={
+            'userId': str(self.user_id),
+            'bookId': '1,2',
+            'tipo': 'ALUNO'
+        })
+        self.assertEqual(self.estado(), ([1, 0, 0], 2))
+
+
+class TestDevolucoes(TestBiblioteca):
+    """Testes da devolução de empréstimos"""
+
+    def setUp(self):
+        super().setUp()
+        conn = sqlite3.connect('biblioteca.db')
+        c = conn.cursor()
+        c.execute("INSERT INTO usuario (nome, matricula, tipo) VALUES ('A', '10101', 'ALUNO')")
+        c.executemany('INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES (?, ?, ?, ?)',
+                      [('L1', 'A', 3, 0), ('L2', 'A', 1, 0)])
+        c.executemany('INSERT INTO emprestimo (userId, bookId, loanDate, dueDate, status) VALUES (1, ?, ?, ?, ?)', [
+            (1, '2024-03-01 10:00:00', '2024-03-15', 'ACTIVE'),
+            (1, '2024-03-01 10:00:00', '2024-03-15', 'OVERDUE'),
+            (1, '2024-03-10 10:00:00', '2024-03-24', 'ACTIVE'),
+            (2, '2024-03-01 10:00:00', '2024-03-15', 'ACTIVE'),
+        ])
+        conn.commit()
+        conn.close()
+
+    def consultar(self, sql):
+        conn = sqlite3.connect('biblioteca.db')
+        c = conn.cursor()
+        c.execute(sql)
+        rows = c.fetchall()
+        conn.close()
+        return rows
+
+    def test_devolucao_em_lote(self):
+        """Testa devolução de vários empréstimos com multa e reposição de estoque"""
+        conn = conectar('biblioteca.db')
+        resultado = devolver(conn, [1, 2, 3, 4, 99], agora=datetime(2024, 3, 20, 9, 0))
+        conn.close()
+
+        multas = {d['loanId']: d['fine'] for d in resultado['devolvidos']}
+        self.assertEqual(multas, {1: 5 * MULTA_DIARIA, 2: 5 * MULTA_DIARIA, 3: 0, 4: 5 * MULTA_DIARIA})
+        self.assertEqual(resultado['ignorados'], [99])
+        self.assertEqual(self.consultar('SELECT copiasDisponiveis FROM livro ORDER BY bookId'), [(3,), (1,)])
+        self.assertEqual(self.consultar("SELECT COUNT(*) FROM emprestimo WHERE status = 'RETURNED' AND returnDate LIKE '2024-03-20%'"), [(4,)])
+
+    def test_devolucao_repetida_ignorada(self):
+        """Testa que devolver duas vezes não repõe o estoque em dobro"""
+        self.client.post('/api/devolucoes', json={'loanIds': [4]})
+        response = self.client.post('/api/devolucoes', json={'loanIds': [4]})
+        data = json.loads(response.data)
+
+        self.assertEqual(data['devolvidos'], [])
+        self.assertEqual(data['ignorados'], [4])
+        self.assertEqual(self.consultar('SELECT copiasDisponiveis FROM livro WHERE bookId = 2'), [(1,)])
+
+    def test_loan_ids_precisam_ser_lista(self):
+        """Testa que loanIds como string ou objeto é recusado em vez de
+        percorrido ("12" devolveria os empréstimos 1 e 2)"""
+        for corpo in ({'loanIds': '12'}, {'loanIds': {'1': 1, '2': 2}}, {'loanIds': 1}, {'loanIds': ['1']}, {}):
+            response = self.client.post('/api/devolucoes', json=corpo)
+            self.assertEqual(response.status_code, 400, corpo)
+        self.assertEqual(self.consultar("SELECT COUNT(*) FROM emprestimo WHERE status = 'RETURNED'"), [(0,)])
+
+    def test_formulario_de_devolucao(self):
+        """Testa a devolução pelo formulário da página de empréstimos"""
+        response = self.client.post('/devolucoes', data={'loanIds': '1,3'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.consultar('SELECT copiasDisponiveis FROM livro WHERE bookId = 1'), [(2,)])
+
+
+class TestVarreduraAtrasos(TestBiblioteca):
+    """Testes da marcação de empréstimos atrasados"""
+
+    def setUp(self):
+        super().setUp()
+        conn = sqlite3.connect('biblioteca.db')
+        c = conn.cursor()
+        c.execute("INSERT INTO usuario (nome, matricula, tipo) VALUES ('A', '10101', 'ALUNO')")
+        c.execute("INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES ('L', 'A', 50, 50)")
+        vencidos = [(f'2024-03-{d:02d}', 'ACTIVE') for d in range(1, 11)]
+        outros = [('2024-03-10', 'RETURNED'), ('2024-03-25', 'ACTIVE'), ('2024-04-30', 'ACTIVE')]
+        c.executemany("INSERT INTO emprestimo (userId, bookId, loanDate, dueDate, status) VALUES (1, 1, '2024-02-20', ?, ?)",
+                      vencidos + outros)
+        conn.commit()
+        conn.close()
+        self.conn = conectar('biblioteca.db')
+
+    def tearDown(self):
+        self.conn.close()
+        super().tearDown()
+
+    def situacao(self):
+        c = self.conn.execute('SELECT dueDate, status, fine FROM emprestimo ORDER BY loanId')
+        return c.fetchall()
+
+    def test_marca_atrasados_em_lotes(self):
+        """Testa que só empréstimos ativos vencidos viram OVERDUE, com multa"""
+        resultado = marcar_atrasados(self.conn, agora=datetime(2024, 3, 11), lote=3)
+        situacao = self.situacao()
+
+        self.assertEqual(resultado['linhas'], 10)
+        self.assertEqual(situacao[0], ('2024-03-01', 'OVERDUE', 10 * MULTA_DIARIA))
+        self.assertEqual(situacao[9], ('2024-03-10', 'OVERDUE', 1 * MULTA_DIARIA))
+        self.assertEqual([s[1] for s in situacao[10:]], ['RETURNED', 'ACTIVE', 'ACTIVE'])
+
+    def test_multa_acumula_e_nao_regrava(self):
+        """Testa que a multa cresce nas rodadas seguintes e nada muda no mesmo dia"""
+        marcar_atrasados(self.conn, agora=datetime(2024, 3, 11))
+        self.assertEqual(marcar_atrasados(self.conn, agora=datetime(2024, 3, 11, 18))['linhas'], 0)
+
+        resultado = marcar_atrasados(self.conn, agora=datetime(2024, 3, 26))
+        situacao = self.situacao()
+        self.assertEqual(resultado['linhas'], 11)
+        self.assertEqual(situacao[0][2], 25 * MULTA_DIARIA)
+        self.assertEqual(situacao[11][1], 'OVERDUE')
+
+    def test_execucao_registrada(self):
+        """Testa que cada rodada fica registrada com duração e linhas alteradas"""
+        marcar_atrasados(self.conn, agora=datetime(2024, 3, 11))
+        data = json.loads(self.client.get('/api/diagnostico').data)
+
+        self.assertEqual(data['tarefas'][0]['tarefa'], 'atrasados')
+        self.assertEqual(data['tarefas'][0]['linhas'], 10)
+        self.assertIn('duracao_ms', data['tarefas'][0])
+
+    def test_varredor_sobrevive_a_falhas(self):
+        """Testa que uma rodada com erro é registrada no log e que a thread
+        continua e roda de novo no intervalo seguinte"""
+        with tempfile.TemporaryDirectory() as pasta:
+            # A pasta do banco ainda não existe: as primeiras rodadas falham
+            path = os.path.join(pasta, 'dados', 'varredor.db')
+            with self.assertLogs('tarefas', 'ERROR') as logs:
+                parar = iniciar_varredor(path, 0.01)
+                try:
+                    limite = time.monotonic() + 5
+                    while not logs.output and time.monotonic() < limite:
+                        time.sleep(0.01)
+                    os.mkdir(os.path.dirname(path))
+                    rodadas = 0
+                    while not rodadas and time.monotonic() < limite:
+                        time.sleep(0.01)
+                        if os.path.exists(path):
+                            conn = sqlite3.connect(path)
+                            try:
+                                rodadas = conn.execute('SELECT COUNT(*) FROM tarefa_execucao').fetchone()[0]
+                            except sqlite3.OperationalError:
+                                pass
+                            conn.close()
+                finally:
+                    parar.set()
+            time.sleep(0.05)
+        self.assertIn('falha na varredura de atrasos', logs.output[0])
+        self.assertGreater(rodadas, 0)
+
+
+class TestBuscaLivros(TestBiblioteca):
+    """Testes da busca textual no catálogo"""
+
+    def setUp(self):
+        super().setUp()
+        conn = sqlite3.connect('biblioteca.db')
+        conn.executemany('INSERT INTO livro (titulo, autores, ISBN, copiasTotal, copiasDisponiveis) VALUES (?, ?, ?, 1, 1)', [
+            ('Introdução à Programação', 'Ana Souza', '9788575221112'),
+            ('Programação Funcional em Python', 'Bruno Lima', None),
+            ('História do Brasil', 'Carla Programa', None),
+            ('Cálculo Volume 1', 'James Stewart', '8522112584'),
+        ])
+        conn.commit()
+        conn.close()
+
+    def buscar(self, q):
+        response = self.client.get(f'/api/livros/busca?q={q}')
+        return [r['titulo'] for r in json.loads(response.data)['data']]
+
+    def test_busca_por_prefixo_sem_acentos(self):
+        """Testa busca por prefixo ignorando acentos e maiúsculas"""
+        self.assertEqual(sorted(self.buscar('programacao')),
+                         ['Introdução à Programação', 'Programação Funcional em Python'])
+        self.assertEqual(len(self.buscar('progr')), 3)
+        self.assertEqual(self.buscar('calc'), ['Cálculo Volume 1'])
+
+    def test_busca_com_varios_termos(self):
+        """Testa que todos os termos precisam aparecer"""
+        self.assertEqual(self.buscar('prog pyth'), ['Programação Funcional em Python'])
+        self.assertEqual(self.buscar('stewart'), ['Cálculo Volume 1'])
+
+    def test_busca_por_isbn(self):
+        """Testa busca exata por ISBN, com ou sem hífens"""
+        self.assertEqual(self.buscar('978-85-7522-111-2'), ['Introdução à Programação'])
+        self.assertEqual(self.buscar('8522112584'), ['Cálculo Volume 1'])
+
+    def test_indice_acompanha_alteracoes(self):
+        """Testa que triggers mantêm o índice em dia com updates e deletes"""
+        conn = sqlite3.connect('biblioteca.db')
+        conn.execute("UPDATE livro SET titulo = 'Geografia Geral' WHERE titulo = 'História do Brasil'")
+        conn.execute("DELETE FROM livro WHERE titulo = 'Cálculo Volume 1'")
+        conn.commit()
+        conn.close()
+
+        self.assertEqual(self.buscar('historia'), [])
+        self.assertEqual(self.buscar('geografia'), ['Geografia Geral'])
+        self.assertEqual(self.buscar('calculo'), [])
+
+    def test_busca_na_pagina_de_livros(self):
+        """Testa o campo de busca da página de livros"""
+        html = self.client.get('/livros?q=python').get_data(as_text=True)
+        self.assertIn('Programação Funcional em Python', html)
+        self.assertNotIn('História do Brasil', html)
+
+    def test_busca_sem_termo(self):
+        """Testa que a busca exige o parâmetro q"""
+        self.assertEqual(self.client.get('/api/livros/busca').status_code, 400)
+
+    def test_relevancia_em_todos_os_resultados(self):
+        """Testa que todos os livros que casam são ordenados por relevância,
+        com o título exato na frente, e que a paginação vai até o último"""
+        conn = sqlite3.connect('biblioteca.db')
+        conn.executemany('INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES (?, ?, 1, 1)', [
+            (f'Guia de Redes {i} com exemplos práticos e exercícios resolvidos', 'Autor') for i in range(600)
+        ])
+        conn.execute("INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES ('Redes', 'Autor', 1, 1)")
+        conn.commit()
+        conn.close()
+
+        primeira = self.client.get('/api/livros/busca?q=redes').get_json()
+        self.assertEqual(primeira['data'][0]['titulo'], 'Redes')
+        self.assertTrue(primeira['pagination']['has_more'])
+        penultima = self.client.get('/api/livros/busca?q=redes&page=30').get_json()
+        self.assertTrue(penultima['pagination']['has_more'])
+        ultima = self.client.get('/api/livros/busca?q=redes&page=31').get_json()
+        self.assertEqual(len(ultima['data']), 1)
+        self.assertFalse(ultima['pagination']['has_more'])
+
+    def test_busca_curta_pagina_sem_relevancia(self):
+        """Testa que buscas de uma ou duas letras seguem a ordem do catálogo
+        e continuam paginando até o último livro"""
+        conn = sqlite3.connect('biblioteca.db')
+        conn.executemany('INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES (?, ?, 1, 1)', [
+            (f'Redes {i}', 'Autor') for i in range(30)
+        ])
+        conn.commit()
+        conn.close()
+
+        primeira = self.client.get('/api/livros/busca?q=re').get_json()
+        self.assertEqual(primeira['data'][0]['titulo'], 'Redes 0')
+        self.assertTrue(primeira['pagination']['has_more'])
+        segunda = self.client.get('/api/livros/busca?q=re&page=2').get_json()
+        self.assertEqual([r['titulo'] for r in segunda['data']], [f'Redes {i}' for i in range(20, 30)])
+        self.assertFalse(segunda['pagination']['has_more'])
+
+
+class TestBuscaUsuarios(TestBiblioteca):
+    """Testes do autocompletar de usuários"""
+
+    def setUp(self):
+        super().setUp()
+        conn = sqlite3.connect('biblioteca.db')
+        conn.executemany('INSERT INTO usuario (nome, matricula, tipo, email) VALUES (?, ?, ?, ?)', [
+            ('José da Silva', '12345', 'ALUNO', 'jose@teste.com'),
+            ('Joana Souza', '12399', 'PROFESSOR', None),
+            ('Márcia Joaquina', '54321', 'FUNCIONARIO', None),
+        ])
+        conn.commit()
+        conn.close()
+
+    def buscar(self, q):
+        response = self.client.get(f'/api/usuarios/busca?q={q}')
+        return json.loads(response.data)['data']
+
+    def test_prefixo_de_matricula(self):
+        """Testa busca por prefixo de matrícula em ordem"""
+        self.assertEqual([u['matricula'] for u in self.buscar('123')], ['12345', '12399'])
+        self.assertEqual(self.buscar('5'), [{'id': 3, 'nome': 'Márcia Joaquina', 'matricula': '54321', 'tipo': 'FUNCIONARIO'}])
+
+    def test_prefixo_de_nome_sem_acentos(self):
+        """Testa busca por prefixo de qualquer palavra do nome, sem acentos"""
+        self.assertEqual(sorted(u['nome'] for u in self.buscar('jo')),
+                         ['Joana Souza', 'José da Silva', 'Márcia Joaquina'])
+        self.assertEqual([u['nome'] for u in self.buscar('marc')], ['Márcia Joaquina'])
+        self.assertEqual([u['nome'] for u in self.buscar('JOSÉ S')], ['José da Silva'])
+
+    def test_nao_expoe_email(self):
+        """Testa que só as colunas necessárias são devolvidas"""
+        self.assertNotIn('email', self.buscar('jose')[0])
+
+    def test_cache_invalidado_por_cadastro(self):
+        """Testa que o cache de prefixos não devolve resultado desatualizado"""
+        self.assertEqual(len(self.buscar('jo')), 3)
+        hits = cache_usuarios.hits
+        self.assertEqual(len(self.buscar('jo')), 3)
+        self.assertEqual(cache_usuarios.hits, hits + 1)
+
+        self.client.post('/usuarios', data={'nome': 'João Novo', 'matricula': '77777', 'tipo': 'ALUNO'})
+        self.assertEqual(len(self.buscar('jo')), 4)
+
+    def test_limite_entre_1_e_50(self):
+        """Testa que limite zero ou negativo vira 1, em vez de LIMIT -1 (tabela inteira)"""
+        for limite in (-1, 0):
+            data = json.loads(self.client.get(f'/api/usuarios/busca?q=jo&limite={limite}').data)['data']
+            self.assertEqual(len(data), 1, limite)
+        data = json.loads(self.client.get('/api/usuarios/busca?q=jo&limite=500').data)['data']
+        self.assertEqual(len(data), 3)
+
+    def test_cache_nao_mistura_outros_alfabetos(self):
+        """Testa que buscas só com letras fora do ASCII têm chaves próprias
+        no cache, e que variações de acento e caixa dividem a mesma"""
+        conn = sqlite3.connect('biblioteca.db')
+        conn.executemany('INSERT INTO usuario (nome, matricula, tipo) VALUES (?, ?, ?)', [
+            ('日本 太郎', '20001', 'ALUNO'),
+            ('中国 明', '20002', 'ALUNO'),
+        ])
+        conn.commit()
+        conn.close()
+
+        self.assertEqual([u['nome'] for u in self.buscar('日本')], ['日本 太郎'])
+        self.assertEqual([u['nome'] for u in self.buscar('中国')], ['中国 明'])
+        self.assertEqual([u['nome'] for u in self.buscar('MÁRC')], ['Márcia Joaquina'])
+        hits = cache_usuarios.estatisticas()['hits']
+        self.assertEqual([u['nome'] for u in self.buscar('marc')], ['Márcia Joaquina'])
+        self.assertEqual(cache_usuarios.estatisticas()['hits'], hits + 1)
+
+
+class TestCacheRelatorio(TestBiblioteca):
+    """Testes do cache de respostas do relatório"""
+
+    def setUp(self):
+        super().setUp()
+        conn = sqlite3.connect('biblioteca.db')
+        c = conn.cursor()
+        c.execute("INSERT INTO usuario (nome, matricula, tipo) VALUES ('A', '10101', 'ALUNO')")
+        c.execute("INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES ('L', 'A', 50, 50)")
+        c.execute("INSERT INTO emprestimo (userId, bookId, loanDate, dueDate) VALUES (1, 1, '2024-03-01', '2024-03-15')")
+        conn.commit()
+        conn.close()
+
+    def relatorio(self, query=''):
+        return json.loads(self.client.get('/api/relatorio/emprestimos' + query).data)
+
+    def test_leitura_repetida_vem_do_cache(self):
+        """Testa que a mesma consulta é servida da memória na segunda vez"""
+        hits = cache_relatorio.hits
+        primeira = self.relatorio('?start=2024-03-01')
+        segunda = self.relatorio('?start=2024-03-01')
+
+        self.assertEqual(primeira, segunda)
+        self.assertEqual(cache_relatorio.hits, hits + 1)
+
+    def test_gravacao_invalida_cache(self):
+        """Testa que gravações em qualquer das três tabelas invalidam o cache"""
+        self.assertEqual(len(self.relatorio()['data']), 1)
+
+        conn = sqlite3.connect('biblioteca.db')
+        conn.execute("INSERT INTO emprestimo (userId, bookId, loanDate, dueDate) VALUES (1, 1, '2024-03-02', '2024-03-16')")
+        conn.commit()
+        self.assertEqual(len(self.relatorio()['data']), 2)
+
+        conn.execute("UPDATE usuario SET matricula = '20202' WHERE id = 1")
+        conn.commit()
+        self.assertEqual(self.relatorio()['data'][0]['matricula'], '20202')
+
+        conn.execute("UPDATE livro SET titulo = 'Outro' WHERE bookId = 1")
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.relatorio()['data'][0]['titulo'], 'Outro')
+
+    def test_tamanho_limitado(self):
+        """Testa o descarte LRU ao passar da capacidade"""
+        capacidade = cache_relatorio.capacidade
+        cache_relatorio.capacidade = 2
+        try:
+            for pagina in (1, 2, 3):
+                self.relatorio(f'?page={pagina}')
+            estatisticas = cache_relatorio.estatisticas()
+        finally:
+            cache_relatorio.capacidade = capacidade
+
+        self.assertEqual(estatisticas['entradas'], 2)
+        self.assertGreaterEqual(estatisticas['evictions'], 1)
+
+
+class TestGetCondicional(TestBiblioteca):
+    """Testes de ETag e respostas 304"""
+
+    def test_etag_e_304(self):
+        """Testa que If-None-Match com o ETag atual devolve 304 sem corpo"""
+        for url in ('/usuarios', '/livros', '/emprestimos', '/api/relatorio/emprestimos'):
+            response = self.client.get(url)
+            etag = response.headers['ETag']
+            self.assertIsNotNone(response.last_modified)
+
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304, url)
+            self.assertEqual(response.data, b'')
+
+    def test_gravacao_muda_etag(self):
+        """Testa que um cadastro invalida o ETag da listagem"""
+        etag = self.client.get('/livros').headers['ETag']
+        self.client.post('/livros', data={'titulo': 'Novo', 'autores': 'A', 'copiasTotal': '1'})
+
+        response = self.client.get('/livros', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Novo', response.get_data(as_text=True))
+
+    def test_etag_depende_da_pagina(self):
+        """Testa que parâmetros diferentes geram ETags diferentes"""
+        primeira = self.client.get('/api/relatorio/emprestimos?page=1').headers['ETag']
+        segunda = self.client.get('/api/relatorio/emprestimos?page=2').headers['ETag']
+        self.assertNotEqual(primeira, segunda)
+
+    def test_etag_de_tabela_nao_relacionada(self):
+        """Testa que gravar em usuario não invalida a listagem de livros"""
+        etag = self.client.get('/livros').headers['ETag']
+        self.client.post('/usuarios', data={'nome': 'A', 'matricula': '12345', 'tipo': 'ALUNO'})
+
+        response = self.client.get('/livros', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+
+class TestMigracoes(TestBiblioteca):
+    """Testes do schema criado sob demanda por migrações"""
+
+    def test_importar_app_nao_acessa_banco(self):
+        """Testa que importar app não abre nem cria o banco"""
+        raiz = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+        script = (
+            "import sqlite3\n"
+            "abertas = []\n"
+            "original = sqlite3.connect\n"
+            "sqlite3.connect = lambda *a, **k: abertas.append(a) or original(*a, **k)\n"
+            "import app\n"
+            "print(len(abertas))\n"
+        )
+        with tempfile.TemporaryDirectory() as pasta:
+            saida = subprocess.run([sys.executable, '-c', script], cwd=pasta,
+                                   env=dict(os.environ, PYTHONPATH=raiz),
+                                   capture_output=True, text=True, check=True)
+            self.assertEqual(saida.stdout.strip(), '0')
+            self.assertEqual(os.listdir(pasta), [])
+
+    def test_primeira_conexao_aplica_migracoes(self):
+        """Testa que a primeira conexão a um banco novo cria o schema"""
+        with tempfile.TemporaryDirectory() as pasta:
+            conn = conectar(os.path.join(pasta, 'novo.db'))
+            versao = conn.execute('PRAGMA user_version').fetchone()[0]
+            tabelas = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            conn.close()
+        self.assertEqual(versao, SCHEMA_VERSAO)
+        self.assertTrue({'usuario', 'livro', 'emprestimo', 'contador'} <= tabelas)
+
+    def test_schema_atual_nao_executa_comandos(self):
+        """Testa que migrar só lê user_version quando o schema está em dia"""
+        conn = sqlite3.connect('biblioteca.db')
+        comandos = []
+        conn.set_trace_callback(comandos.append)
+        versao = migrar(conn)
+        conn.close()
+        self.assertEqual(versao, SCHEMA_VERSAO)
+        self.assertEqual(comandos, ['PRAGMA user_version'])
+
+    def test_banco_antigo_recebe_migracoes(self):
+        """Testa que um banco com o schema do biblioteca.db distribuído é
+        atualizado e que devolução e varredura de atrasos funcionam nele"""
+        with tempfile.TemporaryDirectory() as pasta:
+            conn = sqlite3.connect(os.path.join(pasta, 'antigo.db'))
+            for comando in ESQUEMA_ANTIGO:
+                conn.execute(comando)
+            conn.execute("INSERT INTO usuario (nome, matricula, tipo) VALUES ('A', '10101', 'ALUNO')")
+            conn.execute("INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES ('L', 'X', 2, 0)")
+            conn.execute("INSERT INTO emprestimo (userId, bookId, loanDate, dueDate) VALUES (1, 1, '2024-03-01 10:00:00', '2024-03-08')")
+            conn.execute("INSERT INTO emprestimo (userId, bookId, loanDate, dueDate) VALUES (1, 1, '2024-03-02 10:00:00', '2024-03-09')")
+            conn.commit()
+
+            self.assertEqual(migrar(conn), SCHEMA_VERSAO)
+            colunas = {r[1] for r in conn.execute('PRAGMA table_info(emprestimo)')}
+            total = conn.execute("SELECT valor FROM contador WHERE nome = 'emprestimos'").fetchone()[0]
+            diario = conn.execute('SELECT SUM(total) FROM emprestimo_diario').fetchone()[0]
+            devolver(conn, [1], agora=datetime(2024, 3, 10, 9, 0))
+            atrasados = marcar_atrasados(conn, agora=datetime(2024, 3, 11))['linhas']
+            linhas = conn.execute('SELECT status, returnDate IS NOT NULL, fine > 0 FROM emprestimo ORDER BY loanId').fetchall()
+            conn.close()
+        self.assertTrue({'copyId', 'returnDate', 'fine'} <= colunas)
+        self.assertEqual((total, diario), (2, 2))
+        self.assertEqual(atrasados, 1)
+        self.assertEqual(linhas, [('RETURNED', 1, 1), ('OVERDUE', 0, 1)])
+
+    def test_passo_ja_aplicado_por_outro_processo(self):
+        """Testa que a versão é relida dentro de cada BEGIN IMMEDIATE e que
+        passos já aplicados (ex.: por outro processo) não rodam de novo"""
+        conn = sqlite3.connect('biblioteca.db')
+        comandos = []
+        conn.set_trace_callback(comandos.append)
+        aplicar_migracoes(conn)
+        conn.close()
+
+        self.assertEqual(comandos, ['BEGIN IMMEDIATE', 'PRAGMA user_version', 'ROLLBACK'] * SCHEMA_VERSAO)
+
+
+class TestMetricas(TestBiblioteca):
+    """Testes da instrumentação de SQL e do endpoint /metrics"""
+
+    def test_conexao_instrumentada_mede_comandos(self):
+        """Testa que cada comando é contado com suas linhas ao terminar"""
+        comandos = []
+        conn = ConexaoInstrumentada(sqlite3.connect(':memory:'),
+                                    lambda sql, params, duracao, linhas: comandos.append((sql, linhas)))
+        conn.execute('CREATE TABLE t (x)')
+        conn.executemany('INSERT INTO t VALUES (?)', [(1,), (2,), (3,)])
+        c = conn.cursor()
+        c.execute('SELECT x FROM t')
+        self.assertEqual([r[0] for r in c], [1, 2, 3])
+        c.execute('SELECT x FROM t WHERE x > ?', (1,))
+        c.fetchone()
+        conn.encerrar()
+
+        self.assertEqual(conn.consultas, 4)
+        self.assertGreater(conn.segundos, 0)
+        self.assertEqual([linhas for _, linhas in comandos], [0, 3, 3, 1])
+
+    def test_server_timing_separa_etapas(self):
+        """Testa que o cabeçalho Server-Timing traz SQL, template e total"""
+        response = self.client.get('/usuarios')
+        timing = response.headers['Server-Timing']
+        for etapa in ('sql;dur=', 'render;dur=', 'json;dur=', 'total;dur='):
+            self.assertIn(etapa, timing)
+        self.assertRegex(timing, r'desc="[1-9]\d* consultas"')
+
+    def test_metrics_formato_prometheus(self):
+        """Testa que /metrics expõe contadores e histograma por rota"""
+        metricas.limpar()
+        self.client.get('/usuarios')
+        self.client.get('/api/relatorio/emprestimos')
+        response = self.client.get('/metrics')
+        texto = response.data.decode()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertIn('biblioteca_requisicoes_total{rota="/usuarios",metodo="GET",status="200"} 1', texto)
+        self.assertIn('biblioteca_requisicao_segundos_count{rota="/api/relatorio/emprestimos"} 1', texto)
+        self.assertIn('biblioteca_requisicao_segundos_bucket{rota="/usuarios",le="+Inf"} 1', texto)
+        self.assertIn('biblioteca_etapa_segundos_total{rota="/api/relatorio/emprestimos",etapa="json"}', texto)
+        self.assertIn('biblioteca_pool_conexoes 1', texto)
+
+    def test_metrics_restrito_a_maquina_local(self):
+        """Testa que /metrics recusa acessos de outras máquinas"""
+        response = self.client.get('/metrics', environ_base={'REMOTE_ADDR': '10.0.0.5'})
+        self.assertEqual(response.status_code, 403)
+
+
+class TestConsultasLentas(TestBiblioteca):
+    """Testes do log de consultas lentas"""
+
+    def setUp(self):
+        super().setUp()
+        consultas_lentas.limpar()
+        self.app.config['CONSULTA_LENTA_MS'] = 0
+
+    def tearDown(self):
+        self.app.config.pop('CONSULTA_LENTA_MS', None)
+        consultas_lentas.limpar()
+        super().tearDown()
+
+    def consulta_relatorio(self):
+        dados = self.client.get('/admin/consultas-lentas').get_json()
+        return [e for e in dados['consultas'] if 'ORDER BY e.loanDate DESC' in e['sql']]
+
+    def test_normalizar_sql(self):
+        """Testa que literais e listas de marcadores são normalizados"""
+        self.assertEqual(
+            normalizar_sql("SELECT a FROM t1\n WHERE x IN (?, ?,?) AND y = 'it''s' AND z > 10.5 LIMIT 20"),
+            "SELECT a FROM t1 WHERE x IN (?, ...) AND y = ? AND z > ? LIMIT ?")
+
+    def test_relatorio_registrado_com_plano(self):
+        """Testa que a consulta do relatório é registrada com plano e parâmetros"""
+        self.client.get('/api/relatorio/emprestimos?start=2024-01-01&end=2024-01-31')
+        entradas = self.consulta_relatorio()
+
+        self.assertEqual(len(entradas), 1)
+        entrada = entradas[0]
+        self.assertEqual(entrada['parametros'], ['str', 'str', 'int', 'int'])
+        self.assertEqual(entrada['rotas'], ['/api/relatorio/emprestimos'])
+        self.assertTrue(any('idx_emprestimo_loanDate' in p for p in entrada['plano']))
+        self.assertFalse(entrada['varredura'])
+
+    def test_variacoes_agrupadas_pela_digital(self):
+        """Testa que o mesmo comando com outros valores soma na mesma entrada"""
+        self.client.get('/api/relatorio/emprestimos?start=2024-01-01&end=2024-01-31')
+        self.client.get('/api/relatorio/emprestimos?start=2024-02-01&end=2024-02-28')
+        entradas = self.consulta_relatorio()
+
+        self.assertEqual(len(entradas), 1)
+        self.assertEqual(entradas[0]['execucoes'], 2)
+
+    def test_abaixo_do_limite_nao_registra(self):
+        """Testa que consultas rápidas não entram no log"""
+        self.app.config['CONSULTA_LENTA_MS'] = 10000
+        self.client.get('/api/relatorio/emprestimos')
+        self.assertEqual(self.client.get('/admin/consultas-lentas').get_json()['consultas'], [])
+
+    def test_limpar_e_acesso_local(self):
+        """Testa que DELETE esvazia o log e que outras máquinas são recusadas"""
+        self.client.get('/usuarios')
+        self.assertEqual(self.client.delete('/admin/consultas-lentas').status_code, 204)
+        self.assertEqual(self.client.get('/admin/consultas-lentas').get_json()['consultas'], [])
+        response = self.client.get('/admin/consultas-lentas', environ_base={'REMOTE_ADDR': '10.0.0.5'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_plano_so_na_primeira_vez_e_no_intervalo(self):
+        """Testa que o EXPLAIN roda ao criar a entrada e depois só quando o intervalo vence"""
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE t (a INTEGER)')
+        sql = 'SELECT a FROM t WHERE a = ?'
+
+        registro = ConsultasLentas(intervalo_plano=3600)
+        explicados = []
+        plano = registro._plano
+        registro._plano = lambda *args: explicados.append(args[1]) or plano(*args)
+        for valor in range(3):
+            registro.registrar(conn, sql, (valor,), 0.5, 0)
+        self.assertEqual(len(explicados), 1)
+        entrada = registro.listar()[0]
+        self.assertEqual(entrada['execucoes'], 3)
+        self.assertTrue(entrada['varredura'])
+
+        registro.intervalo_plano = 0
+        registro.registrar(conn, sql, (3,), 0.5, 0)
+        self.assertEqual(len(explicados), 2)
+
+        registro.limpar()
+        registro.intervalo_plano = 3600
+        registro.registrar(conn, sql, (4,), 0.5, 0)
+        self.assertEqual(len(explicados), 3)
+        conn.close()
+
+
+class TestAnalise(TestBiblioteca):
+    """Testes dos agregados diários e dos endpoints de análise"""
+
+    def setUp(self):
+        super().setUp()
+        self.conn = conectar('biblioteca.db')
+        self.conn.executemany('INSERT INTO usuario (nome, matricula, tipo) VALUES (?, ?, ?)',
+                              [('Aluno', '10101', 'ALUNO'), ('Prof', '20202', 'PROFESSOR')])
+        self.conn.executemany('INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES (?, ?, 10, 10)',
+                              [('Livro A', 'X'), ('Livro B', 'Y')])
+        self.conn.commit()
+        # Aluno: 3 em janeiro (um devolvido com atraso), 1 em fevereiro; professor: 1 em janeiro
+        self.ids = [
+            emprestar(self.conn, 1, 1, 'ALUNO', agora=datetime(2024, 1, 10, 9)),
+            emprestar(self.conn, 1, 2, 'ALUNO', agora=datetime(2024, 1, 10, 15)),
+            emprestar(self.conn, 1, 1, 'ALUNO', agora=datetime(2024, 1, 20, 10)),
+            emprestar(self.conn, 2, 1, 'PROFESSOR', agora=datetime(2024, 1, 22, 10)),
+            emprestar(self.conn, 1, 2, 'ALUNO', agora=datetime(2024, 2, 5, 10)),
+        ]
+        devolver(self.conn, [self.ids[0]], agora=datetime(2024, 1, 15))
+        devolver(self.conn, [self.ids[1]], agora=datetime(2024, 2, 1))
+
+    def tearDown(self):
+        self.conn.close()
+        super().tearDown()
+
+    def agregado(self):
+        c = self.conn.execute('''
+            SELECT dia, status, tipo, total, atrasados FROM emprestimo_diario
+            WHERE total != 0 ORDER BY 1, 2, 3
+        ''')
+        return c.fetchall()
+
+    def recalculado(self):
+        c = self.conn.execute('''
+            SELECT substr(e.loanDate, 1, 10), e.status, u.tipo, COUNT(*),
+                   SUM(e.status = 'OVERDUE' OR (e.status = 'RETURNED' AND date(e.returnDate) > e.dueDate))
+            FROM emprestimo e JOIN usuario u ON u.id = e.userId
+            GROUP BY 1, 2, 3 ORDER BY 1, 2, 3
+        ''')
+        return c.fetchall()
+
+    def test_agregado_acompanha_alteracoes(self):
+        """Testa que os agregados batem com a contagem direta após cada mudança"""
+        self.assertEqual(self.agregado(), self.recalculado())
+        marcar_atrasados(self.conn, agora=datetime(2024, 3, 1))
+        self.assertEqual(self.agregado(), self.recalculado())
+        devolver(self.conn, [self.ids[2]], agora=datetime(2024, 3, 2))
+        self.conn.execute("UPDATE emprestimo SET loanDate = '2024-01-11 08:00:00' WHERE loanId = ?", (self.ids[3],))
+        self.conn.execute('DELETE FROM emprestimo WHERE loanId = ?', (self.ids[4],))
+        self.conn.commit()
+        self.assertEqual(self.agregado(), self.recalculado())
+
+        por_livro = self.conn.execute('''
+            SELECT dia, bookId, total FROM emprestimo_diario_livro WHERE total != 0 ORDER BY 1, 2
+        ''').fetchall()
+        direto = self.conn.execute('''
+            SELECT substr(loanDate, 1, 10), bookId, COUNT(*) FROM emprestimo GROUP BY 1, 2 ORDER BY 1, 2
+        ''').fetchall()
+        self.assertEqual(por_livro, direto)
+
+    def test_mudanca_de_tipo_do_usuario(self):
+        """Testa que mudar o tipo do usuário move os empréstimos dele de balde,
+        e que devoluções e exclusões depois disso saem do balde certo"""
+        self.conn.execute("UPDATE usuario SET tipo = 'PROFESSOR' WHERE id = 1")
+        self.conn.commit()
+        self.assertEqual(self.agregado(), self.recalculado())
+
+        devolver(self.conn, [self.ids[2]], agora=datetime(2024, 1, 25))
+        self.conn.execute('DELETE FROM emprestimo WHERE loanId = ?', (self.ids[4],))
+        self.conn.commit()
+        self.assertEqual(self.agregado(), self.recalculado())
+        self.assertFalse(self.conn.execute('SELECT 1 FROM emprestimo_diario WHERE total < 0').fetchall())
+
+    def test_mudanca_de_tipo_inclui_arquivados(self):
+        """Testa que os empréstimos arquivados também mudam de tipo"""
+        arquivar_emprestimos(self.conn, dias=30, agora=datetime(2024, 6, 1))
+        self.conn.execute("UPDATE usuario SET tipo = 'FUNCIONARIO' WHERE id = 1")
+        self.conn.commit()
+
+        data = self.client.get('/api/analise/emprestimos?tipo=FUNCIONARIO').get_json()['data']
+        self.assertEqual([(d['periodo'], d['total']) for d in data], [('2024-01', 3), ('2024-02', 1)])
+        self.assertEqual(self.client.get('/api/analise/emprestimos?tipo=ALUNO').get_json()['data'], [])
+
+    def test_mudanca_de_tipo_invalida_etag(self):
+        """Testa que mudar o tipo de um usuário invalida o ETag das análises,
+        já que os empréstimos dele mudam de balde"""
+        urls = ('/api/analise/emprestimos?tipo=ALUNO', '/api/analise/atrasos?tipo=ALUNO',
+                '/api/analise/picos?tipo=ALUNO')
+        etags = [self.client.get(url).headers['ETag'] for url in urls]
+        self.conn.execute("UPDATE usuario SET tipo = 'PROFESSOR' WHERE id = 1")
+        self.conn.commit()
+
+        for url, etag in zip(urls, etags):
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200, url)
+            self.assertNotEqual(response.headers['ETag'], etag, url)
+
+    def test_emprestimos_por_mes(self):
+        """Testa a série mensal com a divisão por status e os filtros"""
+        data = self.client.get('/api/analise/emprestimos?agrupar=mes').get_json()['data']
+        self.assertEqual([(d['periodo'], d['total']) for d in data], [('2024-01', 4), ('2024-02', 1)])
+        self.assertEqual(data[0]['por_status'], {'ACTIVE': 2, 'RETURNED': 2})
+
+        data = self.client.get('/api/analise/emprestimos?tipo=PROFESSOR').get_json()['data']
+        self.assertEqual([(d['periodo'], d['total']) for d in data], [('2024-01', 1)])
+
+        data = self.client.get('/api/analise/emprestimos?bookId=2&agrupar=dia').get_json()['data']
+        self.assertEqual(data, [{'periodo': '2024-01-10', 'total': 1}, {'periodo': '2024-02-05', 'total': 1}])
+
+    def test_taxa_de_atraso(self):
+        """Testa que a taxa conta atrasados e devolvidos depois do prazo"""
+        marcar_atrasados(self.conn, agora=datetime(2024, 2, 4))
+        data = self.client.get('/api/analise/atrasos?agrupar=mes&end=2024-01-31').get_json()['data']
+        # janeiro: devolvido em 01/02 com prazo 24/01, e o de 20/01 vencido em 03/02
+        self.assertEqual(data, [{'periodo': '2024-01', 'total': 4, 'atrasados': 2, 'taxa': 0.5}])
+
+    def test_dias_de_pico(self):
+        """Testa os dias com mais empréstimos e a média por dia da semana"""
+        data = self.client.get('/api/analise/picos?limite=2').get_json()
+        self.assertEqual(data['dias'], [{'dia': '2024-01-10', 'total': 2}, {'dia': '2024-01-20', 'total': 1}])
+        quarta = next(d for d in data['dia_semana'] if d['dia_semana'] == 'quarta')
+        self.assertEqual(quarta, {'dia_semana': 'quarta', 'total': 2, 'media': 2.0})
+
+    def test_parametros_invalidos(self):
+        """Testa que parâmetros inválidos retornam 400"""
+        for url in ('/api/analise/emprestimos?agrupar=hora', '/api/analise/atrasos?tipo=VISITANTE',
+                    '/api/analise/picos?start=31/01/2024', '/api/analise/emprestimos?tipo=ALUNO&bookId=1'):
+            self.assertEqual(self.client.get(url).status_code, 400, url)
+
+
+class TestRanking(TestBiblioteca):
+    """Testes do ranking de livros e usuários mais ativos"""
+
+    def setUp(self):
+        super().setUp()
+        self.conn = conectar('biblioteca.db')
+        self.conn.executemany('INSERT INTO usuario (nome, matricula, tipo) VALUES (?, ?, ?)',
+                              [(f'Usuário {i}', f'1000{i}', 'ALUNO') for i in range(1, 5)])
+        self.conn.executemany('INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES (?, ?, 50, 50)',
+                              [(f'Livro {i}', 'X') for i in range(1, 6)])
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+        super().tearDown()
+
+    def emprestar_em(self, dia, userId, bookId):
+        return emprestar(self.conn, userId, bookId, 'ALUNO', agora=datetime.strptime(dia, '%Y-%m-%d'))
+
+    def test_topo_por_livro_e_usuario(self):
+        """Testa a ordem do ranking, com empate desfeito pelo menor ID"""
+        for userId, bookId in ((1, 3), (2, 3), (3, 3), (1, 2), (2, 2), (1, 5)):
+            self.emprestar_em('2024-01-10', userId, bookId)
+
+        data = self.client.get('/api/relatorio/ranking?entidade=livros&dias=0&n=2').get_json()['data']
+        self.assertEqual([(d['posicao'], d['titulo'], d['emprestimos']) for d in data],
+                         [(1, 'Livro 3', 3), (2, 'Livro 2', 2)])
+
+        data = self.client.get('/api/relatorio/ranking?entidade=usuarios&dias=0').get_json()['data']
+        self.assertEqual([(d['matricula'], d['emprestimos']) for d in data],
+                         [('10001', 3), ('10002', 2), ('10003', 1)])
+
+    def test_atualizacao_incremental(self):
+        """Testa que novos empréstimos entram sem reler os agregados"""
+        ranking = Ranking('livros', 0, k=2)
+        self.emprestar_em('2024-01-10', 1, 1)
+        self.emprestar_em('2024-01-10', 1, 1)
+        self.emprestar_em('2024-01-10', 1, 2)
+        self.assertEqual(ranking.atualizar(self.conn), [(1, 2), (2, 1)])
+
+        for _ in range(3):
+            self.emprestar_em('2024-01-11', 2, 4)
+        comandos = []
+        self.conn.set_trace_callback(comandos.append)
+        self.assertEqual(ranking.atualizar(self.conn), [(4, 3), (1, 2)])
+        self.conn.set_trace_callback(None)
+        self.assertFalse(any('emprestimo_diario_livro' in c for c in comandos))
+
+    def test_janela_desliza_com_o_dia(self):
+        """Testa que dias fora da janela deixam de contar"""
+        self.emprestar_em('2024-01-01', 1, 1)
+        self.emprestar_em('2024-01-01', 1, 1)
+        self.emprestar_em('2024-01-05', 1, 2)
+        self.emprestar_em('2024-01-06', 1, 3)
+        ranking = Ranking('livros', 7)
+        self.assertEqual(ranking.atualizar(self.conn, hoje=date(2024, 1, 7)), [(1, 2), (2, 1), (3, 1)])
+        self.assertEqual(ranking.atualizar(self.conn, hoje=date(2024, 1, 10)), [(2, 1), (3, 1)])
+
+    def test_exclusao_invalida_contagens(self):
+        """Testa que excluir um empréstimo força a recontagem"""
+        ranking = Ranking('usuarios', 0)
+        loanId = self.emprestar_em('2024-01-10', 1, 1)
+        self.emprestar_em('2024-01-10', 2, 1)
+        self.emprestar_em('2024-01-10', 2, 2)
+        self.assertEqual(ranking.atualizar(self.conn), [(2, 2), (1, 1)])
+
+        self.conn.execute('DELETE FROM emprestimo WHERE loanId = ?', (loanId,))
+        self.conn.commit()
+        self.assertEqual(ranking.atualizar(self.conn), [(2, 2)])
+
+    def test_parametros_invalidos(self):
+        """Testa que janelas, entidades e tamanhos fora do aceito retornam 400"""
+        for url in ('/api/relatorio/ranking?dias=10', '/api/relatorio/ranking?entidade=autores',
+                    '/api/relatorio/ranking?n=0', '/api/relatorio/ranking?n=500'):
+            self.assertEqual(self.client.get(url).status_code, 400, url)
+
+
+class TestConexaoLeitura(TestBiblioteca):
+    """Testes das conexões somente leitura usadas por listagens e relatórios"""
+
+    def test_recusa_gravacao(self):
+        """Testa que a conexão de leitura não consegue gravar"""
+        conn = conectar_leitura('biblioteca.db')
+        with self.assertRaises(sqlite3.OperationalError):
+            conn.execute("INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES ('X', 'Y', 1, 1)")
+        conn.close()
+
+    def test_listagens_nao_abrem_conexao_de_escrita(self):
+        """Testa que GETs de listagem e relatório só usam a conexão de leitura"""
+        for url in ('/usuarios', '/livros', '/emprestimos', '/api/relatorio/emprestimos',
+                    '/api/analise/emprestimos', '/api/relatorio/ranking'):
+            self.assertEqual(self.client.get(url).status_code, 200, url)
+        self.assertEqual(pool._escrita.qsize(), 0)
+        self.assertEqual(pool._leitura.qsize(), 1)
+
+    def test_snapshot_nao_bloqueia_gravacao(self):
+        """Testa que uma leitura em andamento não trava um empréstimo e lê
+        sempre o mesmo snapshot"""
+        with self.app.app_context():
+            conn = get_db_leitura()
+            antes = conn.execute('SELECT COUNT(*) FROM livro').fetchone()[0]
+
+            escrita = sqlite3.connect('biblioteca.db', timeout=0)
+            escrita.execute("INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES ('Novo', 'Autor', 1, 1)")
+            escrita.commit()
+            escrita.close()
+
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM livro').fetchone()[0], antes)
+
+        with self.app.app_context():
+            self.assertEqual(get_db_leitura().execute('SELECT COUNT(*) FROM livro').fetchone()[0], antes + 1)
+
+
+class TestArquivamento(TestBiblioteca):
+    """Testes do arquivamento de empréstimos encerrados em emprestimo_historico"""
+
+    def setUp(self):
+        super().setUp()
+        conn = sqlite3.connect('biblioteca.db')
+        c = conn.cursor()
+        c.execute("INSERT INTO usuario (nome, matricula, tipo) VALUES ('A', '10101', 'ALUNO')")
+        c.execute("INSERT INTO livro (titulo, autores, copiasTotal, copiasDisponiveis) VALUES ('L', 'A', 50, 50)")
+        antigos = [(f'2023-01-{d:02d} 10:00:00', 'RETURNED', f'2023-01-{d:02d} 18:00:00') for d in range(1, 13)]
+        antigos += [('2023-02-01 10:00:00', 'OVERDUE', None), ('2023-03-01 10:00:00', 'CANCEL', None)]
+        recentes = [(f'2024-05-{d:02d} 10:00:00', 'RETURNED', f'2024-05-{d:02d} 18:00:00') for d in range(1, 11)]
+        c.executemany('''
+            INSERT INTO emprestimo (userId, bookId, loanDate, dueDate, status, returnDate)
+            VALUES (1, 1, ?, date(?, '+14 days'), ?, ?)
+        ''', [(l, l, s, r) for l, s, r in antigos + recentes])
+        conn.commit()
+        conn.close()
+        self.conn = conectar('biblioteca.db')
+
+    def tearDown(self):
+        self.conn.close()
+        super().tearDown()
+
+    def arquivar(self):
+        return arquivar_emprestimos(self.conn, dias=365, agora=datetime(2024, 6, 1), lote=5)
+
+    def relatorio_completo(self, consulta=''):
+        """loanIds de todas as páginas do relatório, seguindo next_cursor"""
+        ids = []
+        cursor = ''
+        while cursor is not None:
+            data = self.client.get(f'/api/relatorio/emprestimos?cursor={cursor}{consulta}').get_json()
+            ids += [d['loanId'] for d in data['data']]
+            cursor = data['pagination']['next_cursor']
+        return ids
+
+    def test_move_so_encerrados_antigos(self):
+        """Testa que só devolvidos e cancelados anteriores ao limite são movidos"""
+        self.assertEqual(self.arquivar()['linhas'], 13)
+        self.assertEqual(self.conn.execute('SELECT COUNT(*) FROM emprestimo').fetchone()[0], 11)
+        self.assertEqual(self.conn.execute('SELECT status FROM emprestimo ORDER BY loanId').fetchone()[0], 'OVERDUE')
+        c = self.conn.execute('SELECT COUNT(*), MAX(loanDate) FROM emprestimo_historico')
+        self.assertEqual(c.fetchone(), (13, '2023-03-01 10:00:00'))
+        self.assertEqual(self.arquivar()['linhas'], 0)
+
+    def test_contadores_e_agregados_preservados(self):
+        """Testa que arquivar não altera totais, análises nem rankings"""
+        urls = ('/api/relatorio/emprestimos', '/api/analise/emprestimos?agrupar=ano',
+                '/api/analise/atrasos?agrupar=ano', '/api/relatorio/ranking?dias=0')
+        antes = [self.client.get(url).get_json() for url in urls]
+        invalidacoes = "SELECT valor FROM contador WHERE nome = 'ranking_invalidacoes'"
+        invalidacoes_antes = self.conn.execute(invalidacoes).fetchone()[0]
+
+        self.arquivar()
+
+        self.assertEqual([self.client.get(url).get_json() for url in urls], antes)
+        self.assertEqual(self.conn.execute(invalidacoes).fetchone()[0], invalidacoes_antes)
+
+    def test_relatorio_une_historico(self):
+        """Testa que o relatório e a exportação incluem os arquivados quando o
+        período pede, na mesma ordem de antes"""
+        completo = self.relatorio_completo()
+        self.arquivar()
+
+        self.assertEqual(len(completo), 24)
+        self.assertEqual(self.relatorio_completo(), completo)
+        self.assertEqual(len(self.relatorio_completo('&start=2023-01-05&end=2023-01-06')), 2)
+        self.assertEqual(len(self.relatorio_completo('&start=2024-01-01')), 10)
+
+        exportado = self.client.get('/api/relatorio/emprestimos/exportar?formato=ndjson').data.decode()
+        self.assertEqual([json.loads(l)['loanId'] for l in exportado.splitlines()], completo)
+
+
 class TestIntegracao(TestBiblioteca):
     """Testes de integração entre módulos"""
     
@@ -494,5 +2030,65 @@ class TestIntegracao(TestBiblioteca):
         self.assertEqual(len(emprestimos), 1)
 
 
+class TestPoolConexoes(TestBiblioteca):
+    """Testes do reaproveitamento de conexões"""
+
+    def test_conexao_reaproveitada_entre_requisicoes(self):
+        """Testa que requisições seguidas na mesma thread reutilizam a conexão"""
+        self.client.get('/usuarios')
+        antes = pool.estatisticas()
+        self.client.get('/livros')
+        self.client.get('/emprestimos')
+        depois = pool.estatisticas()
+
+        self.assertEqual(depois['misses'], antes['misses'])
+        self.assertEqual(depois['hits'], antes['hits'] + 2)
+        self.assertEqual(depois['conexoes'], 1)
+
+    def test_threads_compartilham_conexoes(self):
+        """Testa que threads novas a cada requisição reaproveitam as conexões
+        devolvidas em vez de abrir uma por thread"""
+        antes = pool.estatisticas()
+        for _ in range(20):
+            t = threading.Thread(target=lambda: self.client.get('/livros'))
+            t.start()
+            t.join()
+        estatisticas = pool.estatisticas()
+
+        self.assertEqual(estatisticas['conexoes'], 1)
+        self.assertEqual(estatisticas['misses'], antes['misses'] + 1)
+        self.assertEqual(estatisticas['hits'], antes['hits'] + 19)
+
+    def test_excedentes_fechados(self):
+        """Testa que conexões devolvidas com a fila cheia são fechadas"""
+        conexoes = [pool.obter() for _ in range(pool.tamanho + 5)]
+        self.assertEqual(pool.estatisticas()['conexoes'], pool.tamanho + 5)
+        for conn in conexoes:
+            pool.liberar(conn)
+
+        estatisticas = pool.estatisticas()
+        self.assertEqual(estatisticas['conexoes'], pool.tamanho)
+        self.assertEqual(estatisticas['ociosas'], pool.tamanho)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conexoes[-1].execute('SELECT 1')
+
+    def test_pragmas_aplicados(self):
+        """Testa que a conexão do pool sai configurada com WAL e foreign keys"""
+        with self.app.app_context():
+            conn = get_db()
+            self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(conn.execute('PRAGMA foreign_keys').fetchone()[0], 1)
+            self.assertEqual(conn.execute('PRAGMA synchronous').fetchone()[0], 1)
+
+    def test_diagnostico_expoe_pool(self):
+        """Testa que o endpoint de diagnóstico informa hits e misses"""
+        self.client.get('/usuarios')
+        response = self.client.get('/api/diagnostico')
+        data = json.loads(response.data)
+
+        self.assertIn('hits', data['pool'])
+        self.assertIn('misses', data['pool'])
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file